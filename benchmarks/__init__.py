@@ -0,0 +1 @@
+"""Benchmarks for the signing pipeline; run with python -m benchmarks"""
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""Stand-in for zsign that does comparable work without a certificate.
+
+It takes zsign's options, unzips the input, hashes every Mach-O file the way
+a signature would (SHA-1 and SHA-256, or SHA-256 only with -2), writes a
+_CodeSignature folder and zips the result at the -z level, printing progress
+lines shaped like the real tool's. Set FAKE_ZSIGN_DELAY to add seconds of
+extra signing time and FAKE_ZSIGN_FAIL to make it exit with that code."""
+
+import hashlib
+import os
+import plistlib
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+
+VALUE_OPTIONS = set("kmpocbnrelz")
+FLAG_OPTIONS = set("awf2iqdv")
+MACHO_MAGICS = {b"\xfe\xed\xfa\xce", b"\xce\xfa\xed\xfe", b"\xfe\xed\xfa\xcf",
+                b"\xcf\xfa\xed\xfe", b"\xca\xfe\xba\xbe", b"\xbe\xba\xfe\xca"}
+PAGE_SIZE = 4096
+MH_MAGIC_64 = 0xFEEDFACF
+LC_CODE_SIGNATURE = 0x1D
+CSMAGIC_EMBEDDED_SIGNATURE = 0xFADE0CC0
+CSMAGIC_CODEDIRECTORY = 0xFADE0C02
+
+
+def parse_args(argv):
+    options = {}
+    inputs = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith("-") and len(arg) == 2 and arg[1] in VALUE_OPTIONS:
+            if i + 1 >= len(argv):
+                raise SystemExit(f">>> Missing value for {arg}")
+            options[arg[1]] = argv[i + 1]
+            i += 2
+        elif arg.startswith("-") and len(arg) == 2 and arg[1] in FLAG_OPTIONS:
+            options[arg[1]] = True
+            i += 1
+        else:
+            inputs.append(arg)
+            i += 1
+    return options, inputs
+
+
+def find_app(folder):
+    for dirpath, dirnames, _ in os.walk(folder):
+        for name in dirnames:
+            if name.endswith(".app"):
+                return os.path.join(dirpath, name)
+    return None
+
+
+def sign_file(path, sha256_only):
+    """Hash the file page by page, as a code directory would"""
+    hashes = [hashlib.sha256] if sha256_only else [hashlib.sha1, hashlib.sha256]
+    digests = []
+    with open(path, "rb") as f:
+        for page in iter(lambda: f.read(PAGE_SIZE), b""):
+            for algorithm in hashes:
+                digests.append(algorithm(page).digest())
+    return digests
+
+
+def embed_signature(path, digests):
+    """Append the page hashes as a code signature and point an
+    LC_CODE_SIGNATURE load command at it, replacing an earlier one. Only
+    little-endian 64-bit files with room after their load commands are
+    signed, which is all synth.py writes."""
+    with open(path, "r+b") as f:
+        header = bytearray(f.read(PAGE_SIZE))
+        if len(header) < 32 or struct.unpack_from("<I", header)[0] != MH_MAGIC_64:
+            return False
+        ncmds, sizeofcmds = struct.unpack_from("<II", header, 16)
+        offset, end = 32, 32 + sizeofcmds
+        while offset < end:
+            cmd, size = struct.unpack_from("<II", header, offset)
+            if size < 8:
+                return False
+            if cmd == LC_CODE_SIGNATURE:
+                f.truncate(struct.unpack_from("<I", header, offset + 8)[0])
+                break
+            offset += size
+        else:
+            if end + 16 > PAGE_SIZE or any(header[end:end + 16]):
+                return False
+            ncmds, sizeofcmds = ncmds + 1, sizeofcmds + 16
+        f.seek(0, os.SEEK_END)
+        dataoff = (f.tell() + 15) // 16 * 16
+        directory = b"".join(digests)
+        directory = struct.pack(">II", CSMAGIC_CODEDIRECTORY, 8 + len(directory)) + directory
+        blob = struct.pack(">IIIII", CSMAGIC_EMBEDDED_SIGNATURE, 20 + len(directory), 1, 0, 20) + directory
+        struct.pack_into("<II", header, 16, ncmds, sizeofcmds)
+        struct.pack_into("<IIII", header, offset, LC_CODE_SIGNATURE, 16, dataoff, len(blob))
+        f.seek(0)
+        f.write(header)
+        f.seek(dataoff)
+        f.write(blob)
+    return True
+
+
+def apply_overrides(app, options):
+    """Rename the app's bundle ID and name in its Info.plist, as -b and -n
+    do, moving plugins' bundle IDs under the new one"""
+    if not options.get("b") and not options.get("n"):
+        return
+    path = os.path.join(app, "Info.plist")
+    with open(path, "rb") as f:
+        info = plistlib.load(f)
+    old_id = info.get("CFBundleIdentifier", "")
+    if options.get("b"):
+        info["CFBundleIdentifier"] = options["b"]
+    if options.get("n"):
+        info["CFBundleDisplayName"] = options["n"]
+    with open(path, "wb") as f:
+        plistlib.dump(info, f)
+
+    plugins = os.path.join(app, "PlugIns")
+    if not options.get("b") or not old_id or not os.path.isdir(plugins):
+        return
+    for name in os.listdir(plugins):
+        path = os.path.join(plugins, name, "Info.plist")
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            info = plistlib.load(f)
+        identifier = info.get("CFBundleIdentifier", "")
+        if identifier.startswith(old_id + "."):
+            info["CFBundleIdentifier"] = options["b"] + identifier[len(old_id):]
+            with open(path, "wb") as f:
+                plistlib.dump(info, f)
+
+
+def sign_folder(app, options):
+    apply_overrides(app, options)
+    resources = []
+    for dirpath, _, filenames in os.walk(app):
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                continue
+            with open(path, "rb") as f:
+                header = f.read(4)
+            rel = os.path.relpath(path, app)
+            if header in MACHO_MAGICS:
+                print(f">>> SignFile: \t{rel}", flush=True)
+                digests = sign_file(path, options.get("2"))
+                embed_signature(path, digests)
+                resources.append(f"{rel} {hashlib.sha256(b''.join(digests)).hexdigest()}")
+            elif not options.get("f") and rel.startswith("_CodeSignature"):
+                continue
+            else:
+                resources.append(f"{rel} {hashlib.sha256(open(path, 'rb').read()).hexdigest()}")
+
+    signature = os.path.join(app, "_CodeSignature")
+    os.makedirs(signature, exist_ok=True)
+    with open(os.path.join(signature, "CodeResources"), "w") as f:
+        f.write("\n".join(resources))
+    if options.get("m"):
+        shutil.copyfile(options["m"], os.path.join(app, "embedded.mobileprovision"))
+
+
+def archive(folder, output, level):
+    compression = zipfile.ZIP_STORED if level == 0 else zipfile.ZIP_DEFLATED
+    tmp = f"{output}.tmp"
+    with zipfile.ZipFile(tmp, "w", compression, compresslevel=level or None, allowZip64=True) as zf:
+        for dirpath, dirnames, filenames in os.walk(folder):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                zf.write(path, os.path.relpath(path, folder))
+    os.replace(tmp, output)
+
+
+def main(argv):
+    options, inputs = parse_args(argv)
+    if options.get("v"):
+        print("zsign v0.5 (fake)")
+        return 0
+    if not inputs:
+        print(">>> No input file or folder")
+        return 1
+    if not options.get("a") and not (options.get("k") and options.get("m")):
+        print(">>> Missing private key or provisioning profile")
+        return 1
+
+    source = inputs[-1]
+    level = int(options.get("z", 0))
+    temp = None
+    try:
+        if os.path.isdir(source):
+            folder = source
+        else:
+            temp = tempfile.mkdtemp(prefix="fake_zsign_")
+            start = time.monotonic()
+            print(f">>> Unzip:\t{source} ({os.path.getsize(source) / (1024 * 1024):.2f} MB) -> {temp} ...", flush=True)
+            with zipfile.ZipFile(source) as zf:
+                zf.extractall(temp)
+            print(f">>> Unzip OK! ({time.monotonic() - start:.3f}s)", flush=True)
+            folder = temp
+
+        app = find_app(folder)
+        if not app:
+            print(">>> Can't find app folder")
+            return 1
+
+        start = time.monotonic()
+        print(f">>> Signing:\t{app} ...", flush=True)
+        if options.get("b"):
+            print(f">>> BundleId:\t{options['b']}", flush=True)
+        sign_folder(app, options)
+        time.sleep(float(os.environ.get("FAKE_ZSIGN_DELAY", "0")))
+        fail = int(os.environ.get("FAKE_ZSIGN_FAIL", "0"))
+        if fail:
+            print(">>> Sign failed!")
+            return fail
+        print(f">>> Signed OK! ({time.monotonic() - start:.3f}s)", flush=True)
+
+        if options.get("o"):
+            start = time.monotonic()
+            print(f">>> Archiving:\t{options['o']} ...", flush=True)
+            archive(folder, options["o"], level)
+            print(f">>> Archive OK! ({time.monotonic() - start:.3f}s)", flush=True)
+        print(">>> Done.", flush=True)
+        return 0
+    finally:
+        if temp:
+            shutil.rmtree(temp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,315 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass, field, replace
+
+from neosigner import batch, engine, packaging, tools
+from neosigner.engine import SignJob
+
+from .synth import make_ipa
+
+FAKE_ZSIGN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_zsign.py")
+RSS_SAMPLE_SECONDS = 0.01
+
+
+@dataclass
+class Scenario:
+    """One point in the benchmark matrix"""
+    name: str
+    zip_level: int = 9
+    sha256_only: bool = False
+    force: bool = False
+    parallel_zip: bool = False
+    concurrency: int = 0
+
+
+@dataclass
+class Measurement:
+    scenario: str
+    params: dict
+    runs: int = 0
+    failures: int = 0
+    p50: float = 0.0
+    p95: float = 0.0
+    throughput_mb_s: float = 0.0
+    jobs_per_s: float = 0.0
+    peak_rss_mb: float = None
+    output_mb: float = 0.0
+    latencies: list = field(default_factory=list)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile; good enough for a handful of runs"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def _child_pids(parent):
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                # The command name is in parentheses and may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent:
+            pids.append(int(name))
+    return pids
+
+
+def _peak_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class PeakRSS:
+    """Sample the peak resident size of child processes started while active.
+
+    Reads /proc, so it only reports on Linux; peak_mb stays None elsewhere.
+    Children that already existed, like packaging workers, are left out."""
+
+    def __init__(self):
+        self.supported = os.path.isdir("/proc/self")
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._ignore = set()
+
+    def __enter__(self):
+        if self.supported:
+            self._ignore = set(_child_pids(os.getpid()))
+            self.peak_mb = 0.0
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+
+    def _sample(self):
+        me = os.getpid()
+        while not self._stop.wait(RSS_SAMPLE_SECONDS):
+            for pid in _child_pids(me):
+                if pid not in self._ignore:
+                    self.peak_mb = max(self.peak_mb, _peak_rss_kb(pid) / 1024)
+
+
+def build_matrix(args):
+    scenarios = []
+    for mode, level, sha256_only, force in itertools.product(
+            args.modes, args.levels, args.sha256, args.force):
+        name = f"{mode} z{level}{' -2' if sha256_only else ''}{' -f' if force else ''}"
+        scenarios.append(Scenario(name, zip_level=level, sha256_only=sha256_only, force=force,
+                                  parallel_zip=mode == "parallel"))
+    for concurrency in args.concurrency:
+        scenarios.append(Scenario(f"batch x{concurrency}", zip_level=args.batch_level,
+                                  parallel_zip=args.modes == ["parallel"], concurrency=concurrency))
+    return scenarios
+
+
+def template_job(args, scenario):
+    return SignJob(
+        input_path="",
+        pkey=args.pkey,
+        prov=args.prov,
+        password=args.password,
+        adhoc=not args.pkey,
+        zip_level=scenario.zip_level,
+        sha256_only=scenario.sha256_only,
+        force=scenario.force,
+        parallel_zip=scenario.parallel_zip
+    )
+
+
+def run_single(zsign_path, ipa, workdir, args, scenario):
+    measurement = Measurement(scenario.name, asdict(scenario))
+    job = replace(template_job(args, scenario), input_path=ipa,
+                  output_path=os.path.join(workdir, "out.ipa"))
+    engine.validate(job)
+    with PeakRSS() as rss:
+        for _ in range(args.repeat):
+            result = engine.run(zsign_path, job)
+            measurement.runs += 1
+            if not result.ok:
+                measurement.failures += 1
+                continue
+            measurement.latencies.append(result.elapsed)
+            measurement.output_mb = result.output_size / (1024 * 1024)
+    measurement.peak_rss_mb = rss.peak_mb
+    total = sum(measurement.latencies)
+    if total:
+        measurement.throughput_mb_s = len(measurement.latencies) * os.path.getsize(ipa) / (1024 * 1024) / total
+        measurement.jobs_per_s = len(measurement.latencies) / total
+    return measurement
+
+
+def run_batch(zsign_path, ipa, workdir, args, scenario):
+    measurement = Measurement(scenario.name, asdict(scenario))
+    items = [batch.BatchItem(ipa, {"output_path": os.path.join(workdir, f"batch{i}.ipa")})
+             for i in range(args.batch_jobs)]
+    batch.prepare_jobs(items, template_job(args, scenario), workdir)
+    runner = batch.BatchRunner(zsign_path, items, max_workers=scenario.concurrency)
+    with PeakRSS() as rss:
+        summary = runner.run()
+    measurement.peak_rss_mb = rss.peak_mb
+    measurement.runs = summary.total
+    measurement.failures = summary.total - summary.succeeded
+    measurement.latencies = [item.elapsed for item in items if item.status == batch.SUCCEEDED]
+    outputs = [item.job.output_path for item in items if item.status == batch.SUCCEEDED]
+    if outputs:
+        measurement.output_mb = os.path.getsize(outputs[0]) / (1024 * 1024)
+    if summary.elapsed:
+        measurement.throughput_mb_s = summary.succeeded * os.path.getsize(ipa) / (1024 * 1024) / summary.elapsed
+        measurement.jobs_per_s = summary.succeeded / summary.elapsed
+    return measurement
+
+
+def print_table(measurements, out=sys.stdout):
+    header = f"{'scenario':<24} {'runs':>5} {'fail':>5} {'p50 s':>8} {'p95 s':>8} {'MB/s':>8} {'jobs/s':>7} {'RSS MB':>7} {'out MB':>8}"
+    print(header, file=out)
+    print("-" * len(header), file=out)
+    for m in measurements:
+        rss = f"{m.peak_rss_mb:.0f}" if m.peak_rss_mb is not None else "n/a"
+        print(f"{m.scenario:<24} {m.runs:>5} {m.failures:>5} {m.p50:>8.3f} {m.p95:>8.3f} "
+              f"{m.throughput_mb_s:>8.1f} {m.jobs_per_s:>7.2f} {rss:>7} {m.output_mb:>8.2f}", file=out)
+
+
+def compare(measurements, baseline_path, tolerance):
+    """Return the scenarios whose p50 got slower than the baseline by more than tolerance"""
+    with open(baseline_path) as f:
+        baseline = {record["scenario"]: record for record in json.load(f)["results"]}
+    regressions = []
+    for m in measurements:
+        before = baseline.get(m.scenario)
+        if before and before["p50"] and m.p50 > before["p50"] * (1 + tolerance):
+            regressions.append(f"{m.scenario}: p50 {before['p50']:.3f}s -> {m.p50:.3f}s")
+    return regressions
+
+
+def int_list(text):
+    values = []
+    for part in text.split(","):
+        if "-" in part:
+            low, high = part.split("-")
+            values.extend(range(int(low), int(high) + 1))
+        elif part:
+            values.append(int(part))
+    return values
+
+
+def flag_list(text):
+    return [{"off": False, "on": True}[part] for part in text.split(",")]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Measure signing latency, throughput, memory and output size on synthetic IPAs."
+    )
+    parser.add_argument("--zsign", default=None,
+                        help="zsign binary to measure (default: the bundled fake zsign)")
+    parser.add_argument("--real", action="store_true", help="use the zsign found by NeoSigner")
+    parser.add_argument("-k", "--pkey", default="", help="certificate for a real zsign (ad-hoc if not given)")
+    parser.add_argument("-m", "--prov", default="", help="provisioning profile for a real zsign")
+    parser.add_argument("-p", "--password", default="", help="certificate password")
+    parser.add_argument("--size", type=float, default=20, help="synthetic IPA size in MB (default %(default)s)")
+    parser.add_argument("--files", type=int, default=500, help="files in the synthetic IPA (default %(default)s)")
+    parser.add_argument("--ipa", default=None, help="benchmark this IPA instead of a synthetic one")
+    parser.add_argument("--levels", type=int_list, default=list(range(10)),
+                        help="zip levels to try, e.g. 0,6,9 or 0-9 (default 0-9)")
+    parser.add_argument("--sha256", type=flag_list, default=[False, True],
+                        help="-2 settings to try: off, on or off,on (default off,on)")
+    parser.add_argument("--force", type=flag_list, default=[False, True],
+                        help="-f settings to try: off, on or off,on (default off,on)")
+    parser.add_argument("--modes", type=lambda text: text.split(","), default=["zsign"],
+                        help="packaging to try: zsign, parallel or zsign,parallel (default zsign)")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 2, 4],
+                        help="batch concurrency levels to try (default 1,2,4)")
+    parser.add_argument("--batch-jobs", type=int, default=8, help="jobs in each batch run (default %(default)s)")
+    parser.add_argument("--batch-level", type=int, default=9, help="zip level for batch runs (default %(default)s)")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="runs per scenario (default %(default)s)")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    parser.add_argument("--baseline", default=None, help="results file from an earlier --json run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed p50 slowdown against the baseline (default %(default)s)")
+    parser.add_argument("--keep", action="store_true", help="keep the working folder")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.real:
+        zsign_path = tools.find_zsign_binary()
+        if not zsign_path:
+            print("zsign binary not found", file=sys.stderr)
+            return 2
+    else:
+        zsign_path = args.zsign or FAKE_ZSIGN
+    if zsign_path == FAKE_ZSIGN and not os.access(FAKE_ZSIGN, os.X_OK):
+        os.chmod(FAKE_ZSIGN, os.stat(FAKE_ZSIGN).st_mode | stat.S_IXUSR)
+
+    workdir = tempfile.mkdtemp(prefix="neosigner-bench-")
+    try:
+        ipa = args.ipa
+        if not ipa:
+            ipa = os.path.join(workdir, "synthetic.ipa")
+            start = time.monotonic()
+            size = make_ipa(ipa, int(args.size * 1024 * 1024), args.files)
+            print(f"Generated {ipa}: {args.files} files, {size / (1024 * 1024):.1f} MB "
+                  f"in {time.monotonic() - start:.1f}s")
+        if "parallel" in args.modes:
+            # Start the workers now so they don't count against the first run
+            list(packaging.shared_pool().map(abs, range(os.cpu_count() or 1)))
+
+        print(f"zsign: {zsign_path}")
+        measurements = []
+        for scenario in build_matrix(args):
+            if scenario.concurrency:
+                m = run_batch(zsign_path, ipa, workdir, args, scenario)
+            else:
+                m = run_single(zsign_path, ipa, workdir, args, scenario)
+            m.p50 = percentile(m.latencies, 50)
+            m.p95 = percentile(m.latencies, 95)
+            measurements.append(m)
+            print(f"  {m.scenario}: p50 {m.p50:.3f}s, {m.failures} failed", flush=True)
+
+        print()
+        print_table(measurements)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"zsign": zsign_path, "ipa_bytes": os.path.getsize(ipa),
+                           "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                           "results": [asdict(m) for m in measurements]}, f, indent=2)
+        if args.baseline:
+            regressions = compare(measurements, args.baseline, args.tolerance)
+            for line in regressions:
+                print(f"Regression: {line}", file=sys.stderr)
+            if regressions:
+                return 1
+        return 0 if all(m.failures == 0 for m in measurements) else 1
+    finally:
+        if args.keep:
+            print(f"Working folder kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
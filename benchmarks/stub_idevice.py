@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Stand-in for libimobiledevice's idevice_id, ideviceinfo and ideviceinstaller.
+
+Link it under those names (stub_idevice.py --link DIR) and put DIR first on
+PATH. The connected devices are the UDIDs listed one per line in the file
+named by STUB_IDEVICE_FILE, or comma-separated in STUB_IDEVICES; edit the
+file to plug and unplug devices while NeoSigner is running.
+
+Other settings:
+  STUB_INSTALL_SECONDS  how long an install takes (default 1)
+  STUB_LIST_SECONDS     how long 'ideviceinstaller -l' takes (default 2)
+  STUB_FAIL_UDIDS       comma-separated UDIDs whose installs fail"""
+
+import os
+import sys
+import time
+
+TOOLS = ("idevice_id", "ideviceinfo", "ideviceinstaller")
+DEFAULT_UDID = "00008030-000000000000STUB"
+
+
+def connected():
+    path = os.environ.get("STUB_IDEVICE_FILE")
+    if path:
+        try:
+            with open(path) as f:
+                return [line.strip() for line in f if line.strip()]
+        except OSError:
+            return []
+    value = os.environ.get("STUB_IDEVICES")
+    if value is not None:
+        return [udid for udid in value.split(",") if udid]
+    return [DEFAULT_UDID]
+
+
+def option(args, name):
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return None
+
+
+def pick_device(args):
+    devices = connected()
+    udid = option(args, "-u")
+    if udid:
+        return udid if udid in devices else None
+    return devices[0] if devices else None
+
+
+def idevice_id(args):
+    if "-l" not in args:
+        print("Usage: idevice_id -l", file=sys.stderr)
+        return 1
+    for udid in connected():
+        print(udid)
+    return 0
+
+
+def ideviceinfo(args):
+    udid = pick_device(args)
+    if not udid:
+        print(f"ERROR: Device {option(args, '-u') or ''} not found!", file=sys.stderr)
+        return 1
+    index = connected().index(udid) + 1
+    values = {
+        "DeviceName": f"Stub Phone {index}",
+        "ProductType": "iPhone15,2",
+        "ProductVersion": "17.4",
+        "UniqueDeviceID": udid,
+    }
+    key = option(args, "-k")
+    if key:
+        print(values.get(key, ""))
+    else:
+        for name, value in values.items():
+            print(f"{name}: {value}")
+    return 0
+
+
+def ideviceinstaller(args):
+    udid = pick_device(args)
+    if not udid:
+        print("ERROR: No device found.")
+        return 1
+
+    if "-l" in args:
+        time.sleep(float(os.environ.get("STUB_LIST_SECONDS", "2")))
+        print("CFBundleIdentifier, CFBundleVersion, CFBundleDisplayName")
+        for i in range(50):
+            print(f'com.example.app{i}, "1.0", "App {i}"')
+        return 0
+
+    ipa = option(args, "-i")
+    if not ipa:
+        print("Usage: ideviceinstaller -i PATH", file=sys.stderr)
+        return 1
+    if not os.path.exists(ipa):
+        print(f"ERROR: stat: {ipa}: No such file or directory")
+        return 1
+    seconds = float(os.environ.get("STUB_INSTALL_SECONDS", "1"))
+    print(f"Copying '{ipa}' to device... DONE.", flush=True)
+    steps = ("CreatingStagingDirectory", "ExtractingPackage", "InspectingPackage", "VerifyingApplication",
+             "GeneratingApplicationMap", "InstallComplete")
+    for i, step in enumerate(steps):
+        time.sleep(seconds / len(steps))
+        if step == "VerifyingApplication" and udid in os.environ.get("STUB_FAIL_UDIDS", "").split(","):
+            print('ERROR: Install failed. Got error "ApplicationVerificationFailed"', flush=True)
+            return 1
+        print(f"Install: {step} ({(i + 1) * 100 // len(steps)}%)", flush=True)
+    print("Install: Complete", flush=True)
+    return 0
+
+
+def link(directory):
+    os.makedirs(directory, exist_ok=True)
+    script = os.path.abspath(__file__)
+    for name in TOOLS:
+        target = os.path.join(directory, name)
+        if os.path.lexists(target):
+            os.remove(target)
+        os.symlink(script, target)
+        print(target)
+    return 0
+
+
+def main(argv):
+    name = os.path.basename(argv[0])
+    args = argv[1:]
+    if args[:1] == ["--link"] and len(args) == 2:
+        return link(args[1])
+    if name == "idevice_id":
+        return idevice_id(args)
+    if name == "ideviceinfo":
+        return ideviceinfo(args)
+    if name == "ideviceinstaller":
+        return ideviceinstaller(args)
+    print(__doc__, file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,85 @@
+import os
+import plistlib
+import random
+import struct
+import zipfile
+
+# Share of the app's bytes in each kind of file, roughly what a mid-sized
+# app looks like: one large executable, compressed images and assets, and
+# many small text resources
+MIX = (
+    ("binary", 0.45),
+    ("image", 0.30),
+    ("text", 0.25),
+)
+
+# An arm64 executable's header with no load commands yet, followed by the
+# padding linkers leave so a signer can add its own
+MACHO_HEADER = struct.pack("<IiiIIIII", 0xFEEDFACF, 0x0100000C, 0, 2, 0, 0, 0, 0).ljust(4096, b"\0")
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+
+def word_block(rng, size=256 * 1024):
+    """A block of word salad with the odd random run, which deflates to
+    about a third, like code and plain text"""
+    words = [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz_") for _ in range(rng.randint(3, 10)))
+             for _ in range(512)]
+    block = bytearray()
+    while len(block) < size:
+        block += rng.choice(words) + b" "
+        if rng.random() < 0.05:
+            block += random_bytes(rng, 8)
+    return bytes(block[:size])
+
+
+def compressible_bytes(rng, size, block):
+    """size bytes made of block repeated at different rotations with a few
+    random bytes each time; much faster than drawing every word, and the
+    repeats are too far apart for deflate to notice"""
+    out = bytearray()
+    while len(out) < size:
+        offset = rng.randrange(len(block))
+        chunk = bytearray(block[offset:] + block[:offset])
+        for _ in range(64):
+            at = rng.randrange(len(block) - 8)
+            chunk[at:at + 8] = random_bytes(rng, 8)
+        out += chunk
+    return bytes(out[:size])
+
+
+def make_ipa(path, size_bytes, file_count, seed=0, name="Bench", level=6):
+    """Write a synthetic IPA of about size_bytes spread over file_count files"""
+    rng = random.Random(seed)
+    block = word_block(rng)
+    app = f"Payload/{name}.app/"
+    file_count = max(3, file_count)
+    info = plistlib.dumps({
+        "CFBundleIdentifier": f"com.example.{name.lower()}",
+        "CFBundleName": name,
+        "CFBundleExecutable": name,
+        "CFBundleShortVersionString": "1.0",
+        "CFBundleVersion": "1",
+    })
+
+    binary_size = int(size_bytes * MIX[0][1])
+    images = max(1, (file_count - 2) // 4)
+    texts = max(1, file_count - 2 - images)
+    image_size = max(1, int(size_bytes * MIX[1][1]) // images)
+    text_size = max(1, int(size_bytes * MIX[2][1]) // texts)
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=level, allowZip64=True) as zf:
+        zf.writestr(app + "Info.plist", info)
+        executable = zipfile.ZipInfo(app + name)
+        executable.external_attr = 0o100755 << 16
+        executable.compress_type = zipfile.ZIP_DEFLATED
+        zf.writestr(executable, MACHO_HEADER + compressible_bytes(rng, binary_size, block))
+        for i in range(images):
+            folder = f"Assets/{i % 16}/"
+            zf.writestr(f"{app}{folder}image{i}.png", random_bytes(rng, image_size))
+        for i in range(texts):
+            folder = f"Resources/{i % 32}/"
+            zf.writestr(f"{app}{folder}strings{i}.txt", compressible_bytes(rng, text_size, block))
+    return os.path.getsize(path)
@@ -0,0 +1 @@
+"""Signing helpers shared by the NeoSigner GUI and batch tools"""
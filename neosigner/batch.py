@@ -0,0 +1,387 @@
+import csv
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field, replace
+
+from . import engine
+from .cache import job_key
+from .ipainfo import bundle_id_of
+from .verify import can_verify, verify_job
+
+PENDING = "pending"
+RUNNING = "running"
+RETRYING = "retrying"
+# Signed, with the output being checked while the next job runs
+VERIFYING = "verifying"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Per-job overrides accepted from the GUI and from manifests
+OVERRIDE_FIELDS = ("output_path", "bundle_id", "bundle_name", "prov", "pkey", "dylib")
+
+# Manifest column names mapped to SignJob fields
+MANIFEST_COLUMNS = {
+    "input": "input_path",
+    "output": "output_path",
+    "bundle_id": "bundle_id",
+    "bundle_name": "bundle_name",
+    "profile": "prov",
+    "certificate": "pkey",
+    "dylib": "dylib",
+}
+
+# Manifest columns that hold text rather than a path
+TEXT_COLUMNS = ("bundle_id", "bundle_name")
+
+
+@dataclass
+class BatchItem:
+    """One IPA in a batch along with its overrides and status"""
+    input_path: str
+    overrides: dict = field(default_factory=dict)
+    job: object = None
+    # Shown instead of the input's file name, e.g. a fan-out variant's name
+    label: str = ""
+    status: str = PENDING
+    attempts: int = 0
+    returncode: int = None
+    elapsed: float = 0.0
+    error: str = ""
+    # For a job resumed from the journal, the SignJob it was first run with
+    # and the ID of the entry it picks up from
+    resumed_job: object = None
+    resumes: int = None
+
+    @property
+    def name(self):
+        return self.label or os.path.basename(self.input_path)
+
+
+@dataclass
+class BatchSummary:
+    total: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    cancelled: int = 0
+    elapsed: float = 0.0
+
+    def __str__(self):
+        return (f"Batch finished in {self.elapsed:.1f}s: {self.succeeded} succeeded, "
+                f"{self.failed} failed, {self.cancelled} cancelled (of {self.total})")
+
+
+def default_output_path(input_path, output_dir=""):
+    """Return <output_dir>/<name>_signed.ipa, defaulting to the input's directory"""
+    name = os.path.basename(os.path.normpath(input_path))
+    stem = os.path.splitext(name)[0]
+    directory = output_dir or os.path.dirname(os.path.abspath(input_path))
+    return os.path.join(directory, f"{stem}_signed.ipa")
+
+
+def manifest_rows(path):
+    """Each row of a CSV manifest with lower-cased column names, along with
+    the row's overrides; relative paths are resolved against the manifest's
+    directory"""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            row = {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+            overrides = {}
+            for column, attr in MANIFEST_COLUMNS.items():
+                value = row.get(column)
+                if value and column not in TEXT_COLUMNS:
+                    value = os.path.join(base_dir, os.path.expanduser(value))
+                if value:
+                    overrides[attr] = value
+            yield row, overrides
+
+
+def load_manifest(path):
+    """Load batch items from a CSV file with an 'input' column and optional
+    'output', 'bundle_id', 'bundle_name', 'profile', 'certificate' and
+    'dylib' columns. Relative paths are resolved against the manifest's
+    directory."""
+    items = []
+    for row, overrides in manifest_rows(path):
+        if not row.get("input"):
+            continue
+        input_path = overrides.pop("input_path")
+        items.append(BatchItem(input_path, overrides))
+    return items
+
+
+def prepare_jobs(items, template, output_dir=""):
+    """Expand each item into a SignJob based on the template settings"""
+    seen_outputs = set()
+    for item in items:
+        if item.resumed_job:
+            # Signed again with every option it had, not the template's
+            item.job = replace(item.resumed_job, password=item.resumed_job.password or template.password)
+        else:
+            overrides = {k: v for k, v in item.overrides.items() if k in OVERRIDE_FIELDS and v}
+            overrides.setdefault("output_path", default_output_path(item.input_path, output_dir))
+            item.job = replace(template, input_path=item.input_path, **overrides)
+
+        output = os.path.abspath(item.job.output_path)
+        if output in seen_outputs:
+            raise ValueError(f"More than one job writes to {item.job.output_path}")
+        seen_outputs.add(output)
+    return items
+
+
+class BatchRunner:
+    """Run a batch of signing jobs on a pool of concurrent zsign processes.
+
+    With a Journal, every job is recorded as queued when the batch starts,
+    then as it starts and finishes, and a job the journal says was already
+    signed into an output that is still intact is skipped, so a batch run
+    again after a crash (or resumed) picks up where it stopped. With a
+    Scheduler, a job only starts once there are cores, disk space and
+    memory for it. zsign always runs at background priority.
+    With verify, each signed IPA is checked in a process pool while the
+    next job runs, and a job whose output fails the check has failed."""
+
+    def __init__(self, zsign_path, items, max_workers=None, retries=0,
+                 on_update=None, on_output=None, cache=None, workspace=None, metrics=None, journal=None,
+                 scheduler=None, scratch=None, verify=False):
+        self.zsign_path = zsign_path
+        self.cache = cache
+        self.workspace = workspace
+        self.metrics = metrics
+        self.journal = journal
+        self.scheduler = scheduler
+        self.scratch = scratch
+        self.verify = verify
+        self.run_id = f"{os.getpid()}-{int(time.time())}"
+        self.items = items
+        if scheduler:
+            self.max_workers = min(max_workers or scheduler.max_jobs, scheduler.max_jobs)
+        else:
+            self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.retries = max(0, retries)
+        self.on_update = on_update
+        self.on_output = on_output
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._processes = set()
+        self._verifying = 0
+        self._verified_all = threading.Condition(self._lock)
+        # Journal entry ID of each queued item, by id(item)
+        self._entries = {}
+
+    def cancel(self):
+        """Stop starting new jobs and kill the running zsign processes"""
+        self._cancelled.set()
+        with self._lock:
+            for process in list(self._processes):
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+
+    def run(self):
+        """Run every job and return a BatchSummary; blocks until done"""
+        start = time.monotonic()
+        for item in self.items:
+            self._journal_queue(item)
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix="zsign-batch") as pool:
+            for item in self.items:
+                pool.submit(self._run_item, item)
+        with self._verified_all:
+            while self._verifying:
+                self._verified_all.wait()
+
+        summary = BatchSummary(total=len(self.items), elapsed=time.monotonic() - start)
+        for item in self.items:
+            if item.status == SUCCEEDED:
+                summary.succeeded += 1
+            elif item.status == CANCELLED:
+                summary.cancelled += 1
+            else:
+                summary.failed += 1
+        return summary
+
+    def _notify(self, item):
+        if self.on_update:
+            self.on_update(item)
+
+    def _emit(self, item, line):
+        if self.on_output:
+            self.on_output(item, line)
+
+    def _run_item(self, item):
+        start = time.monotonic()
+        entry = None
+        result = None
+        handed_off = False
+        try:
+            entry = self._journal_start(item)
+            if item.status == SUCCEEDED:
+                # The journal has it signed already
+                return
+            while not self._cancelled.is_set():
+                item.attempts += 1
+                item.status = RUNNING
+                self._notify(item)
+
+                result = self._run_zsign(item)
+                item.returncode = result.returncode
+                if item.returncode == 0:
+                    item.status = SUCCEEDED
+                    break
+                if self._cancelled.is_set():
+                    break
+                if item.attempts > self.retries:
+                    item.status = FAILED
+                    item.error = f"zsign exited with code {item.returncode}"
+                    break
+                item.status = RETRYING
+                self._notify(item)
+                self._emit(item, f"Retrying (attempt {item.attempts + 1} of {self.retries + 1})")
+
+            if self._cancelled.is_set() and item.status != SUCCEEDED:
+                item.status = CANCELLED
+            elif item.status == SUCCEEDED and self.verify and can_verify(item.job):
+                item.elapsed = time.monotonic() - start
+                handed_off = self._start_verify(item, entry, result)
+        except engine.SignError as e:
+            item.status = CANCELLED if self._cancelled.is_set() else FAILED
+            item.error = str(e)
+            self._emit(item, str(e))
+        except Exception as e:
+            item.status = FAILED
+            item.error = str(e)
+            self._emit(item, f"Error: {str(e)}")
+        finally:
+            # Once handed off, _verified finishes the item, maybe already has
+            if not handed_off:
+                item.elapsed = time.monotonic() - start
+                if entry is not None:
+                    self._journal_finish(item, entry, result)
+                self._notify(item)
+
+    def _start_verify(self, item, entry, result):
+        """Check the output in the verification pool and finish the item once
+        that's done, leaving this thread free for the next job. Returns
+        whether the item was handed off to be finished there."""
+        try:
+            future = verify_job(item.job)
+        except Exception as e:
+            self._emit(item, f"Could not verify {item.job.output_path}: {str(e) or type(e).__name__}")
+            return False
+        item.status = VERIFYING
+        with self._lock:
+            self._verifying += 1
+        self._notify(item)
+        # Runs _verified right here if the check is already done
+        future.add_done_callback(lambda done: self._verified(item, entry, result, done))
+        return True
+
+    def _verified(self, item, entry, result, future):
+        try:
+            verification = future.result()
+            self._emit(item, str(verification))
+            if verification.ok:
+                item.status = SUCCEEDED
+            else:
+                item.status = FAILED
+                item.error = f"output failed verification: {'; '.join(verification.problems)}"
+        except Exception as e:
+            # The output may well be fine; only the check couldn't run
+            item.status = SUCCEEDED
+            self._emit(item, f"Could not verify {item.job.output_path}: {str(e) or type(e).__name__}")
+        finally:
+            if entry is not None:
+                self._journal_finish(item, entry, result)
+            self._notify(item)
+            with self._verified_all:
+                self._verifying -= 1
+                self._verified_all.notify_all()
+
+    def _journal_queue(self, item):
+        """Record the item as queued, so it can be resumed even if this
+        process dies before the pool gets to it"""
+        if not self.journal:
+            return
+        try:
+            if item.resumes is not None:
+                self.journal.requeued([item.resumes])
+            if not os.path.exists(item.job.input_path):
+                # engine.run reports a missing input
+                return
+            self._entries[id(item)] = self.journal.queue(item.job, run=self.run_id)
+        except OSError as e:
+            self._emit(item, f"Could not update journal: {str(e)}")
+
+    def _journal_start(self, item):
+        """Record that a queued item is starting and return its journal
+        entry's ID, or mark it succeeded if the journal has it done already.
+        Runs on the pool, as the key hashes every input."""
+        entry = self._entries.get(id(item))
+        if entry is None:
+            return None
+        try:
+            key = job_key(self.zsign_path, item.job)
+            done = item.job.output_path and self.journal.completed(key, item.job.output_path)
+            if done:
+                item.status = SUCCEEDED
+                item.returncode = 0
+                finished = time.strftime("%Y-%m-%d %H:%M", time.localtime(done.finished))
+                self._emit(item, f"Already signed on {finished}, skipping ({item.job.output_path} is unchanged)")
+                self.journal.discard(entry)
+                return None
+            bundle_id = item.job.bundle_id or bundle_id_of(item.job.input_path)
+            return self.journal.start(item.job, key, bundle_id, entry_id=entry)
+        except OSError as e:
+            self._emit(item, f"Could not update journal: {str(e)}")
+            # Still recorded as queued, so finish it
+            return entry
+
+    def _journal_finish(self, item, entry, result):
+        try:
+            self.journal.finish(entry, item.status, item.returncode, item.error, item.job.output_path,
+                                item.elapsed, result.record.stages if result and result.record else None)
+        except OSError as e:
+            self._emit(item, f"Could not update journal: {str(e)}")
+
+    def _track(self, process):
+        with self._lock:
+            self._processes.add(process)
+        if self._cancelled.is_set():
+            process.kill()
+
+    def _admitted(self, item):
+        if not self.scheduler:
+            return nullcontext()
+        return self.scheduler.admit(item.job, self.workspace, scratch=self.scratch, cancelled=self._cancelled,
+                                    on_wait=lambda reason: self._emit(item, f"Waiting to start: {reason}"))
+
+    def _run_zsign(self, item):
+        started = []
+
+        def on_start(process):
+            started.append(process)
+            self._track(process)
+
+        try:
+            with self._admitted(item):
+                result = engine.run(
+                    self.zsign_path,
+                    item.job,
+                    on_output=lambda line: self._emit(item, line),
+                    on_start=on_start,
+                    cache=self.cache,
+                    workspace=self.workspace,
+                    metrics=self.metrics,
+                    background=True,
+                    scratch=self.scratch
+                )
+        finally:
+            with self._lock:
+                self._processes.difference_update(started)
+        return result
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from .digest import file_digest, path_digest
+from .paths import cache_dir
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+# Bump when the key layout changes so old entries are never reused
+KEY_VERSION = 2
+
+
+def job_key(zsign_path, job):
+    """Hash every input and option that affects what zsign writes.
+
+    The password only decides whether signing works, not what it produces,
+    and the output path and install flag don't change the signed bytes, so
+    those are left out."""
+    parts = {
+        "version": KEY_VERSION,
+        "zsign": file_digest(zsign_path),
+        "input": path_digest(job.input_path),
+        "pkey": "" if job.adhoc else path_digest(job.pkey),
+        "prov": "" if job.adhoc else path_digest(job.prov),
+        "cert": path_digest(job.cert),
+        "entitlements": path_digest(job.entitlements),
+        "dylib": path_digest(job.dylib),
+        "slim": path_digest(job.slim),
+        "options": {
+            "adhoc": job.adhoc,
+            "bundle_id": job.bundle_id,
+            "bundle_name": job.bundle_name,
+            "bundle_version": job.bundle_version,
+            "weak": job.weak,
+            "force": job.force,
+            "sha256_only": job.sha256_only,
+            "zip_level": job.zip_level,
+            "parallel_zip": job.parallel_zip,
+        },
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def is_cacheable(job):
+    """Only jobs that write an output file and have no side effects"""
+    return bool(job.output_path) and not job.install
+
+
+def release_output(path):
+    """Remove path if it is hardlinked to a cache entry, so zsign writing over
+    it can't change what the cache holds"""
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+def place_file(source, dest):
+    """Hardlink source to dest, copying instead when that isn't possible"""
+    if os.path.exists(dest) and os.path.samefile(source, dest):
+        return
+    tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, dest)
+
+
+class SignedCache:
+    """On-disk cache of signed IPAs keyed by job_key, evicted least
+    recently used first once it grows past max_bytes"""
+
+    def __init__(self, root=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root or cache_dir("signed")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _entry(self, key):
+        return os.path.join(self.root, f"{key}.ipa")
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _touch(self, key):
+        """The cached IPA for key, marked recently used, or None"""
+        path = self._entry(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def lookup(self, key):
+        """Return the cached IPA for key (marking it recently used), or None"""
+        path = self._touch(key)
+        self._count(path is not None)
+        return path
+
+    def fetch(self, key, output_path):
+        """Place the cached IPA for key at output_path; returns False on a
+        miss, which includes an entry that couldn't be placed"""
+        path = self._touch(key)
+        placed = False
+        if path:
+            try:
+                place_file(path, output_path)
+                placed = True
+            except OSError:
+                pass
+        self._count(placed)
+        return placed
+
+    def store(self, key, output_path):
+        """Add a freshly signed IPA to the cache, then evict to stay under max_bytes"""
+        if os.path.getsize(output_path) > self.max_bytes:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        place_file(output_path, self._entry(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".ipa"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return f"cache {self.hits} hits, {self.misses} misses"
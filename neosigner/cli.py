@@ -0,0 +1,739 @@
+import argparse
+import os
+import signal
+import sys
+import time
+
+from . import devices, engine, tools
+from .cache import DEFAULT_MAX_BYTES, SignedCache
+from .engine import SignError, SignJob
+from .metrics import MetricsWriter
+from .ipainfo import bundle_id_of, read_app_info
+from .journal import Journal
+from .profiles import LIBRARY_ENV, ProfileLibrary
+from .scheduler import Scheduler
+from .scratch import SCRATCH_ENV, default_policy
+from .verify import can_verify, verify_ipa, verify_job, verify_pool
+from .workspace import DEFAULT_QUOTA_BYTES, Workspace
+
+# Environment variable read when -p isn't given, to keep passwords out of argv
+PASSWORD_ENV = "NEOSIGNER_P12_PASSWORD"
+
+
+def add_signing_options(parser):
+    """Options shared by every command that signs an app"""
+    parser.add_argument("-k", "--pkey", default="", help="certificate file (.p12) or private key")
+    parser.add_argument("-m", "--prov", default="", help="provisioning profile")
+    parser.add_argument("--profiles", default=os.environ.get(LIBRARY_ENV, ""), metavar="DIR",
+                        help=f"pick the profile and certificate not given with -m/-k from this folder "
+                             f"(defaults to ${LIBRARY_ENV})")
+    parser.add_argument("-a", "--adhoc", action="store_true", help="ad-hoc signature, no certificate needed")
+    parser.add_argument("-c", "--cert", default="", help="additional certificate file")
+    parser.add_argument("-b", "--bundle-id", default="", help="override bundle ID")
+    parser.add_argument("-n", "--bundle-name", default="", help="override app name")
+    parser.add_argument("-r", "--bundle-version", default="", help="override app version")
+    parser.add_argument("-e", "--entitlements", default="", help="entitlements file")
+    parser.add_argument("-l", "--dylib", default="", help="dylib to inject")
+    parser.add_argument("-w", "--weak", action="store_true", help="inject dylib as weak")
+    parser.add_argument("-f", "--force", action="store_true", help="force sign without cache")
+    parser.add_argument("-2", "--sha256-only", action="store_true", help="SHA256 only")
+    parser.add_argument("-z", "--zip-level", type=int, default=9, choices=range(10), metavar="0-9",
+                        help="zip compression level (default 9)")
+    parser.add_argument("--parallel-zip", action="store_true",
+                        help="zip the signed app on every core instead of inside zsign")
+    parser.add_argument("--slim", default="", metavar="RULES",
+                        help="JSON file of slimming rules: what to leave out of the app before signing")
+    add_runner_options(parser)
+
+
+def add_runner_options(parser):
+    """Options for how jobs run rather than what they sign"""
+    parser.add_argument("-p", "--password", default=None,
+                        help=f"certificate password (defaults to ${PASSWORD_ENV})")
+    parser.add_argument("--zsign", default=None, help="path to the zsign binary")
+    parser.add_argument("--no-cache", action="store_true", help="always run zsign, even for a job signed before")
+    parser.add_argument("--cache-size", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3, metavar="GB",
+                        help="size limit of the signed app cache (default %(default).0f GB)")
+    parser.add_argument("--workspace", action="store_true",
+                        help="keep extracted copies of input IPAs so re-signing them skips the unzip")
+    parser.add_argument("--workspace-size", type=float, default=DEFAULT_QUOTA_BYTES / 1024 ** 3, metavar="GB",
+                        help="size limit of the extracted app workspace (default %(default).0f GB)")
+    parser.add_argument("--metrics", default=None, metavar="FILE",
+                        help="append per-job timings to this JSON lines file (default: metrics.jsonl in the log folder)")
+    parser.add_argument("--no-metrics", action="store_true", help="don't record per-job timings")
+    parser.add_argument("--prometheus", default=None, metavar="FILE",
+                        help="also keep totals in this Prometheus textfile")
+    parser.add_argument("--scratch", default=None, metavar="DIR",
+                        help=f"unpack apps in this fast folder, e.g. a tmpfs, when they fit "
+                             f"(defaults to ${SCRATCH_ENV})")
+    parser.add_argument("--scratch-budget", type=float, default=None, metavar="GB",
+                        help="most the scratch folder holds at once (default: half its size)")
+    parser.add_argument("--no-scheduler", action="store_true",
+                        help="start jobs without waiting for free cores, disk space and memory")
+    parser.add_argument("--no-journal", action="store_true",
+                        help="don't record jobs in the journal, and redo jobs it says are done")
+    parser.add_argument("--no-verify", action="store_true",
+                        help="don't check signed IPAs' CRCs, code signatures, bundle ID and profile")
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't print zsign output")
+
+
+def job_from_args(args, input_path="", output_path=""):
+    password = args.password if args.password is not None else os.environ.get(PASSWORD_ENV, "")
+    return SignJob(
+        input_path=input_path,
+        output_path=output_path,
+        pkey=args.pkey,
+        prov=args.prov,
+        password=password,
+        adhoc=args.adhoc,
+        cert=args.cert,
+        bundle_id=args.bundle_id,
+        bundle_name=args.bundle_name,
+        bundle_version=args.bundle_version,
+        entitlements=args.entitlements,
+        dylib=args.dylib,
+        weak=args.weak,
+        force=args.force,
+        sha256_only=args.sha256_only,
+        zip_level=args.zip_level,
+        parallel_zip=args.parallel_zip,
+        slim=args.slim
+    )
+
+
+def signed_cache(args):
+    if args.no_cache:
+        return None
+    return SignedCache(max_bytes=int(args.cache_size * 1024 ** 3))
+
+
+def workspace(args):
+    if not args.workspace:
+        return None
+    return Workspace(quota_bytes=int(args.workspace_size * 1024 ** 3))
+
+
+def metrics_writer(args):
+    if args.no_metrics:
+        return None
+    return MetricsWriter(args.metrics, textfile=args.prometheus)
+
+
+def scratch_policy(args):
+    return default_policy(args.scratch, args.scratch_budget)
+
+
+def job_scheduler(args):
+    if args.no_scheduler:
+        return None
+    return Scheduler(max_jobs=args.jobs)
+
+
+def job_journal(args):
+    if args.no_journal:
+        return None
+    return Journal()
+
+
+def profile_library(args):
+    if not args.profiles or args.adhoc:
+        return None
+    password = args.password if args.password is not None else os.environ.get(PASSWORD_ENV, "")
+    return ProfileLibrary(args.profiles, password=password).scan()
+
+
+def pick_profile(library, job, quiet=False, prefix=""):
+    match = library.apply(job) if library else None
+    if match and not quiet:
+        print(f"{prefix}Using {match}", flush=True)
+
+
+def resolve_zsign(args):
+    zsign_path = args.zsign or tools.find_zsign_binary()
+    if not zsign_path:
+        raise SignError("zsign binary not found. Pass --zsign or run ./setup.sh")
+    return zsign_path
+
+
+def printer(args, prefix=""):
+    if args.quiet:
+        return None
+    return lambda line: print(f"{prefix}{line}", flush=True)
+
+
+def cmd_sign(args):
+    zsign_path = resolve_zsign(args)
+    job = job_from_args(args, args.input, args.output)
+    job.install = args.install
+    pick_profile(profile_library(args), job, args.quiet)
+
+    cache = signed_cache(args)
+    result = engine.run(zsign_path, job, on_output=printer(args), cache=cache,
+                        workspace=workspace(args), metrics=metrics_writer(args), scratch=scratch_policy(args))
+    if not args.quiet:
+        print(result.record.summary())
+    if not result.ok:
+        print(f"Signature failed with return code {result.returncode}", file=sys.stderr)
+        return result.returncode
+
+    message = f"Signature {'reused from cache' if result.cached else 'completed'} in {result.elapsed:.1f}s"
+    if result.output_size:
+        message += f": {job.output_path} ({result.output_size / (1024 * 1024):.2f} MB)"
+    print(message)
+    if not args.no_verify and can_verify(job):
+        verification = verify_job(job).result()
+        print(verification, file=sys.stdout if verification.ok else sys.stderr)
+        if not verification.ok:
+            return 1
+    return 0
+
+
+def cmd_batch(args):
+    from . import batch
+
+    zsign_path = resolve_zsign(args)
+    items = []
+    for path in args.inputs:
+        if path.lower().endswith(".csv"):
+            items.extend(batch.load_manifest(path))
+        else:
+            items.append(batch.BatchItem(path))
+    if not items:
+        raise SignError("No jobs to run.")
+
+    batch.prepare_jobs(items, job_from_args(args), args.output_dir)
+    pick_profiles(args, items)
+    return run_batch(args, zsign_path, items, workspace(args))
+
+
+def cmd_fanout(args):
+    from . import fanout
+
+    zsign_path = resolve_zsign(args)
+    variants = []
+    for path in args.variants:
+        variants.extend(fanout.load_variants(path))
+    items = fanout.prepare_variants(args.input, variants, job_from_args(args), args.output_dir)
+    pick_profiles(args, items)
+    # The workspace is what makes this one extraction rather than one per variant
+    extracted = Workspace(quota_bytes=int(args.workspace_size * 1024 ** 3))
+    return run_batch(args, zsign_path, items, extracted)
+
+
+def cmd_resume(args):
+    from . import batch
+
+    zsign_path = resolve_zsign(args)
+    journal = Journal()
+    entries = journal.interrupted()
+    if not entries:
+        print("No interrupted jobs in the journal.")
+        return 0
+    password = args.password if args.password is not None else os.environ.get(PASSWORD_ENV, "")
+    items = []
+    for entry in entries:
+        job = entry.sign_job(password)
+        items.append(batch.BatchItem(job.input_path, job=job, resumed_job=job, resumes=entry.id))
+    if args.no_journal:
+        # The batch won't record them, so they'd be resumed again next time
+        journal.requeued(entry.id for entry in entries)
+    print(f"Resuming {len(items)} interrupted jobs")
+    return run_batch(args, zsign_path, items, workspace(args))
+
+
+def pick_profiles(args, items):
+    library = profile_library(args)
+    for item in items:
+        pick_profile(library, item.job, args.quiet, prefix=f"[{item.name}] ")
+
+
+def run_batch(args, zsign_path, items, extracted=None):
+    """Run prepared BatchItems and print a summary"""
+    from . import batch
+
+    cache = signed_cache(args)
+    scheduler = job_scheduler(args)
+    emit = printer(args)
+    runner = batch.BatchRunner(
+        zsign_path,
+        items,
+        max_workers=args.jobs,
+        retries=args.retries,
+        on_update=lambda item: print(f"[{item.name}] {item.status}", flush=True),
+        on_output=(lambda item, line: emit(f"[{item.name}] {line}")) if emit else None,
+        cache=cache,
+        workspace=extracted,
+        metrics=metrics_writer(args),
+        journal=job_journal(args),
+        scheduler=scheduler,
+        scratch=scratch_policy(args),
+        verify=not args.no_verify
+    )
+    try:
+        summary = runner.run()
+    except KeyboardInterrupt:
+        runner.cancel()
+        raise
+
+    for item in items:
+        if item.status == batch.FAILED:
+            print(f"Failed: {item.name} ({item.error})", file=sys.stderr)
+    print(summary)
+    if cache:
+        print(f"Signed app {cache.stats()}")
+    if extracted:
+        print(f"Extracted app {extracted.stats()}")
+    if scheduler and scheduler.waited:
+        print(f"Job {scheduler.stats()}")
+    return 0 if summary.failed == 0 and summary.cancelled == 0 else 1
+
+
+def cmd_journal(args):
+    journal = Journal()
+    if args.interrupted:
+        entries = journal.interrupted()
+    elif args.last:
+        entry = journal.last_success(args.last)
+        entries = [entry] if entry else []
+    else:
+        entries = journal.history(args.limit, args.bundle_id, args.status)
+    if not entries:
+        print("No matching jobs in the journal.")
+        return 1
+    for entry in entries:
+        print(entry)
+    return 0
+
+
+def cmd_verify(args):
+    pool = verify_pool()
+    futures = [pool.submit(verify_ipa, path, args.bundle_id, args.prov, os.path.basename(args.dylib))
+               for path in args.inputs]
+    status = 0
+    for path, future in zip(args.inputs, futures):
+        verification = future.result()
+        if verification.ok:
+            print(verification)
+        else:
+            status = 1
+            print(f"{path}: failed verification", file=sys.stderr)
+            for problem in verification.problems:
+                print(f"  {problem}", file=sys.stderr)
+    return status
+
+
+def cmd_info(args):
+    status = 0
+    for path in args.inputs:
+        app_info = read_app_info(path)
+        if app_info.error:
+            print(f"{path}: {app_info.error}", file=sys.stderr)
+            status = 1
+        else:
+            print(f"{path}: {app_info}")
+    return status
+
+
+def cmd_profiles(args):
+    password = args.password if args.password is not None else os.environ.get(PASSWORD_ENV, "")
+    library = ProfileLibrary(args.directory, password=password).scan()
+    if args.match:
+        bundle_id = bundle_id_of(args.match) if os.path.exists(args.match) else args.match
+        if not bundle_id:
+            raise SignError(f"Can't read the bundle ID of {args.match}")
+        found = library.matches(bundle_id)
+        for match in found:
+            print(f"{match.profile.path}\t{match.certificate.path if match.certificate else '-'}\t{match}")
+        if not found:
+            print(f"No unexpired provisioning profile for {bundle_id}", file=sys.stderr)
+            return 1
+        return 0
+
+    for profile in sorted(library.profiles, key=lambda profile: profile.path):
+        print(f"{profile.path}\t{profile.error or profile}")
+    for certificate in sorted(library.certificates, key=lambda certificate: certificate.path):
+        print(f"{certificate.path}\t{certificate.error or certificate.name}")
+    print(f"{len(library.profiles)} profiles, {len(library.certificates)} certificates "
+          f"({library.parsed} read, the rest from cache)")
+    return 0
+
+
+def load_presets(args):
+    from . import presets
+
+    path = args.presets or presets.default_presets_path()
+    if args.presets or os.path.exists(path):
+        return presets.load_presets(path)
+    return {}
+
+
+def cmd_watch(args):
+    from . import watch
+
+    zsign_path = resolve_zsign(args)
+    watcher = watch.Watcher(
+        zsign_path,
+        args.inbox,
+        args.outbox,
+        args.failed or os.path.join(os.path.dirname(os.path.abspath(args.outbox)), "failed"),
+        job_from_args(args),
+        presets=load_presets(args),
+        default_preset=args.preset,
+        max_workers=args.jobs,
+        settle_seconds=args.settle,
+        cache=signed_cache(args),
+        workspace=workspace(args),
+        metrics=metrics_writer(args),
+        on_event=lambda message: print(f"{time.strftime('%H:%M:%S')} {message}", flush=True),
+        use_inotify=not args.poll,
+        scheduler=job_scheduler(args),
+        scratch=scratch_policy(args),
+        verify=not args.no_verify
+    )
+    # Let running jobs finish on SIGTERM as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+    return 0 if watcher.failed == 0 else 1
+
+
+def cmd_serve(args):
+    import asyncio
+
+    from .presets import Presets
+    from .service import TOKEN_ENV, SigningService
+
+    token = args.token if args.token is not None else os.environ.get(TOKEN_ENV, "")
+    if not token and args.host not in ("127.0.0.1", "localhost", "::1"):
+        print(f"Warning: listening on {args.host} without a token (--token or ${TOKEN_ENV})", file=sys.stderr)
+    service = SigningService(
+        resolve_zsign(args),
+        Presets(load_presets(args), job_from_args(args)),
+        max_concurrent=args.jobs,
+        allowed_roots=args.allow_path,
+        token=token,
+        max_upload=int(args.max_upload * 1024 ** 3),
+        default_preset=args.preset,
+        cache=signed_cache(args),
+        workspace=workspace(args),
+        metrics=metrics_writer(args),
+        on_event=lambda message: print(f"{time.strftime('%H:%M:%S')} {message}", flush=True),
+        scheduler=job_scheduler(args),
+        scratch=scratch_policy(args),
+        verify=not args.no_verify
+    )
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def cmd_coordinate(args):
+    from . import batch, distributed
+
+    items = []
+    for path in args.inputs:
+        if path.lower().endswith(".csv"):
+            items.extend(batch.load_manifest(path))
+        else:
+            items.append(batch.BatchItem(path))
+    if not items:
+        raise SignError("No jobs to run.")
+    batch.prepare_jobs(items, job_from_args(args), args.output_dir)
+    pick_profiles(args, items)
+
+    host, port = distributed.parse_address(args.listen)
+    token = args.token if args.token is not None else os.environ.get(distributed.TOKEN_ENV, "")
+    if not token and host not in ("127.0.0.1", "localhost", "::1"):
+        print(f"Warning: listening on {host} without a token (--token or ${distributed.TOKEN_ENV})", file=sys.stderr)
+    local = []
+    emit = printer(args)
+    coordinator = distributed.Coordinator(
+        items,
+        host=host,
+        port=port,
+        token=token,
+        retries=args.retries,
+        on_update=lambda item: print(f"[{item.name}] {item.status}", flush=True),
+        on_output=(lambda item, line: emit(f"[{item.name}] {line}")) if emit else None,
+        on_event=lambda message: print(f"{time.strftime('%H:%M:%S')} {message}", flush=True),
+        on_ready=lambda address: local.extend(
+            distributed.start_local_workers(address, args.local_workers, local_worker_args(args), token))
+    )
+    try:
+        summary = coordinator.run()
+    finally:
+        distributed.stop_local_workers(local)
+
+    for item in items:
+        if item.status == batch.FAILED:
+            print(f"Failed: {item.name} ({item.error})", file=sys.stderr)
+    print(summary)
+    return 0 if summary.failed == 0 and summary.cancelled == 0 else 1
+
+
+def local_worker_args(args):
+    """Arguments for workers started with --local-workers, from the coordinator's own"""
+    worker_args = ["-j", str(args.worker_jobs)] if args.worker_jobs else []
+    if args.zsign:
+        worker_args += ["--zsign", args.zsign]
+    for flag in ("no_cache", "workspace", "no_metrics", "no_scheduler", "no_verify"):
+        if getattr(args, flag):
+            worker_args.append("--" + flag.replace("_", "-"))
+    if args.scratch:
+        worker_args += ["--scratch", args.scratch]
+    return worker_args
+
+
+def cmd_worker(args):
+    from . import distributed
+
+    host, port = distributed.parse_address(args.coordinator)
+    token = args.token if args.token is not None else os.environ.get(distributed.TOKEN_ENV, "")
+    worker = distributed.Worker(
+        resolve_zsign(args),
+        host,
+        port,
+        name=args.name,
+        max_jobs=args.jobs,
+        token=token,
+        cache=signed_cache(args),
+        workspace=workspace(args),
+        metrics=metrics_writer(args),
+        scheduler=job_scheduler(args),
+        scratch=scratch_policy(args),
+        verify=not args.no_verify,
+        once=args.once,
+        on_event=lambda message: print(f"{time.strftime('%H:%M:%S')} {worker.name}: {message}", flush=True)
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(143))
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def find_devices(args):
+    idevice_id_path = args.idevice_id or tools.find_idevice_tool("idevice_id")
+    if not idevice_id_path:
+        raise SignError("idevice_id not found. Please install libimobiledevice first.")
+    return devices.list_devices(idevice_id_path, tools.find_idevice_tool("ideviceinfo"))
+
+
+def cmd_devices(args):
+    found = find_devices(args)
+    for device in found:
+        print(f"{device.udid}\t{device.name}\t{device.model}\t{device.ios_version}")
+    if not found:
+        print("No devices connected", file=sys.stderr)
+        return 1
+    return 0
+
+
+def cmd_install(args):
+    ideviceinstaller_path = args.ideviceinstaller or tools.find_ideviceinstaller()
+    if not ideviceinstaller_path:
+        raise SignError("ideviceinstaller not found. Please install it first.")
+    if args.udid or args.all:
+        return install_on_devices(args, ideviceinstaller_path)
+    engine.check_device(ideviceinstaller_path, args.idevice_id or tools.find_idevice_tool("idevice_id"))
+
+    return_code = engine.install(ideviceinstaller_path, args.ipa, on_output=print)
+    if return_code == 0:
+        print("App installed successfully!")
+    else:
+        print(f"Installation failed with code {return_code}", file=sys.stderr)
+    return return_code
+
+
+def install_on_devices(args, ideviceinstaller_path):
+    if args.all:
+        targets = find_devices(args)
+        if not targets:
+            raise SignError("No iOS device found. Please connect your device.")
+    else:
+        targets = [devices.Device(udid) for udid in args.udid]
+
+    shown = {}
+
+    def on_update(install):
+        progress = f" {install.progress}%" if install.status == devices.RUNNING and install.progress else ""
+        line = f"{install.status}{progress}"
+        if shown.get(install.device.udid) != line:
+            shown[install.device.udid] = line
+            print(f"[{install.device.udid}] {line}", flush=True)
+
+    installer = devices.MultiInstaller(
+        ideviceinstaller_path,
+        args.ipa,
+        targets,
+        max_parallel=args.jobs,
+        on_update=on_update,
+        on_output=None if args.quiet else lambda install, line: print(f"[{install.device.udid}] {line}", flush=True)
+    )
+    try:
+        summary = installer.run()
+    except KeyboardInterrupt:
+        installer.cancel()
+        raise
+
+    for install in installer.installs:
+        if install.status == devices.FAILED:
+            print(f"Failed: {install.device} ({install.error})", file=sys.stderr)
+    print(summary)
+    return 0 if summary.succeeded == summary.total else 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m neosigner",
+                                     description="Sign and install iOS apps with zsign, without the GUI.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sign = commands.add_parser("sign", help="sign one app")
+    sign.add_argument("input", help="unsigned .ipa file or app folder")
+    sign.add_argument("-o", "--output", default="", help="signed .ipa to write")
+    sign.add_argument("-i", "--install", action="store_true", help="install after signing (zsign -i)")
+    add_signing_options(sign)
+    sign.set_defaults(func=cmd_sign)
+
+    batch = commands.add_parser("batch", help="sign many apps concurrently")
+    batch.add_argument("inputs", nargs="+", help=".ipa files and/or CSV manifests")
+    batch.add_argument("-d", "--output-dir", default="", help="folder for outputs not set in a manifest")
+    batch.add_argument("-j", "--jobs", type=int, default=None, help="concurrent zsign processes")
+    batch.add_argument("--retries", type=int, default=1, help="retries for a failed job (default 1)")
+    add_signing_options(batch)
+    batch.set_defaults(func=cmd_batch)
+
+    fanout = commands.add_parser("fanout", help="sign many variants of one app from a single extraction")
+    fanout.add_argument("input", help="unsigned .ipa file")
+    fanout.add_argument("variants", nargs="+",
+                        help="CSV files with a 'variant' column and bundle_id, bundle_name, profile, "
+                             "certificate, dylib and output columns")
+    fanout.add_argument("-d", "--output-dir", default="", help="folder for outputs not set in a CSV file")
+    fanout.add_argument("-j", "--jobs", type=int, default=None, help="concurrent zsign processes")
+    fanout.add_argument("--retries", type=int, default=1, help="retries for a failed variant (default 1)")
+    add_signing_options(fanout)
+    fanout.set_defaults(func=cmd_fanout)
+
+    resume = commands.add_parser("resume", help="sign again the jobs a crashed or killed run left unfinished")
+    resume.add_argument("-j", "--jobs", type=int, default=None, help="concurrent zsign processes")
+    resume.add_argument("--retries", type=int, default=1, help="retries for a failed job (default 1)")
+    add_runner_options(resume)
+    resume.set_defaults(func=cmd_resume)
+
+    journal = commands.add_parser("journal", help="show signing history")
+    journal.add_argument("-b", "--bundle-id", default="", help="only jobs for this bundle ID")
+    journal.add_argument("--status", default="", help="only jobs with this status, e.g. failed")
+    journal.add_argument("-n", "--limit", type=int, default=20, help="how many jobs to show (default 20)")
+    journal.add_argument("--last", default="", metavar="BUNDLE_ID",
+                         help="just the last successful signing of a bundle ID")
+    journal.add_argument("--interrupted", action="store_true", help="jobs left unfinished by a crash")
+    journal.set_defaults(func=cmd_journal)
+
+    install = commands.add_parser("install", help="install a signed app to connected devices")
+    install.add_argument("ipa", help="signed .ipa file")
+    install.add_argument("-u", "--udid", action="append", default=[],
+                         help="install on this device; repeat for several devices")
+    install.add_argument("--all", action="store_true", help="install on every connected device")
+    install.add_argument("-j", "--jobs", type=int, default=devices.DEFAULT_MAX_PARALLEL,
+                         help="devices to install on at once (default %(default)s)")
+    install.add_argument("-q", "--quiet", action="store_true", help="only print each device's status")
+    install.add_argument("--ideviceinstaller", default=None, help="path to ideviceinstaller")
+    install.add_argument("--idevice-id", default=None, help="path to idevice_id")
+    install.set_defaults(func=cmd_install)
+
+    watch = commands.add_parser("watch", help="sign every IPA dropped into a folder")
+    watch.add_argument("inbox", help="folder to watch; IPAs in a subfolder named after a preset use that preset")
+    watch.add_argument("outbox", help="folder for signed apps")
+    watch.add_argument("--failed", default="", metavar="DIR",
+                       help="folder for inputs that failed and their logs (default: 'failed' next to the outbox)")
+    watch.add_argument("--presets", default="", metavar="FILE",
+                       help="JSON file of named signing presets (default: presets.json in the data folder)")
+    watch.add_argument("--preset", default="", help="preset for IPAs directly in the inbox")
+    watch.add_argument("-j", "--jobs", type=int, default=2, help="concurrent zsign processes (default 2)")
+    watch.add_argument("--settle", type=float, default=2.0, metavar="SECONDS",
+                       help="how long a file must stay unchanged before it is signed (default 2)")
+    watch.add_argument("--poll", action="store_true", help="list the inbox every second instead of using inotify")
+    add_signing_options(watch)
+    watch.set_defaults(func=cmd_watch)
+
+    serve = commands.add_parser("serve", help="sign apps for other machines over HTTP")
+    serve.add_argument("--host", default="127.0.0.1", help="address to listen on (default %(default)s)")
+    serve.add_argument("--port", type=int, default=8788, help="port to listen on (default %(default)s)")
+    serve.add_argument("-j", "--jobs", type=int, default=2, help="concurrent zsign processes (default 2)")
+    serve.add_argument("--presets", default="", metavar="FILE",
+                       help="JSON file of named signing presets (default: presets.json in the data folder)")
+    serve.add_argument("--preset", default="", help="preset for jobs that don't name one")
+    serve.add_argument("--allow-path", action="append", default=[], metavar="DIR",
+                       help="let clients sign IPAs under this folder by path; repeat for several")
+    serve.add_argument("--token", default=None, help="require this bearer token (defaults to $NEOSIGNER_SERVICE_TOKEN)")
+    serve.add_argument("--max-upload", type=float, default=8, metavar="GB", help="largest upload (default 8 GB)")
+    add_signing_options(serve)
+    serve.set_defaults(func=cmd_serve)
+
+    coordinate = commands.add_parser("coordinate", help="sign a batch on worker machines that connect over TCP")
+    coordinate.add_argument("inputs", nargs="+", help=".ipa files and/or CSV manifests")
+    coordinate.add_argument("-d", "--output-dir", default="", help="folder for outputs not set in a manifest")
+    coordinate.add_argument("--listen", default="127.0.0.1:8790", metavar="HOST:PORT",
+                            help="address workers connect to (default %(default)s)")
+    coordinate.add_argument("--token", default=None,
+                            help="require this token from workers (defaults to $NEOSIGNER_CLUSTER_TOKEN)")
+    coordinate.add_argument("--retries", type=int, default=1, help="retries for a failed job (default 1)")
+    coordinate.add_argument("--local-workers", type=int, default=0, metavar="N",
+                            help="also start N workers on this machine")
+    coordinate.add_argument("--worker-jobs", type=int, default=None, metavar="N",
+                            help="concurrent zsign processes per local worker (default: one per core)")
+    add_signing_options(coordinate)
+    coordinate.set_defaults(func=cmd_coordinate)
+
+    worker = commands.add_parser("worker", help="sign jobs for a coordinator")
+    worker.add_argument("coordinator", help="the coordinator's HOST:PORT")
+    worker.add_argument("--name", default="",
+                        help="name to join as (default: the host name); keep it to resume transfers after a restart")
+    worker.add_argument("-j", "--jobs", type=int, default=None, help="concurrent zsign processes (default: one per core)")
+    worker.add_argument("--token", default=None,
+                        help="token the coordinator requires (defaults to $NEOSIGNER_CLUSTER_TOKEN)")
+    worker.add_argument("--once", action="store_true", help="exit when the coordinator's batch is done")
+    add_runner_options(worker)
+    worker.set_defaults(func=cmd_worker)
+
+    verify = commands.add_parser("verify", help="check that signed IPAs are intact and fully signed")
+    verify.add_argument("inputs", nargs="+", help="signed .ipa files")
+    verify.add_argument("-b", "--bundle-id", default="", help="bundle ID the app must have")
+    verify.add_argument("-m", "--prov", default="", help="provisioning profile the app must embed")
+    verify.add_argument("-l", "--dylib", default="", help="name of a dylib that must have been injected")
+    verify.set_defaults(func=cmd_verify)
+
+    info = commands.add_parser("info", help="show what an IPA contains without unzipping it")
+    info.add_argument("inputs", nargs="+", help=".ipa files or app folders")
+    info.set_defaults(func=cmd_info)
+
+    profiles = commands.add_parser("profiles", help="list a folder of profiles and certificates, or match one")
+    profiles.add_argument("directory", nargs="?", default=os.environ.get(LIBRARY_ENV) or ".",
+                          help=f"folder to scan (defaults to ${LIBRARY_ENV})")
+    profiles.add_argument("--match", default="", metavar="BUNDLE_ID_OR_IPA",
+                          help="list the profiles that fit this bundle ID or app, best first")
+    profiles.add_argument("-p", "--password", default=None,
+                          help=f"certificate password (defaults to ${PASSWORD_ENV})")
+    profiles.set_defaults(func=cmd_profiles)
+
+    list_devices = commands.add_parser("devices", help="list connected devices")
+    list_devices.add_argument("--idevice-id", default=None, help="path to idevice_id")
+    list_devices.set_defaults(func=cmd_devices)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except (SignError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        return 130
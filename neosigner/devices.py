@@ -0,0 +1,230 @@
+import os
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from .batch import CANCELLED, FAILED, PENDING, RUNNING, SUCCEEDED
+from .engine import SignError
+
+# More parallel installs than this tends to saturate a shared USB hub, after
+# which every install slows down instead of finishing sooner
+DEFAULT_MAX_PARALLEL = 4
+
+# ideviceinfo keys shown for each device
+INFO_KEYS = ("DeviceName", "ProductType", "ProductVersion")
+
+# ideviceinstaller reports progress as e.g. "Install: CopyingApplication (40%)"
+PROGRESS_PATTERN = re.compile(r"\((\d+)%\)")
+STEP_PATTERN = re.compile(r"^(?:Install|Copying)\b[:\s]*(\w+)?")
+
+
+@dataclass
+class Device:
+    udid: str
+    name: str = ""
+    model: str = ""
+    ios_version: str = ""
+
+    def __str__(self):
+        return f"{self.name or 'iOS device'} ({self.udid})"
+
+
+@dataclass
+class DeviceInstall:
+    """One device's part of a multi-device install"""
+    device: Device
+    status: str = PENDING
+    progress: int = 0
+    step: str = ""
+    returncode: int = None
+    elapsed: float = 0.0
+    error: str = ""
+
+
+@dataclass
+class InstallSummary:
+    total: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    cancelled: int = 0
+    elapsed: float = 0.0
+
+    def __str__(self):
+        return (f"Installed on {self.succeeded} of {self.total} devices in {self.elapsed:.1f}s "
+                f"({self.failed} failed, {self.cancelled} cancelled)")
+
+
+def list_udids(idevice_id_path):
+    """UDIDs of the devices connected over USB"""
+    try:
+        result = subprocess.run([idevice_id_path, "-l"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                text=True,
+                                timeout=10)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise SignError(f"Error listing devices: {str(e)}")
+    if result.returncode != 0:
+        raise SignError(f"Error listing devices: {result.stderr.strip() or result.returncode}")
+    udids = []
+    for line in result.stdout.splitlines():
+        udid = line.split()[0] if line.strip() else ""
+        if udid and udid not in udids:
+            udids.append(udid)
+    return udids
+
+
+def device_info(ideviceinfo_path, udid):
+    """Name, model and iOS version of a device; blank fields if it won't say"""
+    device = Device(udid)
+    if not ideviceinfo_path:
+        return device
+    try:
+        result = subprocess.run([ideviceinfo_path, "-u", udid],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                text=True,
+                                timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return device
+    values = {}
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition(":")
+        if key in INFO_KEYS:
+            values[key] = value.strip()
+    device.name = values.get("DeviceName", "")
+    device.model = values.get("ProductType", "")
+    device.ios_version = values.get("ProductVersion", "")
+    return device
+
+
+def describe(udids, ideviceinfo_path=None):
+    """Devices for the given UDIDs, with the ideviceinfo queries run in parallel"""
+    if not udids:
+        return []
+    with ThreadPoolExecutor(max_workers=min(8, len(udids))) as pool:
+        return list(pool.map(lambda udid: device_info(ideviceinfo_path, udid), udids))
+
+
+def list_devices(idevice_id_path, ideviceinfo_path=None):
+    """Every connected device"""
+    return describe(list_udids(idevice_id_path), ideviceinfo_path)
+
+
+class MultiInstaller:
+    """Install one IPA on several devices at once, at most max_parallel at a time.
+
+    on_update(install) is called whenever a device's status or progress
+    changes and on_output(install, line) for each line ideviceinstaller
+    prints; both run on worker threads."""
+
+    def __init__(self, ideviceinstaller_path, ipa_path, devices, max_parallel=DEFAULT_MAX_PARALLEL,
+                 on_update=None, on_output=None):
+        if not ideviceinstaller_path:
+            raise SignError("ideviceinstaller not found. Please install it first.")
+        if not ipa_path or not os.path.exists(ipa_path):
+            raise SignError(f"Signed app not found: {ipa_path}")
+        if not devices:
+            raise SignError("No devices selected.")
+        self.ideviceinstaller_path = ideviceinstaller_path
+        self.ipa_path = ipa_path
+        self.installs = [DeviceInstall(device) for device in devices]
+        self.max_parallel = max(1, max_parallel)
+        self.on_update = on_update
+        self.on_output = on_output
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._processes = set()
+
+    def cancel(self):
+        """Stop starting new installs and kill the running ones"""
+        self._cancelled.set()
+        with self._lock:
+            for process in list(self._processes):
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+
+    def run(self):
+        """Install on every device and return an InstallSummary; blocks until done"""
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_parallel,
+                                thread_name_prefix="device-install") as pool:
+            for install in self.installs:
+                pool.submit(self._install, install)
+
+        summary = InstallSummary(total=len(self.installs), elapsed=time.monotonic() - start)
+        for install in self.installs:
+            if install.status == SUCCEEDED:
+                summary.succeeded += 1
+            elif install.status == CANCELLED:
+                summary.cancelled += 1
+            else:
+                summary.failed += 1
+        return summary
+
+    def _notify(self, install):
+        if self.on_update:
+            self.on_update(install)
+
+    def _install(self, install):
+        start = time.monotonic()
+        try:
+            if self._cancelled.is_set():
+                install.status = CANCELLED
+                return
+            install.status = RUNNING
+            self._notify(install)
+            install.returncode = self._run_ideviceinstaller(install)
+            if install.returncode == 0:
+                install.status = SUCCEEDED
+                install.progress = 100
+            elif self._cancelled.is_set():
+                install.status = CANCELLED
+            else:
+                install.status = FAILED
+                install.error = install.error or f"ideviceinstaller exited with code {install.returncode}"
+        except Exception as e:
+            install.status = FAILED
+            install.error = str(e)
+        finally:
+            install.elapsed = time.monotonic() - start
+            self._notify(install)
+
+    def _run_ideviceinstaller(self, install):
+        process = subprocess.Popen(
+            [self.ideviceinstaller_path, "-u", install.device.udid, "-i", self.ipa_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1
+        )
+        with self._lock:
+            self._processes.add(process)
+        if self._cancelled.is_set():
+            process.kill()
+        try:
+            for line in process.stdout:
+                line = line.strip()
+                if not line:
+                    continue
+                if self.on_output:
+                    self.on_output(install, line)
+                if line.startswith("ERROR"):
+                    install.error = line
+                progress = PROGRESS_PATTERN.search(line)
+                step = STEP_PATTERN.match(line)
+                if progress or step:
+                    if progress:
+                        install.progress = int(progress.group(1))
+                    if step and step.group(1):
+                        install.step = step.group(1)
+                    self._notify(install)
+            return process.wait()
+        finally:
+            with self._lock:
+                self._processes.discard(process)
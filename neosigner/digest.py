@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import threading
+
+from .paths import cache_dir
+
+CHUNK_SIZE = 1024 * 1024
+
+# Digests are remembered per (path, size, mtime, inode) so an unchanged
+# multi-gigabyte IPA is only read once, even across runs
+MEMO_FILE = "digests.json"
+MEMO_MAX_ENTRIES = 5000
+
+_memo = None
+_memo_lock = threading.Lock()
+
+
+def _stat_key(path, st):
+    return f"{os.path.realpath(path)}|{st.st_size}|{st.st_mtime_ns}|{st.st_ino}"
+
+
+def _load_memo():
+    global _memo
+    if _memo is None:
+        try:
+            with open(cache_dir(MEMO_FILE)) as f:
+                _memo = json.load(f)
+            if not isinstance(_memo, dict):
+                _memo = {}
+        except (OSError, ValueError):
+            _memo = {}
+    return _memo
+
+
+def _save_memo():
+    path = cache_dir(MEMO_FILE)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(_memo, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def hash_file(path):
+    """SHA-256 of a file's contents, without the memo"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_digest(path):
+    """SHA-256 of a file, reusing the stored digest while the file is unchanged"""
+    st = os.stat(path)
+    key = _stat_key(path, st)
+    with _memo_lock:
+        digest = _load_memo().get(key)
+    if digest:
+        return digest
+
+    digest = hash_file(path)
+    with _memo_lock:
+        memo = _load_memo()
+        memo[key] = digest
+        # Drop the oldest entries once the memo gets large; dicts keep insertion order
+        while len(memo) > MEMO_MAX_ENTRIES:
+            del memo[next(iter(memo))]
+        _save_memo()
+    return digest
+
+
+def tree_digest(path):
+    """SHA-256 over every file name, mode and content digest under a folder"""
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            full = os.path.join(dirpath, name)
+            rel = os.path.relpath(full, path).replace(os.sep, "/")
+            if os.path.islink(full):
+                h.update(f"L {rel} {os.readlink(full)}\n".encode())
+                continue
+            # Folders can hold tens of thousands of files, too many for the memo
+            mode = os.stat(full).st_mode & 0o777
+            h.update(f"F {rel} {mode:o} {hash_file(full)}\n".encode())
+    return h.hexdigest()
+
+
+def path_digest(path):
+    """Digest of a file or a folder, or '' for an empty path"""
+    if not path:
+        return ""
+    if os.path.isdir(path):
+        return tree_digest(path)
+    return file_digest(path)
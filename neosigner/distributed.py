@@ -0,0 +1,915 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass, field
+
+from . import engine
+from .batch import CANCELLED, FAILED, PENDING, RETRYING, RUNNING, SUCCEEDED, BatchSummary
+from .engine import SignError
+from .paths import cache_dir
+from .scheduler import available_cores
+from .verify import can_verify, verify_job
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8790
+
+# Read when --token isn't given, to keep the token out of argv
+TOKEN_ENV = "NEOSIGNER_CLUSTER_TOKEN"
+
+# Every message is two lengths, a JSON object and then, for file chunks, raw bytes
+FRAME = struct.Struct(">II")
+MAX_MESSAGE = 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+# Both ends send a heartbeat this often, and take a peer they haven't heard
+# from in DEAD_AFTER seconds for dead
+HEARTBEAT_SECONDS = 2.0
+DEAD_AFTER = 10.0
+RECONNECT_SECONDS = 2.0
+# A worker started with once stops trying to reach a coordinator that has
+# been gone this long, e.g. one that was killed
+GIVE_UP_SECONDS = 60.0
+
+# A job that has lost this many workers fails instead of being sent again,
+# in case the job is what kills them
+MAX_LOST_WORKERS = 3
+
+# SignJob fields naming files on the coordinator, sent to the worker with the IPA
+FILE_FIELDS = ("pkey", "prov", "cert", "entitlements", "dylib", "slim")
+INPUT = "input"
+OUTPUT = "output"
+
+# Job folders a worker left behind, e.g. when it was killed, are removed after a day
+STALE_SECONDS = 24 * 3600
+
+
+class Connection:
+    """One end of the link between the coordinator and a worker. Messages
+    are written whole, one at a time, so file chunks, logs and heartbeats
+    can share it."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self._lock = asyncio.Lock()
+
+    async def send(self, message, payload=b""):
+        if self.closed:
+            raise ConnectionError("Connection closed")
+        body = json.dumps(message).encode()
+        async with self._lock:
+            self.writer.write(FRAME.pack(len(body), len(payload)) + body + payload)
+            await self.writer.drain()
+
+    async def receive(self):
+        """The next (message, payload); raises ConnectionError once the peer
+        has gone or been silent for DEAD_AFTER seconds"""
+        try:
+            return await asyncio.wait_for(self._read(), DEAD_AFTER)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"nothing heard for {DEAD_AFTER:.0f}s")
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("connection closed")
+        except ValueError:
+            raise ConnectionError("peer sent a message that isn't JSON")
+
+    async def _read(self):
+        size, payload_size = FRAME.unpack(await self.reader.readexactly(FRAME.size))
+        if size > MAX_MESSAGE or payload_size > CHUNK_SIZE:
+            raise ConnectionError("peer sent an oversized message")
+        message = json.loads(await self.reader.readexactly(size))
+        if not isinstance(message, dict):
+            raise ValueError("not an object")
+        payload = await self.reader.readexactly(payload_size) if payload_size else b""
+        return message, payload
+
+    async def heartbeat(self):
+        try:
+            while True:
+                await asyncio.sleep(HEARTBEAT_SECONDS)
+                await self.send({"type": "heartbeat"})
+        except (ConnectionError, OSError):
+            pass
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+
+
+def parse_address(text, default_port=DEFAULT_PORT):
+    """(host, port) from "host", "host:port" or ":port" """
+    host, _, port = text.rpartition(":") if ":" in text else (text, "", "")
+    try:
+        return host.strip("[]") or DEFAULT_HOST, int(port) if port else default_port
+    except ValueError:
+        raise SignError(f"Bad address: {text} (expected HOST:PORT)")
+
+
+def append_chunk(path, offset, payload):
+    """Add a received chunk to a .part file and return the file's size. A
+    chunk that doesn't start where the file ends, left over from a transfer
+    that was cut off, is dropped."""
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if offset != size:
+        return size
+    with open(path, "ab") as f:
+        f.write(payload)
+    return size + len(payload)
+
+
+async def send_file(conn, loop, header, path, offset=0):
+    """Stream a file from offset to the peer as chunk messages"""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, CHUNK_SIZE)
+            if not chunk:
+                break
+            await conn.send(dict(header, type="chunk", offset=offset), chunk)
+            offset += len(chunk)
+
+
+def _mb(n):
+    return f"{n / (1024 * 1024):.1f} MB"
+
+
+# Worker
+
+@dataclass
+class WorkerJob:
+    """A job a worker was given, from its files arriving until the
+    coordinator has the signed app"""
+    id: str
+    directory: str
+    options: dict
+    # {field: {"name": ..., "size": ...}} for the IPA and each file it refers to
+    files: dict
+    output_name: str
+    status: str = PENDING
+    # Sent to the coordinator as "done", again after every reconnect until it's collected
+    result: dict = None
+    process: object = field(default=None, repr=False)
+    cancelled: bool = False
+
+    def path(self, name):
+        if name == OUTPUT:
+            return os.path.join(self.directory, OUTPUT, self.output_name)
+        return os.path.join(self.directory, name, self.files[name]["name"])
+
+    def missing(self):
+        """{field: bytes already received} for each file not complete yet"""
+        missing = {}
+        for name, info in self.files.items():
+            path = self.path(name)
+            if os.path.exists(path) and os.path.getsize(path) == info["size"]:
+                continue
+            part = path + ".part"
+            have = os.path.getsize(part) if os.path.exists(part) else 0
+            if have > info["size"]:
+                os.remove(part)
+                have = 0
+            missing[name] = have
+        return missing
+
+    def sign_job(self):
+        paths = {name: self.path(name) for name in self.files if name != INPUT}
+        return engine.SignJob(input_path=self.path(INPUT), output_path=self.path(OUTPUT), **self.options, **paths)
+
+
+class Worker:
+    """Sign jobs a Coordinator hands out, max_jobs at a time.
+
+    The worker connects to the coordinator, says how many jobs it takes and
+    keeps the connection alive with heartbeats, connecting again whenever it
+    drops. A job's IPA and the files it refers to arrive in chunks into a
+    folder of its own under root, so a transfer that was cut off carries on
+    from where it stopped, even after the worker restarts under the same
+    name. Jobs keep running while the coordinator is out of reach, and their
+    signed apps are kept until it has fetched them. With once, the worker
+    exits when the coordinator's batch is done, or once it has been out of
+    reach for GIVE_UP_SECONDS."""
+
+    def __init__(self, zsign_path, host=DEFAULT_HOST, port=DEFAULT_PORT, name="", max_jobs=None, token="",
+                 root=None, cache=None, workspace=None, metrics=None, scheduler=None, scratch=None, verify=False,
+                 once=False, on_event=None):
+        self.zsign_path = zsign_path
+        self.host = host
+        self.port = port
+        self.name = name or socket.gethostname()
+        # Tells a reconnect from a second worker started under the same name
+        self.instance = uuid.uuid4().hex[:12]
+        if scheduler:
+            self.max_jobs = min(max_jobs or scheduler.max_jobs, scheduler.max_jobs)
+        else:
+            self.max_jobs = max(1, max_jobs or available_cores())
+        self.token = token
+        self.root = root or cache_dir("worker", self.name)
+        self.cache = cache
+        self.workspace = workspace
+        self.metrics = metrics
+        self.scheduler = scheduler
+        self.scratch = scratch
+        self.verify = verify
+        self.once = once
+        self.on_event = on_event
+        self.signed = 0
+        self.jobs = {}
+        self._conn = None
+        self._loop = None
+        self._executor = None
+        self._tasks = set()
+        self._signing = set()
+
+    def _event(self, message):
+        if self.on_event:
+            self.on_event(message)
+
+    def run(self):
+        """Serve coordinators until stopped, or until the batch is done with once"""
+        asyncio.run(self._run())
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_jobs, thread_name_prefix="worker")
+        os.makedirs(self.root, exist_ok=True)
+        self._sweep()
+        unreachable = None
+        connected = False
+        try:
+            while True:
+                try:
+                    reader, writer = await asyncio.open_connection(self.host, self.port)
+                except OSError as e:
+                    if unreachable is None:
+                        unreachable = time.monotonic()
+                        self._event(f"Can't reach the coordinator at {self.host}:{self.port} ({e.strerror or e}), "
+                                    f"trying every {RECONNECT_SECONDS:.0f}s")
+                    elif self.once and connected and time.monotonic() - unreachable > GIVE_UP_SECONDS:
+                        self._event(f"Giving up on the coordinator after {GIVE_UP_SECONDS:.0f}s")
+                        return
+                    await asyncio.sleep(RECONNECT_SECONDS)
+                    continue
+                unreachable = None
+                connected = True
+                try:
+                    if await self._session(Connection(reader, writer)) and self.once:
+                        return
+                except ConnectionError as e:
+                    self._event(f"Lost the coordinator: {e}")
+                await asyncio.sleep(RECONNECT_SECONDS)
+        finally:
+            # Job folders stay, so transfers resume if this worker is started again
+            for job in list(self.jobs.values()):
+                if job.process:
+                    job.cancelled = True
+                    job.process.kill()
+            self._executor.shutdown(wait=True)
+            for job in list(self.jobs.values()):
+                if job.cancelled:
+                    self._drop(job)
+
+    def _sweep(self):
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if now - os.stat(path).st_mtime > STALE_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+    async def _session(self, conn):
+        """Talk to one coordinator; True once it says the batch is done"""
+        await conn.send({"type": "hello", "worker": self.name, "instance": self.instance, "slots": self.max_jobs,
+                         "cores": available_cores(), "token": self.token,
+                         "jobs": {job.id: job.result for job in self.jobs.values()}})
+        reply, _ = await conn.receive()
+        if reply.get("type") == "refused":
+            conn.close()
+            if reply.get("retry"):
+                self._event(f"The coordinator turned this worker away: {reply.get('error', '')}")
+                return False
+            raise SignError(f"The coordinator refused this worker: {reply.get('error', '')}")
+        if reply.get("type") == "bye":
+            conn.close()
+            return True
+        self._conn = conn
+        self._event(f"Connected to the coordinator at {self.host}:{self.port} with {self.max_jobs} slots")
+        heartbeat = asyncio.create_task(conn.heartbeat())
+        try:
+            while True:
+                message, payload = await conn.receive()
+                kind = message.get("type")
+                if kind == "bye":
+                    self._event(f"Batch done, {self.signed} jobs signed here")
+                    for job in list(self.jobs.values()):
+                        self._cancel(job)
+                    return True
+                job = self.jobs.get(message.get("id", ""))
+                if kind == "job":
+                    await self._accept(message)
+                elif kind == "chunk" and job:
+                    await self._chunk(job, message, payload)
+                elif kind == "fetch":
+                    self._spawn(self._send_output(message["id"], message.get("offset", 0)))
+                elif kind in ("received", "cancel") and job:
+                    self._cancel(job)
+        finally:
+            heartbeat.cancel()
+            for task in list(self._tasks):
+                task.cancel()
+            self._conn = None
+            conn.close()
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _send(self, message, payload=b""):
+        """Send from the event loop without waiting; lost if not connected"""
+        if self._conn:
+            self._spawn(self._safe_send(self._conn, message, payload))
+
+    async def _safe_send(self, conn, message, payload=b""):
+        try:
+            await conn.send(message, payload)
+        except (ConnectionError, OSError):
+            pass
+
+    async def _accept(self, message):
+        job = self.jobs.get(message["id"])
+        if job is None:
+            files = {name: {"name": os.path.basename(info["name"]), "size": int(info["size"])}
+                     for name, info in message["files"].items() if name == INPUT or name in FILE_FIELDS}
+            options = {key: value for key, value in message.get("options", {}).items()
+                       if key in engine.SignJob.__dataclass_fields__ and key not in FILE_FIELDS}
+            job = WorkerJob(message["id"], os.path.join(self.root, message["id"]), options, files,
+                            os.path.basename(message.get("output_name") or "signed.ipa"))
+            self.jobs[job.id] = job
+            for name in list(job.files) + [OUTPUT]:
+                os.makedirs(os.path.join(job.directory, name), exist_ok=True)
+            # Keeps a folder in use from being swept as stale
+            os.utime(job.directory)
+        if job.result is not None:
+            self._send(dict(job.result, type="done", id=job.id))
+        elif job.status == PENDING:
+            await self._request_files(job)
+
+    async def _request_files(self, job):
+        missing = job.missing()
+        for name, offset in missing.items():
+            if offset:
+                self._event(f"[{job.id}] Resuming transfer of {job.files[name]['name']} at {_mb(offset)}")
+            self._send({"type": "want", "id": job.id, "file": name, "offset": offset})
+        if not missing:
+            self._start(job)
+
+    async def _chunk(self, job, message, payload):
+        name = message.get("file")
+        if job.status != PENDING or name not in job.files:
+            return
+        path = job.path(name)
+        size = append_chunk(path + ".part", message.get("offset", -1), payload)
+        if size == job.files[name]["size"]:
+            os.replace(path + ".part", path)
+            if not job.missing():
+                self._start(job)
+
+    def _start(self, job):
+        """Sign the job once all its files are in; unlike transfers, this
+        carries on if the connection drops"""
+        job.status = RUNNING
+        task = asyncio.create_task(self._sign(job))
+        self._signing.add(task)
+        task.add_done_callback(self._signing.discard)
+
+    async def _sign(self, job):
+        self._event(f"[{job.id}] Signing {job.files[INPUT]['name']}")
+        start = time.monotonic()
+        try:
+            result = await self._loop.run_in_executor(self._executor, self._run_job, job)
+            returncode, error = result.returncode, "" if result.ok else f"zsign exited with code {result.returncode}"
+        except (SignError, OSError, ValueError) as e:
+            returncode, error = None, str(e)
+            self._log(job, f"Error: {error}")
+        except Exception as e:
+            # A bug shouldn't leave the coordinator waiting on this job forever
+            returncode, error = None, f"{type(e).__name__}: {str(e)}"
+            self._log(job, f"Error: {error}")
+            self._event(f"[{job.id}] Unexpected error: {error}")
+        job.process = None
+        if job.cancelled:
+            self._drop(job)
+            return
+        output = job.path(OUTPUT)
+        size = os.path.getsize(output) if returncode == 0 and os.path.exists(output) else 0
+        job.status = SUCCEEDED if returncode == 0 and not error else FAILED
+        # Tells the coordinator whether an output .part it holds is from this result
+        job.result = {"returncode": returncode, "error": error, "size": size, "result": uuid.uuid4().hex[:12],
+                      "elapsed": time.monotonic() - start}
+        self.signed += job.status == SUCCEEDED
+        self._event(f"[{job.id}] {job.status} in {job.result['elapsed']:.1f}s")
+        self._send(dict(job.result, type="done", id=job.id))
+
+    def _log(self, job, line):
+        self._send({"type": "log", "id": job.id, "line": line})
+
+    def _run_job(self, job):
+        """Sign on an executor thread, sending log lines back to the event loop"""
+        def emit(line):
+            self._loop.call_soon_threadsafe(self._log, job, line)
+
+        def started(process):
+            job.process = process
+            if job.cancelled:
+                process.kill()
+
+        sign_job = job.sign_job()
+        admitted = nullcontext()
+        if self.scheduler:
+            admitted = self.scheduler.admit(sign_job, self.workspace, scratch=self.scratch,
+                                            on_wait=lambda reason: emit(f"Waiting to start: {reason}"))
+        with admitted:
+            result = engine.run(self.zsign_path, sign_job, on_output=emit, on_start=started, cache=self.cache,
+                                workspace=self.workspace, metrics=self.metrics, background=True,
+                                scratch=self.scratch)
+        if result.ok and self.verify and can_verify(sign_job):
+            try:
+                verification = verify_job(sign_job).result()
+            except Exception as e:
+                emit(f"Could not verify the signed app: {str(e) or type(e).__name__}")
+                return result
+            emit(str(verification))
+            if not verification.ok:
+                raise SignError(f"output failed verification: {'; '.join(verification.problems)}")
+        return result
+
+    async def _send_output(self, job_id, offset):
+        job = self.jobs.get(job_id)
+        path = job.path(OUTPUT) if job else ""
+        if not job or job.status != SUCCEEDED or not os.path.exists(path):
+            self._send({"type": "gone", "id": job_id})
+            return
+        if offset:
+            self._event(f"[{job.id}] Resuming transfer of {job.output_name} at {_mb(offset)}")
+        conn = self._conn
+        try:
+            await send_file(conn, self._loop, {"id": job.id, "file": OUTPUT}, path, offset)
+        except (ConnectionError, OSError):
+            pass
+
+    def _cancel(self, job):
+        job.cancelled = True
+        if job.status == RUNNING and job.process:
+            try:
+                job.process.kill()
+            except OSError:
+                pass
+        elif job.status != RUNNING:
+            self._drop(job)
+
+    def _drop(self, job):
+        self.jobs.pop(job.id, None)
+        shutil.rmtree(job.directory, ignore_errors=True)
+
+
+# Coordinator
+
+@dataclass
+class Assignment:
+    """Where one batch item is in the cluster"""
+    id: str
+    item: object
+    # {field: path} of the IPA and each file the job refers to, on the coordinator
+    paths: dict
+    worker: str = ""
+    # Set from the worker's "done" until the signed app is fetched
+    result: dict = None
+    lost: int = 0
+    failures: int = 0
+    started: float = 0.0
+    # Which worker result the output .part holds, so a resumed download isn't
+    # appended to a different signing of the same app
+    part_of: str = ""
+
+    @property
+    def done(self):
+        return self.item.status in (SUCCEEDED, FAILED, CANCELLED)
+
+
+@dataclass
+class WorkerLink:
+    """A connected worker and what it said it can take"""
+    name: str
+    instance: str
+    conn: Connection
+    slots: int
+    cores: int = 0
+    address: str = ""
+
+
+def job_id(job):
+    """An ID that stays the same for the same input and output, so a job
+    sent again to a worker that already has part of its IPA resumes it"""
+    st = os.stat(job.input_path)
+    key = f"{os.path.realpath(job.input_path)}|{st.st_size}|{st.st_mtime_ns}|{os.path.abspath(job.output_path)}"
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+class Coordinator:
+    """Shard a batch of signing jobs across Workers that connect over TCP.
+
+    Each job goes to the worker with the most free slots, as the workers
+    advertise them; its IPA, and the certificate, profile and other files
+    it names, are sent in chunks, and the signed app comes back the same
+    way to the job's output path. A transfer cut off by a dropped
+    connection resumes from the bytes already received. A worker that
+    disconnects or misses heartbeats for DEAD_AFTER seconds is dead, and
+    its jobs go back to the front of the queue for another worker, unless
+    it reconnects first. Items are updated like BatchRunner updates them;
+    run() returns a BatchSummary."""
+
+    def __init__(self, items, host=DEFAULT_HOST, port=DEFAULT_PORT, token="", retries=0,
+                 on_update=None, on_output=None, on_event=None, on_ready=None):
+        self.items = items
+        self.host = host
+        self.port = port
+        self.token = token
+        self.retries = max(0, retries)
+        self.on_update = on_update
+        self.on_output = on_output
+        self.on_event = on_event
+        # Called with the (host, port) listened on, e.g. to start local workers
+        self.on_ready = on_ready
+        self.workers = {}
+        self.assignments = {}
+        self._pending = deque()
+        self._finished = None
+        self._loop = None
+        self._tasks = set()
+        self._handlers = set()
+
+    def _event(self, message):
+        if self.on_event:
+            self.on_event(message)
+
+    def _notify(self, item):
+        if self.on_update:
+            self.on_update(item)
+
+    def _emit(self, item, line):
+        if self.on_output:
+            self.on_output(item, line)
+
+    def run(self):
+        """Run every job on the workers and return a BatchSummary; blocks until done"""
+        start = time.monotonic()
+        asyncio.run(self._run())
+        summary = BatchSummary(total=len(self.items), elapsed=time.monotonic() - start)
+        for item in self.items:
+            if item.status == SUCCEEDED:
+                summary.succeeded += 1
+            elif item.status == CANCELLED:
+                summary.cancelled += 1
+            else:
+                summary.failed += 1
+        return summary
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        self._finished = asyncio.Event()
+        for item in self.items:
+            self._prepare(item)
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        address = server.sockets[0].getsockname()[:2]
+        self._event(f"Waiting for workers on {address[0]}:{address[1]}")
+        try:
+            if self.on_ready:
+                self.on_ready(address)
+            self._check_finished()
+            await self._finished.wait()
+        finally:
+            self._finished.set()
+            for assignment in self.assignments.values():
+                if not assignment.done:
+                    assignment.item.status = CANCELLED
+                    self._notify(assignment.item)
+            for link in list(self.workers.values()):
+                await self._safe_send(link.conn, {"type": "bye"})
+                link.conn.close()
+            server.close()
+            # Let each connection's handler see its link close and end
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await server.wait_closed()
+
+    def _prepare(self, item):
+        job = item.job
+        try:
+            engine.validate(job)
+            if not os.path.isfile(job.input_path):
+                raise SignError(f"Only .ipa files can be sent to workers: {job.input_path}")
+            if not job.output_path:
+                raise SignError(f"No output path for {job.input_path}")
+        except SignError as e:
+            item.status = FAILED
+            item.error = str(e)
+            self._emit(item, str(e))
+            self._notify(item)
+            return
+        paths = {INPUT: job.input_path}
+        paths.update((name, getattr(job, name)) for name in FILE_FIELDS if getattr(job, name))
+        assignment = Assignment(job_id(job), item, paths)
+        self.assignments[assignment.id] = assignment
+        self._pending.append(assignment.id)
+
+    def _check_finished(self):
+        if all(item.status in (SUCCEEDED, FAILED, CANCELLED) for item in self.items):
+            self._finished.set()
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _send_to(self, worker, message, payload=b""):
+        link = self.workers.get(worker)
+        if link:
+            self._spawn(self._safe_send(link.conn, message, payload))
+
+    async def _safe_send(self, conn, message, payload=b""):
+        try:
+            await conn.send(message, payload)
+        except (ConnectionError, OSError):
+            # The link's reader notices and hands its jobs to other workers
+            pass
+
+    def _busy(self, name):
+        """Jobs a worker is signing or about to; fetching a signed app doesn't take a slot"""
+        return sum(1 for a in self.assignments.values()
+                   if a.worker == name and a.result is None and not a.done)
+
+    def _dispatch(self):
+        """Hand queued jobs to the workers with the most free slots"""
+        while self._pending and self.workers:
+            link = max(self.workers.values(), key=lambda link: link.slots - self._busy(link.name))
+            if link.slots - self._busy(link.name) <= 0:
+                return
+            assignment = self.assignments[self._pending.popleft()]
+            self._assign(assignment, link)
+
+    def _assign(self, assignment, link):
+        item = assignment.item
+        assignment.worker = link.name
+        assignment.result = None
+        assignment.started = time.monotonic()
+        item.attempts += 1
+        item.status = RUNNING
+        self._notify(item)
+        self._emit(item, f"Sent to worker {link.name}")
+        self._send_job(assignment, link)
+
+    def _send_job(self, assignment, link):
+        job = assignment.item.job
+        options = {key: value for key, value in asdict(job).items()
+                   if key not in FILE_FIELDS + ("input_path", "output_path", "install")}
+        files = {name: {"name": os.path.basename(path), "size": os.path.getsize(path)}
+                 for name, path in assignment.paths.items()}
+        self._send_to(link.name, {"type": "job", "id": assignment.id, "options": options, "files": files,
+                                  "output_name": os.path.basename(job.output_path)})
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        asyncio.current_task().add_done_callback(self._handlers.discard)
+        conn = Connection(reader, writer)
+        link = None
+        reason = "connection closed"
+        heartbeat = None
+        try:
+            hello, _ = await conn.receive()
+            if hello.get("type") != "hello" or not hello.get("worker"):
+                return
+            if self.token and not hmac.compare_digest(str(hello.get("token", "")).encode(), self.token.encode()):
+                await conn.send({"type": "refused", "error": "missing or wrong token"})
+                self._event(f"Refused worker {hello['worker']}: wrong token")
+                return
+            if self._finished.is_set():
+                await conn.send({"type": "bye"})
+                return
+            name = str(hello["worker"])
+            instance = str(hello.get("instance", ""))
+            old = self.workers.get(name)
+            if old and old.instance != instance:
+                # Until the old connection times out, in case this is a restart
+                await conn.send({"type": "refused", "error": f"a worker named {name} is already connected",
+                                 "retry": True})
+                return
+            if old:
+                # The same worker again: the old connection is dead even if it hasn't timed out yet
+                old.conn.close()
+            peer = writer.get_extra_info("peername") or ("?", 0)
+            link = WorkerLink(name, instance, conn, max(1, int(hello.get("slots", 1))), int(hello.get("cores", 0)),
+                              f"{peer[0]}:{peer[1]}")
+            self.workers[name] = link
+            await conn.send({"type": "welcome"})
+            self._event(f"Worker {name} {'reconnected' if old else 'joined'} from {link.address} with {link.slots} "
+                        f"slots ({link.cores} cores)")
+            heartbeat = asyncio.create_task(conn.heartbeat())
+            self._reclaim(link, hello.get("jobs") or {})
+            self._dispatch()
+            while True:
+                message, payload = await conn.receive()
+                self._on_message(link, message, payload)
+        except (ConnectionError, OSError) as e:
+            reason = str(e) or type(e).__name__
+        finally:
+            if heartbeat:
+                heartbeat.cancel()
+            if link and self.workers.get(link.name) is link and not self._finished.is_set():
+                self._lost(link, reason)
+            conn.close()
+
+    def _reclaim(self, link, jobs):
+        """Take back the jobs a reconnecting worker still has, unless they've
+        gone to another worker since"""
+        for job_id, result in jobs.items():
+            assignment = self.assignments.get(job_id)
+            if not assignment or assignment.done or (assignment.worker and assignment.worker != link.name):
+                self._send_to(link.name, {"type": "cancel", "id": job_id})
+                continue
+            if job_id in self._pending:
+                self._pending.remove(job_id)
+                assignment.worker = link.name
+                assignment.item.status = RUNNING
+                self._notify(assignment.item)
+                self._emit(assignment.item, f"Picked up again on worker {link.name}")
+            if result:
+                self._on_done(link, assignment, result)
+            else:
+                # The worker asks for whatever of its files it's still missing
+                self._send_job(assignment, link)
+        for assignment in list(self.assignments.values()):
+            if assignment.worker != link.name or assignment.done or assignment.id in jobs:
+                continue
+            if assignment.result is None:
+                # Sent just as the connection dropped
+                self._send_job(assignment, link)
+            else:
+                self._requeue(assignment)
+
+    def _lost(self, link, reason):
+        """A worker died or dropped off: queue its jobs for the others"""
+        del self.workers[link.name]
+        self._event(f"Lost worker {link.name}: {reason}")
+        requeue = []
+        for assignment in self.assignments.values():
+            if assignment.worker != link.name or assignment.done:
+                continue
+            item = assignment.item
+            assignment.worker = ""
+            assignment.result = None
+            assignment.lost += 1
+            if assignment.lost >= MAX_LOST_WORKERS:
+                item.status = FAILED
+                item.error = f"lost {assignment.lost} workers while signing it"
+                self._emit(item, f"Giving up: {item.error}")
+            else:
+                item.status = PENDING
+                self._emit(item, f"Worker {link.name} was lost, sending the job to another worker")
+                requeue.append(assignment.id)
+            self._notify(item)
+        self._pending.extendleft(reversed(requeue))
+        self._dispatch()
+        self._check_finished()
+
+    def _on_message(self, link, message, payload):
+        kind = message.get("type")
+        assignment = self.assignments.get(message.get("id", ""))
+        if not assignment or assignment.worker != link.name or assignment.done:
+            return
+        if kind == "log":
+            self._emit(assignment.item, str(message.get("line", "")))
+        elif kind == "want":
+            name = message.get("file")
+            if name in assignment.paths:
+                self._spawn(self._upload(link, assignment, name, int(message.get("offset", 0))))
+        elif kind == "done":
+            self._on_done(link, assignment, message)
+        elif kind == "chunk" and message.get("file") == OUTPUT and assignment.result:
+            self._receive_output(link, assignment, message.get("offset", -1), payload)
+        elif kind == "gone":
+            # The worker no longer has the signed app, e.g. after a restart
+            self._requeue(assignment)
+
+    def _requeue(self, assignment):
+        assignment.worker = ""
+        assignment.result = None
+        assignment.item.status = PENDING
+        self._notify(assignment.item)
+        self._pending.appendleft(assignment.id)
+        self._dispatch()
+
+    async def _upload(self, link, assignment, name, offset):
+        path = assignment.paths[name]
+        size = os.path.getsize(path)
+        if not 0 <= offset <= size:
+            offset = 0
+        if offset and name == INPUT:
+            self._emit(assignment.item, f"Resuming upload to {link.name} at {_mb(offset)} of {_mb(size)}")
+        try:
+            await send_file(link.conn, self._loop, {"id": assignment.id, "file": name}, path, offset)
+        except (ConnectionError, OSError):
+            pass
+
+    def _on_done(self, link, assignment, result):
+        item = assignment.item
+        item.returncode = result.get("returncode")
+        if item.returncode == 0 and not result.get("error"):
+            assignment.result = result
+            part = item.job.output_path + ".part"
+            if assignment.part_of != result.get("result") and os.path.exists(part):
+                os.remove(part)
+            assignment.part_of = result.get("result", "")
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset:
+                self._emit(item, f"Resuming download from {link.name} at {_mb(offset)}")
+            if offset < result.get("size", 0):
+                self._send_to(link.name, {"type": "fetch", "id": assignment.id, "offset": offset})
+            else:
+                self._receive_output(link, assignment, offset, b"")
+            self._dispatch()
+            return
+        assignment.failures += 1
+        error = result.get("error") or f"zsign exited with code {item.returncode}"
+        self._send_to(link.name, {"type": "received", "id": assignment.id})
+        assignment.worker = ""
+        if assignment.failures > self.retries:
+            self._finish(assignment, FAILED, error)
+            return
+        item.status = RETRYING
+        self._notify(item)
+        self._emit(item, f"{error}; retrying (attempt {assignment.failures + 1} of {self.retries + 1})")
+        self._pending.append(assignment.id)
+        self._dispatch()
+
+    def _receive_output(self, link, assignment, offset, payload):
+        output = assignment.item.job.output_path
+        size = append_chunk(output + ".part", offset, payload)
+        if size < assignment.result["size"]:
+            return
+        if size > assignment.result["size"]:
+            os.remove(output + ".part")
+            self._finish(assignment, FAILED, "signed app came back larger than the worker said")
+        else:
+            os.replace(output + ".part", output)
+            self._finish(assignment, SUCCEEDED)
+        self._send_to(link.name, {"type": "received", "id": assignment.id})
+
+    def _finish(self, assignment, status, error=""):
+        item = assignment.item
+        item.status = status
+        item.error = error
+        item.elapsed = time.monotonic() - assignment.started
+        if error:
+            self._emit(item, error)
+        self._notify(item)
+        self._dispatch()
+        self._check_finished()
+
+
+def start_local_workers(address, count, args=(), token=""):
+    """Start count worker processes on this machine for a coordinator at
+    address, named local-1, local-2 and so on; returns their Popen objects"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                       env.get("PYTHONPATH")]))
+    if token:
+        env[TOKEN_ENV] = token
+    host, port = address
+    return [subprocess.Popen([sys.executable, "-m", "neosigner", "worker", f"{host}:{port}", "--name", f"local-{i}",
+                              "--once", *args], env=env)
+            for i in range(1, count + 1)]
+
+
+def stop_local_workers(processes, timeout=10):
+    """Wait for workers started by start_local_workers to exit, killing any that don't"""
+    deadline = time.monotonic() + timeout
+    for process in processes:
+        try:
+            process.wait(max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
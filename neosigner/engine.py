@@ -0,0 +1,491 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+from dataclasses import dataclass, field, replace
+
+from .cache import is_cacheable, job_key, release_output
+from .incremental import PackIndex
+from .ipainfo import read_app_info
+from .metrics import JobRecord, PhaseTracker
+from .packaging import DEFAULT_LEVEL, pack_folder
+from .process import background_command
+from .slim import load_rules, slim_ipa, slim_tree
+from .workspace import extract_ipa
+
+
+# Stages whose work grows with the size of the app, after it was slimmed
+SIZE_BOUND_STAGES = ("zsign", "package")
+
+
+class SignError(Exception):
+    """A job can't be run as specified; the message is meant for the user"""
+
+
+@dataclass
+class SignJob:
+    """Everything zsign needs to sign one app"""
+    input_path: str
+    output_path: str = ""
+    pkey: str = ""
+    prov: str = ""
+    password: str = ""
+    adhoc: bool = False
+    cert: str = ""
+    bundle_id: str = ""
+    bundle_name: str = ""
+    bundle_version: str = ""
+    entitlements: str = ""
+    dylib: str = ""
+    weak: bool = False
+    force: bool = False
+    sha256_only: bool = False
+    install: bool = False
+    zip_level: int = None
+    # Have zsign sign an unpacked folder and zip it on every core afterwards
+    parallel_zip: bool = False
+    # JSON file of slimming rules for what to leave out of the app before signing
+    slim: str = ""
+
+
+def build_command(zsign_path, job):
+    """Build the zsign command line for a job"""
+    cmd = [zsign_path]
+
+    # Basic options
+    if job.adhoc:
+        cmd.append("-a")
+    else:
+        cmd.extend(["-k", job.pkey])
+        cmd.extend(["-m", job.prov])
+        if job.password:
+            cmd.extend(["-p", job.password])
+
+    if job.output_path:
+        cmd.extend(["-o", job.output_path])
+
+    # Advanced options
+    if job.cert:
+        cmd.extend(["-c", job.cert])
+    if job.bundle_id:
+        cmd.extend(["-b", job.bundle_id])
+    if job.bundle_name:
+        cmd.extend(["-n", job.bundle_name])
+    if job.bundle_version:
+        cmd.extend(["-r", job.bundle_version])
+    if job.entitlements:
+        cmd.extend(["-e", job.entitlements])
+    if job.dylib:
+        cmd.extend(["-l", job.dylib])
+    if job.weak:
+        cmd.append("-w")
+    if job.force:
+        cmd.append("-f")
+    if job.sha256_only:
+        cmd.append("-2")
+    if job.install:
+        cmd.append("-i")
+    if job.zip_level is not None and 0 <= job.zip_level <= 9:
+        cmd.extend(["-z", str(job.zip_level)])
+
+    # The input path always goes last
+    cmd.append(job.input_path)
+    return cmd
+
+
+@dataclass
+class SignResult:
+    """What happened when zsign ran a job"""
+    job: SignJob
+    returncode: int
+    elapsed: float = 0.0
+    output_size: int = 0
+    log: list = field(default_factory=list)
+    cached: bool = False
+    record: JobRecord = None
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+def validate(job):
+    """Check that every file a job refers to exists, raising SignError if not.
+    Also creates the output directory so zsign can write to it."""
+    if not job.input_path:
+        raise SignError("Unsigned app (.ipa) is required.")
+    if not os.path.exists(job.input_path):
+        raise SignError(f"Input path does not exist: {job.input_path}")
+
+    if not job.adhoc:
+        # When not adhoc, we need key and prov
+        if not job.pkey:
+            raise SignError("Certificate file (.p12) is required unless using ad-hoc.")
+        if not job.prov:
+            raise SignError("Provisioning profile is required unless using ad-hoc.")
+        if not os.path.exists(job.pkey):
+            raise SignError(f"Certificate file not found: {job.pkey}")
+        if not os.path.exists(job.prov):
+            raise SignError(f"Provisioning profile not found: {job.prov}")
+
+    if job.cert and not os.path.exists(job.cert):
+        raise SignError(f"Certificate file not found: {job.cert}")
+    if job.entitlements and not os.path.exists(job.entitlements):
+        raise SignError(f"Entitlements file not found: {job.entitlements}")
+    if job.dylib and not os.path.exists(job.dylib):
+        raise SignError(f"Dylib file not found: {job.dylib}")
+    if job.slim and not os.path.exists(job.slim):
+        raise SignError(f"Slimming rules not found: {job.slim}")
+
+    # Ensure output directory exists
+    output_dir = os.path.dirname(job.output_path)
+    if output_dir and not os.path.exists(output_dir):
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+        except OSError as e:
+            raise SignError(f"Could not create output directory: {str(e)}")
+
+
+class SignRun:
+    """One job on its way through zsign.
+
+    prepare() checks the signed app cache and gets the input ready (e.g. a
+    workspace checkout), the caller runs self.command however it likes, and
+    finish() turns the exit code into a SignResult, updates the cache and
+    cleans up. The GUI runs each step on its own schedule; run() does all
+    three in a row. With a ScratchPolicy, IPAs are unpacked into its fast
+    or disk folder and zsign signs the folder, instead of unzipping into
+    the system temp directory itself. A job with slimming rules has them
+    applied to the unpacked app, or to a slimmed copy of the IPA, before
+    zsign runs. Each step's timing goes into self.record, which is
+    handed to metrics (a MetricsWriter) once the job is done."""
+
+    def __init__(self, zsign_path, job, on_output=None, cache=None, workspace=None, metrics=None, scratch=None):
+        self.zsign_path = zsign_path
+        self.job = job
+        self.on_output = on_output
+        self.cache = cache
+        self.workspace = workspace
+        self.metrics = metrics
+        self.scratch = scratch
+        self.lease = None
+        self.record = JobRecord.for_job(job)
+        self.phases = PhaseTracker(self.record)
+        self.cache_key = None
+        self.checkout = None
+        self.unpacked = None
+        self.pack_dir = None
+        self.pack_index = None
+        self.slim_dir = None
+        self.slim_kept_bytes = 0
+        self.command = None
+        self.log = []
+        self.start = time.monotonic()
+
+    def emit(self, line):
+        self.log.append(line)
+        if self.on_output:
+            self.on_output(line)
+
+    def observe(self, line):
+        """Note when each of zsign's phases finished from a line it printed"""
+        self.phases.line(line)
+
+    def zsign_output(self, line):
+        self.observe(line)
+        self.emit(line)
+
+    def started(self):
+        """Call once zsign is running"""
+        self.phases.start()
+
+    def prepare(self):
+        """Validate the job and return a SignResult if the cache already
+        holds the signed app, otherwise None with self.command ready to run.
+        Whatever was set up is cleaned up again if this raises."""
+        try:
+            return self._prepare()
+        except BaseException:
+            self.cleanup()
+            raise
+
+    def _prepare(self):
+        job = self.job
+        with self.record.stage("validate"):
+            if not self.zsign_path or not os.path.exists(self.zsign_path):
+                raise SignError(f"Zsign binary not found: {self.zsign_path}")
+            validate(job)
+        with self.record.stage("preflight"):
+            # Imported here as preflight builds on modules that import this one
+            from .preflight import check
+            check(job)
+
+        if self.cache and is_cacheable(job):
+            with self.record.stage("cache"):
+                self.cache_key = job_key(self.zsign_path, job)
+                hit = self.cache.fetch(self.cache_key, job.output_path)
+            if hit:
+                self.emit(f"Reused cached signed app ({self.cache.stats()})")
+                return self._finalize(self._result(0, cached=True))
+            self.emit(f"No cached signed app, running zsign ({self.cache.stats()})")
+        packing = job.parallel_zip and not job.install and job.output_path and os.path.isfile(job.input_path)
+        if packing:
+            # Before release_output, which may remove the IPA it reuses entries from
+            self.pack_index = PackIndex.load(read_app_info(job.input_path).bundle_id or job.input_path,
+                                             self._zip_level())
+        if job.output_path:
+            release_output(job.output_path)
+
+        zsign_job = job
+        if self.workspace and self.workspace.accepts(job):
+            with self.record.stage("workspace"):
+                self.checkout = self.workspace.checkout(job.input_path)
+            self.emit(f"Signing an extracted copy of {os.path.basename(job.input_path)} ({self.workspace.stats()})")
+            zsign_job = replace(job, input_path=self.checkout)
+        elif self.scratch and job.output_path and os.path.isfile(job.input_path):
+            zsign_job = replace(job, input_path=self._unpack(job.input_path))
+
+        if job.parallel_zip:
+            if not packing:
+                self.emit("Parallel compression needs an IPA input, an output file and no install; using zsign's")
+            else:
+                self.pack_dir = self.checkout or self.unpacked or self._unpack(job.input_path)
+                # Without -o zsign signs the folder in place and skips zipping
+                zsign_job = replace(job, input_path=self.pack_dir, output_path="", zip_level=None)
+        if job.slim:
+            zsign_job = self._slim(zsign_job)
+
+        self.command = build_command(self.zsign_path, zsign_job)
+        return None
+
+    def _unpack(self, ipa_path):
+        start = time.monotonic()
+        if self.scratch:
+            self.lease = self.scratch.allocate(read_app_info(ipa_path).size)
+            self.unpacked = self.lease.path
+            self.record.scratch = self.lease.tier
+            where = f" into {self.scratch.describe(self.lease)}"
+        else:
+            # The PID lets a later run remove it if this process dies first
+            self.unpacked = tempfile.mkdtemp(prefix=f"neosigner-{os.getpid()}-")
+            where = ""
+        size, files, _ = extract_ipa(ipa_path, self.unpacked)
+        elapsed = time.monotonic() - start
+        self.record.add("unpack", elapsed)
+        self.emit(f"Unpacked {files} files ({size / (1024 * 1024):.2f} MB){where} in {elapsed:.1f}s")
+        return self.unpacked
+
+    def _slim(self, zsign_job):
+        """Apply the job's slimming rules to what zsign is about to sign"""
+        try:
+            rules = load_rules(self.job.slim)
+        except (OSError, ValueError) as e:
+            raise SignError(f"Can't read slimming rules: {str(e)}")
+        tree = self.checkout or self.unpacked
+        if not tree and not os.path.isfile(zsign_job.input_path):
+            self.emit("Not slimming the app: zsign signs an app folder in place")
+            return zsign_job
+        with self.record.stage("slim"):
+            try:
+                if tree:
+                    slimmed = slim_tree(tree, rules)
+                else:
+                    self.slim_dir = tempfile.mkdtemp(prefix=f"neosigner-{os.getpid()}-")
+                    slim_path = os.path.join(self.slim_dir, os.path.basename(zsign_job.input_path))
+                    slimmed = slim_ipa(zsign_job.input_path, slim_path, rules)
+                    zsign_job = replace(zsign_job, input_path=slim_path)
+            except (OSError, ValueError, zipfile.BadZipFile) as e:
+                raise SignError(f"Could not slim {os.path.basename(self.job.input_path)}: {str(e)}")
+        self.record.slimmed_files = slimmed.files
+        self.record.slimmed_bytes = slimmed.bytes
+        self.slim_kept_bytes = slimmed.kept_bytes
+        self.emit(str(slimmed))
+        return zsign_job
+
+    def _zip_level(self):
+        return self.job.zip_level if self.job.zip_level is not None else DEFAULT_LEVEL
+
+    def _pack(self):
+        level = self._zip_level()
+        self.emit(f"Compressing with {os.cpu_count() or 1} worker processes at level {level}...")
+        index = self.pack_index
+        with self.record.stage("package"):
+            packed = pack_folder(self.pack_dir, self.job.output_path, level, index=index)
+        self.emit(f"Packed {packed}")
+        if index:
+            self.emit(str(index))
+            self.record.reused_files = index.reused
+            self.record.reused_bytes = index.reused_bytes
+            try:
+                index.save(self.job.output_path)
+            except OSError as e:
+                self.emit(f"Could not save the index of compressed files: {str(e)}")
+
+    def finish(self, returncode):
+        """Record how zsign exited and return the SignResult"""
+        self.phases.exit(install=self.job.install)
+        try:
+            if self.pack_dir and returncode == 0:
+                try:
+                    self._pack()
+                except OSError as e:
+                    self.emit(f"Could not package signed app: {str(e)}")
+                    returncode = 1
+            result = self._result(returncode)
+            if result.output_size and self.cache_key:
+                try:
+                    with self.record.stage("cache_store"):
+                        self.cache.store(self.cache_key, self.job.output_path)
+                except OSError as e:
+                    self.emit(f"Could not cache signed app: {str(e)}")
+            if self.checkout or self.unpacked:
+                with self.record.stage("cleanup"):
+                    self.cleanup()
+            return self._finalize(result)
+        finally:
+            self.cleanup()
+
+    def cleanup(self):
+        if self.checkout:
+            self.workspace.release(self.checkout)
+            self.checkout = None
+        if self.lease:
+            self.scratch.release(self.lease)
+            self.lease = None
+        elif self.unpacked:
+            shutil.rmtree(self.unpacked, ignore_errors=True)
+        self.unpacked = None
+        if self.slim_dir:
+            shutil.rmtree(self.slim_dir, ignore_errors=True)
+            self.slim_dir = None
+        if self.pack_index:
+            self.pack_index.close()
+            self.pack_index = None
+
+    def _result(self, returncode, cached=False):
+        result = SignResult(self.job, returncode, elapsed=time.monotonic() - self.start,
+                            log=self.log, cached=cached, record=self.record)
+        output = self.job.output_path
+        if result.ok and output and os.path.exists(output):
+            result.output_size = os.path.getsize(output)
+        return result
+
+    def _finalize(self, result):
+        """Fill in the job record and hand it to the metrics writer"""
+        record = self.record
+        record.returncode = result.returncode
+        record.cached = result.cached
+        record.bytes_out = result.output_size
+        record.total_seconds = round(result.elapsed, 4)
+        if os.path.isfile(self.job.input_path):
+            record.bytes_in = os.path.getsize(self.job.input_path)
+        if record.slimmed_bytes and self.slim_kept_bytes and not result.cached:
+            # Hashing and compressing take about as long per byte for what
+            # was removed as for what was kept
+            work = sum(record.stages.get(stage, 0.0) for stage in SIZE_BOUND_STAGES)
+            record.slim_saved_seconds = round(work * record.slimmed_bytes / self.slim_kept_bytes
+                                              - record.stages.get("slim", 0.0), 2)
+        if self.metrics:
+            try:
+                self.metrics.write(record)
+            except OSError as e:
+                self.emit(f"Could not write metrics: {str(e)}")
+        return result
+
+
+def run(zsign_path, job, on_output=None, on_start=None, cache=None, workspace=None, metrics=None,
+        background=False, scratch=None):
+    """Validate a job, run zsign for it and return a SignResult.
+
+    on_output is called with each line zsign prints and on_start with the
+    Popen object, so callers can kill it. With a SignedCache, a job that was
+    signed before is copied from the cache instead of running zsign; with a
+    Workspace, IPAs are unzipped once and signed from the extracted tree.
+    With a MetricsWriter, the job's timings are recorded there. Background
+    jobs run zsign at a lower CPU and disk priority. With a ScratchPolicy,
+    IPAs are unpacked into its fast folder when they fit."""
+    sign_run = SignRun(zsign_path, job, on_output, cache=cache, workspace=workspace, metrics=metrics,
+                       scratch=scratch)
+    result = sign_run.prepare()
+    if result:
+        return result
+
+    returncode = None
+    try:
+        with sign_run.record.stage("spawn"):
+            process = subprocess.Popen(
+                background_command(sign_run.command) if background else sign_run.command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1
+            )
+        sign_run.started()
+        if on_start:
+            on_start(process)
+
+        for line in process.stdout:
+            line = line.strip()
+            if line:
+                sign_run.zsign_output(line)
+        returncode = process.wait()
+    finally:
+        if returncode is None:
+            sign_run.cleanup()
+    return sign_run.finish(returncode)
+
+
+def check_device(ideviceinstaller_path, idevice_id_path=None):
+    """Raise SignError unless a device is connected.
+
+    With idevice_id, which only asks usbmuxd for its device list, this is
+    near instant; 'ideviceinstaller -l' lists every installed app first."""
+    if idevice_id_path:
+        try:
+            result = subprocess.run([idevice_id_path, "-l"],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    text=True)
+        except OSError as e:
+            raise SignError(f"Error checking device: {str(e)}")
+        if result.returncode == 0:
+            if not result.stdout.strip():
+                raise SignError("No iOS device found. Please connect your device.")
+            return
+
+    try:
+        result = subprocess.run([ideviceinstaller_path, "-l"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                text=True)
+    except OSError as e:
+        raise SignError(f"Error checking device: {str(e)}")
+    if "ERROR:" in result.stdout or "ERROR:" in result.stderr:
+        raise SignError("No iOS device found. Please connect your device.")
+
+
+def install(ideviceinstaller_path, ipa_path, on_output=None, on_start=None):
+    """Install a signed IPA with ideviceinstaller and return its exit code"""
+    if not ideviceinstaller_path:
+        raise SignError("ideviceinstaller not found. Please install it first.")
+    if not ipa_path:
+        raise SignError("No signed app specified. Please sign an app first.")
+    if not os.path.exists(ipa_path):
+        raise SignError(f"Signed app not found: {ipa_path}")
+
+    process = subprocess.Popen(
+        [ideviceinstaller_path, "-i", ipa_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1
+    )
+    if on_start:
+        on_start(process)
+    for line in process.stdout:
+        line = line.strip()
+        if line and on_output:
+            on_output(line)
+    return process.wait()
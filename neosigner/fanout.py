@@ -0,0 +1,55 @@
+import os
+import re
+from dataclasses import replace
+
+from .batch import BatchItem, manifest_rows, prepare_jobs
+from .engine import SignError
+
+# Characters kept when a variant's name becomes part of a file name
+UNSAFE_NAME = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+def variant_output_path(input_path, name, output_dir=""):
+    """Return <output_dir>/<name of the IPA>_<variant>.ipa"""
+    stem = os.path.splitext(os.path.basename(os.path.normpath(input_path)))[0]
+    directory = output_dir or os.path.dirname(os.path.abspath(input_path))
+    return os.path.join(directory, f"{stem}_{UNSAFE_NAME.sub('_', name).strip('_')}.ipa")
+
+
+def load_variants(path):
+    """Load variants from a CSV file with a 'variant' column naming each one
+    and the same optional columns as a batch manifest ('output',
+    'bundle_id', 'bundle_name', 'profile', 'certificate', 'dylib'). Returns
+    (name, overrides) pairs; a row without a name is named after its bundle
+    ID or its row number."""
+    variants = []
+    for number, (row, overrides) in enumerate(manifest_rows(path), 1):
+        overrides.pop("input_path", None)
+        if not overrides and not row.get("variant"):
+            continue
+        variants.append((row.get("variant") or overrides.get("bundle_id") or f"variant{number}", overrides))
+    return variants
+
+
+def prepare_variants(input_path, variants, template, output_dir=""):
+    """One BatchItem per (name, overrides) variant of the same input.
+
+    Run them with a BatchRunner and a Workspace: the IPA is then unzipped
+    once and every variant signs its own checkout, which hardlinks the
+    files zsign leaves alone and copies (or reflinks) only those it
+    rewrites, so each variant costs a signing pass rather than a full run."""
+    if not os.path.isfile(input_path):
+        raise SignError(f"Fan-out needs an .ipa file: {input_path}")
+    names = set()
+    items = []
+    for name, overrides in variants:
+        if name in names:
+            raise SignError(f"More than one variant is named {name}")
+        names.add(name)
+        overrides = dict(overrides)
+        overrides.setdefault("output_path", variant_output_path(input_path, name, output_dir))
+        items.append(BatchItem(input_path, overrides, label=name))
+    if not items:
+        raise SignError("No variants to sign.")
+    # Packaging on every core is what lets many variants finish together
+    return prepare_jobs(items, replace(template, parallel_zip=True))
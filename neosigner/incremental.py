@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+
+from .packaging import DEFLATED
+from .paths import cache_dir
+from .workspace import MACHO_MAGICS
+
+INDEX_VERSION = 1
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+LOCAL_MAGIC = 0x04034B50
+READ_SIZE = 1024 * 1024
+
+# Indexes kept, one per bundle ID, the least recently written dropped first
+MAX_INDEXES = 200
+
+
+def index_path(bundle_id):
+    name = hashlib.sha256(bundle_id.encode("utf-8")).hexdigest()[:24]
+    return cache_dir("incremental", f"{name}.json")
+
+
+def _stat_matches(st, recorded):
+    return [st.st_size, st.st_mtime_ns, st.st_ino] == recorded
+
+
+class PackIndex:
+    """The content hash and compressed entry of every resource in the last
+    signed IPA of one bundle ID, so packing the next build of the app can
+    copy the entries of files that haven't changed instead of deflating
+    them again.
+
+    Entries are only reused from the IPA the index was written for while
+    that file is unchanged, at the same zip level, and for files whose
+    content hash and size match; deflate gives the same bytes for the same
+    input, so the output is what packing from scratch would have written.
+    Mach-O files change with every signing and are always compressed
+    afresh. The source IPA is opened when the index is loaded, so zsign or
+    the cache replacing the old output doesn't take the entries away."""
+
+    def __init__(self, bundle_id, level):
+        self.bundle_id = bundle_id
+        self.level = level
+        self.path = index_path(bundle_id)
+        self.entries = {}
+        self.source = None
+        self.source_path = ""
+        # Filled in while packing, for the index of the new IPA
+        self.digests = {}
+        self.new_entries = {}
+        self.reused = 0
+        self.reused_bytes = 0
+
+    @classmethod
+    def load(cls, bundle_id, level):
+        """The index of bundle_id's last signing, or an empty one to fill in"""
+        index = cls(bundle_id, level)
+        try:
+            with open(index.path) as f:
+                data = json.load(f)
+            if data.get("version") != INDEX_VERSION or data.get("level") != level:
+                return index
+            source = open(data["output"], "rb")
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return index
+        if not _stat_matches(os.fstat(source.fileno()), data.get("stat")):
+            # Signed again elsewhere, or changed since
+            source.close()
+            return index
+        index.source = source
+        index.source_path = data["output"]
+        index.entries = data.get("entries") or {}
+        return index
+
+    def match(self, arcname, path, st):
+        """The previous entry to copy for this file, or None to compress it.
+        Hashes the file either way, for the next build's index."""
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            head = f.read(READ_SIZE)
+            if head[:4] in MACHO_MAGICS:
+                return None
+            for block in iter(lambda: f.read(READ_SIZE), b""):
+                h.update(head)
+                head = block
+            h.update(head)
+        digest = h.hexdigest()
+        self.digests[arcname] = digest
+        entry = self.entries.get(arcname)
+        if not self.source or not entry or entry[0] != digest or entry[4] != st.st_size:
+            return None
+        return self._locate(arcname, entry)
+
+    def _locate(self, arcname, entry):
+        """entry with the offset of its data in the source IPA, after checking
+        the local header there is the one the index points to"""
+        _, method, crc, csize, usize, offset = entry
+        try:
+            self.source.seek(offset)
+            header = LOCAL_HEADER.unpack(self.source.read(LOCAL_HEADER.size))
+            name = self.source.read(header[9])
+        except (OSError, struct.error):
+            return None
+        if header[0] != LOCAL_MAGIC or name != arcname.encode("utf-8") or header[6] != crc:
+            return None
+        return method, crc, csize, usize, offset + LOCAL_HEADER.size + header[9] + header[10]
+
+    def copy(self, writer, arcname, st, located):
+        """Write a matched entry into the new IPA as it is"""
+        method, crc, csize, usize, data_offset = located
+        self.source.seek(data_offset)
+        writer.add_stream(arcname, st, method, crc, csize, usize, self.source)
+        self.reused += 1
+        self.reused_bytes += usize
+
+    def update(self, records):
+        """Note where each compressed entry went in the new IPA, from ZipWriter.records"""
+        for name, _, method, _, crc, csize, usize, offset in records:
+            arcname = name.decode("utf-8")
+            if method == DEFLATED and arcname in self.digests:
+                self.new_entries[arcname] = [self.digests[arcname], method, crc, csize, usize, offset]
+
+    def save(self, output_path):
+        """Make the IPA just packed at output_path the one the next build reuses entries from"""
+        data = {"version": INDEX_VERSION, "bundle_id": self.bundle_id, "level": self.level,
+                "output": os.path.abspath(output_path), "stat": None, "entries": self.new_entries}
+        st = os.stat(output_path)
+        data["stat"] = [st.st_size, st.st_mtime_ns, st.st_ino]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        _prune(os.path.dirname(self.path))
+
+    def close(self):
+        if self.source:
+            self.source.close()
+            self.source = None
+
+    def __str__(self):
+        if not self.source_path:
+            return f"No earlier signing of {self.bundle_id} to reuse compressed files from"
+        return (f"Reused {self.reused} unchanged compressed files ({self.reused_bytes / (1024 * 1024):.2f} MB) "
+                f"of {len(self.entries)} from the last signing of {self.bundle_id}")
+
+
+def _prune(directory):
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith(".json")]
+        if len(names) <= MAX_INDEXES:
+            return
+        paths = sorted((os.path.join(directory, name) for name in names), key=os.path.getmtime)
+        for path in paths[:len(paths) - MAX_INDEXES]:
+            os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,274 @@
+import json
+import mmap
+import os
+import plistlib
+import threading
+import zipfile
+from dataclasses import asdict, dataclass, fields
+from datetime import timezone
+
+from .paths import cache_dir
+
+CACHE_FILE = "ipainfo.json"
+MAX_ENTRIES = 2000
+
+# Bump when AppInfo's fields change so old entries are read again
+CACHE_VERSION = 1
+
+# DER encoding of the commonName attribute's OID, 2.5.4.3
+COMMON_NAME_OID = b"\x06\x03\x55\x04\x03"
+
+
+@dataclass
+class AppInfo:
+    """What an IPA or app folder says about itself, read without extracting it"""
+    path: str
+    bundle_id: str = ""
+    name: str = ""
+    version: str = ""
+    build: str = ""
+    executable: str = ""
+    min_os: str = ""
+    extensions: int = 0
+    frameworks: int = 0
+    files: int = 0
+    size: int = 0
+    # From embedded.mobileprovision, if the app has one
+    profile_name: str = ""
+    team_id: str = ""
+    team_name: str = ""
+    signer: str = ""
+    profile_expires: float = 0.0
+    error: str = ""
+
+    def __str__(self):
+        if self.error:
+            return f"{os.path.basename(self.path)}: {self.error}"
+        text = (f"{self.name or self.executable} {self.version} ({self.build}), {self.bundle_id}; "
+                f"{self.extensions} extensions, {self.frameworks} frameworks, {self.files} files, "
+                f"{self.size / (1024 * 1024):.1f} MB unpacked")
+        if self.signer or self.team_name:
+            text += f"; signed by {self.signer or self.team_name}"
+            if self.team_id and self.team_id not in text:
+                text += f" ({self.team_id})"
+        else:
+            text += "; no provisioning profile"
+        return text
+
+
+def profile_plist(data):
+    """The XML plist inside a profile's CMS envelope, which stores it unencrypted"""
+    start = data.find(b"<?xml")
+    end = data.find(b"</plist>", start)
+    if start < 0 or end < 0:
+        raise ValueError("no plist found in profile")
+    return plistlib.loads(data[start:end + len(b"</plist>")])
+
+
+def certificate_name(der):
+    """Subject common name of a DER certificate, without a crypto library.
+
+    The subject comes after the issuer, so its commonName is the last one."""
+    index = der.rfind(COMMON_NAME_OID)
+    if index < 0:
+        return ""
+    start = index + len(COMMON_NAME_OID)
+    length = der[start + 1] if start + 1 < len(der) else 0
+    if length & 0x80:
+        return ""
+    return der[start + 2:start + 2 + length].decode("utf-8", errors="replace")
+
+
+def _apply_info_plist(app_info, info):
+    app_info.bundle_id = info.get("CFBundleIdentifier", "")
+    app_info.name = info.get("CFBundleDisplayName") or info.get("CFBundleName", "")
+    app_info.version = info.get("CFBundleShortVersionString", "")
+    app_info.build = info.get("CFBundleVersion", "")
+    app_info.executable = info.get("CFBundleExecutable", "")
+    app_info.min_os = info.get("MinimumOSVersion", "")
+
+
+def _apply_profile(app_info, data):
+    profile = profile_plist(data)
+    app_info.profile_name = profile.get("Name", "")
+    app_info.team_id = (profile.get("TeamIdentifier") or [""])[0]
+    app_info.team_name = profile.get("TeamName", "")
+    certificates = profile.get("DeveloperCertificates", [])
+    if certificates:
+        app_info.signer = certificate_name(certificates[0])
+    expires = profile.get("ExpirationDate")
+    if expires:
+        app_info.profile_expires = expires.replace(tzinfo=expires.tzinfo or timezone.utc).timestamp()
+
+
+def _count_bundles(app_info, names, app_prefix):
+    """Count top-level app extensions and frameworks from entry names"""
+    extensions, frameworks = set(), set()
+    for name in names:
+        if not name.startswith(app_prefix):
+            continue
+        parts = name[len(app_prefix):].split("/")
+        if len(parts) > 1 and parts[0] in ("PlugIns", "Extensions") and parts[1].endswith(".appex"):
+            extensions.add(parts[1])
+        elif len(parts) > 1 and parts[0] == "Frameworks" and parts[1].endswith(".framework"):
+            frameworks.add(parts[1])
+    app_info.extensions = len(extensions)
+    app_info.frameworks = len(frameworks)
+
+
+def app_prefix(names):
+    """The "Payload/Name.app/" folder of the app among an IPA's entry names, or "" """
+    for name in names:
+        parts = name.split("/")
+        if len(parts) == 3 and parts[0] == "Payload" and parts[1].endswith(".app") and parts[2] == "Info.plist":
+            return f"Payload/{parts[1]}/"
+    return ""
+
+
+class _MappedFile:
+    """File-like view of an mmap for zipfile, which wants seekable() (only
+    mmap objects from Python 3.13 have it)"""
+
+    def __init__(self, mapped):
+        self._mapped = mapped
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._mapped.seek(offset, whence)
+        return self._mapped.tell()
+
+    def tell(self):
+        return self._mapped.tell()
+
+    def read(self, size=-1):
+        return self._mapped.read(None if size is None or size < 0 else size)
+
+
+def read_ipa(path):
+    """Read an IPA's central directory and just the two entries needed.
+
+    The file is memory-mapped rather than read, so only the pages holding
+    the central directory, Info.plist and embedded.mobileprovision are ever
+    touched, however large the IPA is, and nothing is written to disk."""
+    app_info = AppInfo(path)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with zipfile.ZipFile(_MappedFile(mapped)) as z:
+            infos = z.infolist()
+            app_info.files = sum(1 for info in infos if not info.is_dir())
+            app_info.size = sum(info.file_size for info in infos)
+            app_prefix = ""
+            for info in infos:
+                parts = info.filename.split("/")
+                if len(parts) == 3 and parts[0] == "Payload" and parts[1].endswith(".app") and parts[2] == "Info.plist":
+                    app_prefix = f"Payload/{parts[1]}/"
+                    _apply_info_plist(app_info, plistlib.loads(z.read(info)))
+                    break
+            if not app_prefix:
+                raise ValueError("no Payload/*.app/Info.plist inside")
+            try:
+                _apply_profile(app_info, z.read(app_prefix + "embedded.mobileprovision"))
+            except (KeyError, ValueError):
+                pass
+            _count_bundles(app_info, z.namelist(), app_prefix)
+    return app_info
+
+
+def read_folder(path):
+    app_info = AppInfo(path)
+    if path.rstrip(os.sep).endswith(".app"):
+        app = path
+    else:
+        payload = os.path.join(path, "Payload")
+        root = payload if os.path.isdir(payload) else path
+        apps = sorted(name for name in os.listdir(root) if name.endswith(".app"))
+        if not apps:
+            raise ValueError("no .app inside")
+        app = os.path.join(root, apps[0])
+    with open(os.path.join(app, "Info.plist"), "rb") as f:
+        _apply_info_plist(app_info, plistlib.load(f))
+    try:
+        with open(os.path.join(app, "embedded.mobileprovision"), "rb") as f:
+            _apply_profile(app_info, f.read())
+    except (OSError, ValueError):
+        pass
+    names = []
+    for dirpath, dirnames, filenames in os.walk(app):
+        rel = os.path.relpath(dirpath, app).replace(os.sep, "/")
+        names.extend(f"{rel}/{name}/" for name in dirnames)
+        for name in filenames:
+            app_info.files += 1
+            try:
+                app_info.size += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    _count_bundles(app_info, (name[2:] if name.startswith("./") else name for name in names), "")
+    return app_info
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _cache_path():
+    return cache_dir(CACHE_FILE)
+
+
+def _load_cache():
+    global _cache
+    if _cache is None:
+        try:
+            with open(_cache_path()) as f:
+                data = json.load(f)
+            _cache = data.get("entries", {}) if data.get("version") == CACHE_VERSION else {}
+        except (OSError, ValueError, AttributeError):
+            _cache = {}
+    return _cache
+
+
+def _save_cache():
+    path = _cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": CACHE_VERSION, "entries": _cache}, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def read_app_info(path):
+    """AppInfo for an IPA or app folder, remembered per (path, size, mtime,
+    inode) for IPAs so later jobs and launches get it for free. Problems
+    reading the app end up in AppInfo.error rather than being raised."""
+    key = None
+    try:
+        if os.path.isfile(path):
+            st = os.stat(path)
+            key = f"{os.path.realpath(path)}|{st.st_size}|{st.st_mtime_ns}|{st.st_ino}"
+            with _cache_lock:
+                cached = _load_cache().get(key)
+            if cached:
+                known = {f.name for f in fields(AppInfo)}
+                return AppInfo(**{k: v for k, v in cached.items() if k in known})
+            app_info = read_ipa(path)
+        else:
+            app_info = read_folder(path)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile, plistlib.InvalidFileException) as e:
+        return AppInfo(path, error=str(e) or type(e).__name__)
+
+    if key:
+        with _cache_lock:
+            cache = _load_cache()
+            cache[key] = asdict(app_info)
+            while len(cache) > MAX_ENTRIES:
+                del cache[next(iter(cache))]
+            _save_cache()
+    return app_info
+
+
+def bundle_id_of(path):
+    """CFBundleIdentifier of the app in an IPA or app folder, or "" if unknown"""
+    return read_app_info(path).bundle_id
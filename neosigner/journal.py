@@ -0,0 +1,240 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, field, fields
+
+from .batch import PENDING, RUNNING, SUCCEEDED
+from .digest import file_digest
+from .engine import SignJob
+from .paths import data_dir
+from .workspace import pid_alive
+
+JOURNAL_FILE = "journal.sqlite3"
+
+# A job that was queued or running when its process died, once it has been queued again
+REQUEUED = "requeued"
+
+# Statuses of jobs whose process may have died before they finished
+UNFINISHED = (PENDING, RUNNING)
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    run TEXT NOT NULL DEFAULT '',
+    input_path TEXT NOT NULL,
+    output_path TEXT NOT NULL DEFAULT '',
+    bundle_id TEXT NOT NULL DEFAULT '',
+    job_key TEXT NOT NULL DEFAULT '',
+    job TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL,
+    pid INTEGER NOT NULL DEFAULT 0,
+    returncode INTEGER,
+    error TEXT NOT NULL DEFAULT '',
+    output_sha256 TEXT NOT NULL DEFAULT '',
+    output_size INTEGER NOT NULL DEFAULT 0,
+    started REAL NOT NULL,
+    finished REAL,
+    elapsed REAL NOT NULL DEFAULT 0,
+    stages TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (job_key, status);
+CREATE INDEX IF NOT EXISTS jobs_bundle ON jobs (bundle_id, status, finished);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+# SignJob fields that are never written to the journal
+SECRET_FIELDS = ("password",)
+
+
+@dataclass
+class JournalEntry:
+    """One signing job as the journal recorded it"""
+    id: int
+    input_path: str
+    output_path: str = ""
+    bundle_id: str = ""
+    job_key: str = ""
+    job: dict = field(default_factory=dict)
+    status: str = RUNNING
+    pid: int = 0
+    returncode: int = None
+    error: str = ""
+    output_sha256: str = ""
+    output_size: int = 0
+    started: float = 0.0
+    finished: float = None
+    elapsed: float = 0.0
+    stages: dict = field(default_factory=dict)
+    run: str = ""
+
+    def __str__(self):
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(self.finished or self.started))
+        text = f"{when} {self.status:<9} {self.bundle_id or '?'} {os.path.basename(self.input_path)}"
+        if self.output_path:
+            text += f" -> {self.output_path}"
+        if self.elapsed:
+            text += f" ({self.elapsed:.1f}s)"
+        if self.error:
+            text += f": {self.error}"
+        return text
+
+    def sign_job(self, password=""):
+        """The SignJob this entry recorded, with every option it was run with"""
+        known = {f.name for f in fields(SignJob)}
+        job = SignJob(**{k: v for k, v in self.job.items() if k in known})
+        job.password = password
+        return job
+
+
+class Journal:
+    """Every signing job in a SQLite database, written as each one starts
+    and finishes so a crash loses nothing that was already signed.
+
+    A job is identified by its cache key, the hash of every input and option
+    that affects the signed app, so a batch that is run again can skip the
+    jobs whose output is still there with the same checksum. Database errors
+    are raised as OSError, like the other stores' write errors."""
+
+    def __init__(self, path=None):
+        self.path = path or data_dir(JOURNAL_FILE)
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            # WAL lets the GUI, CLI and watcher write at once; NORMAL still
+            # survives a crash of the process, only a power cut can lose the last job
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                db.executescript(SCHEMA)
+                db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self._db = db
+        return self._db
+
+    def _execute(self, sql, params=()):
+        """Run one statement and return its rows, or for an INSERT the new row's ID"""
+        with self._lock:
+            try:
+                cursor = self._connect().execute(sql, params)
+                return cursor.lastrowid if sql.startswith("INSERT") else cursor.fetchall()
+            except sqlite3.Error as e:
+                raise OSError(f"journal {self.path}: {str(e)}")
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def queue(self, job, key="", bundle_id="", run=""):
+        """Record that a job is waiting to start and return its entry ID, so
+        it can be resumed even if the process dies before it gets to run"""
+        return self._insert(job, key, bundle_id, run, PENDING)
+
+    def start(self, job, key="", bundle_id="", run="", entry_id=None):
+        """Record that a job is starting and return its entry ID; entry_id
+        is the entry queue() returned for it, if any, which gets the key and
+        bundle ID now"""
+        if entry_id is None:
+            return self._insert(job, key, bundle_id, run, RUNNING)
+        self._requeue_dead(job, key)
+        self._execute("UPDATE jobs SET status = ?, pid = ?, started = ?, job_key = ?, bundle_id = ? WHERE id = ?",
+                      (RUNNING, os.getpid(), time.time(), key, bundle_id or job.bundle_id, entry_id))
+        return entry_id
+
+    def discard(self, entry_id):
+        """Forget a queued entry whose job turned out not to need running"""
+        self._execute("DELETE FROM jobs WHERE id = ?", (entry_id,))
+
+    def _requeue_dead(self, job, key):
+        """The same job left unfinished by a run that died is being redone now"""
+        if not key:
+            return
+        output_path = os.path.abspath(job.output_path) if job.output_path else ""
+        rows = self._execute(
+            "SELECT id, pid FROM jobs WHERE job_key = ? AND output_path = ? AND status IN (?, ?)",
+            (key, output_path, *UNFINISHED))
+        self.requeued(row["id"] for row in rows if not pid_alive(row["pid"]))
+
+    def _insert(self, job, key, bundle_id, run, status):
+        output_path = os.path.abspath(job.output_path) if job.output_path else ""
+        self._requeue_dead(job, key)
+        options = {k: v for k, v in asdict(job).items() if k not in SECRET_FIELDS}
+        return self._execute(
+            "INSERT INTO jobs (run, input_path, output_path, bundle_id, job_key, job, status, pid, started) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (run, os.path.abspath(job.input_path), output_path,
+             bundle_id or job.bundle_id, key, json.dumps(options), status, os.getpid(), time.time()))
+
+    def finish(self, entry_id, status, returncode=None, error="", output_path="", elapsed=0.0, stages=None):
+        """Record how a job ended, with the checksum of what it wrote if it succeeded"""
+        sha256, size = "", 0
+        if status == SUCCEEDED and output_path and os.path.isfile(output_path):
+            sha256, size = file_digest(output_path), os.path.getsize(output_path)
+        self._execute(
+            "UPDATE jobs SET status = ?, returncode = ?, error = ?, output_sha256 = ?, output_size = ?, "
+            "finished = ?, elapsed = ?, stages = ? WHERE id = ?",
+            (status, returncode, error, sha256, size, time.time(), round(elapsed, 4),
+             json.dumps(stages or {}), entry_id))
+
+    def completed(self, key, output_path):
+        """The latest successful entry for key whose output is still at
+        output_path with the checksum it was written with, or None"""
+        rows = self._execute(
+            "SELECT * FROM jobs WHERE job_key = ? AND status = ? AND output_path = ? ORDER BY id DESC LIMIT 1",
+            (key, SUCCEEDED, os.path.abspath(output_path)))
+        if not rows or not rows[0]["output_sha256"]:
+            return None
+        entry = _entry(rows[0])
+        try:
+            # The digest memo makes this a stat() unless the file has changed
+            if file_digest(output_path) != entry.output_sha256:
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def interrupted(self):
+        """Entries left queued or running by a process that has since exited, oldest first"""
+        rows = self._execute("SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY id", UNFINISHED)
+        return [_entry(row) for row in rows if row["pid"] != os.getpid() and not pid_alive(row["pid"])]
+
+    def requeued(self, entry_ids):
+        """Mark interrupted entries as queued again, so they're only picked up once"""
+        for entry_id in entry_ids:
+            self._execute("UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status IN (?, ?)",
+                          (REQUEUED, time.time(), entry_id, *UNFINISHED))
+
+    def last_success(self, bundle_id):
+        """The most recent successful signing of bundle_id, or None"""
+        rows = self._execute(
+            "SELECT * FROM jobs WHERE bundle_id = ? AND status = ? ORDER BY finished DESC LIMIT 1",
+            (bundle_id, SUCCEEDED))
+        return _entry(rows[0]) if rows else None
+
+    def history(self, limit=20, bundle_id="", status=""):
+        """The latest entries, newest first, optionally for one bundle ID or status"""
+        conditions, params = [], []
+        if bundle_id:
+            conditions.append("bundle_id = ?")
+            params.append(bundle_id)
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._execute(f"SELECT * FROM jobs {where} ORDER BY id DESC LIMIT ?", params + [limit])
+        return [_entry(row) for row in rows]
+
+
+def _entry(row):
+    values = dict(row)
+    values["job"] = json.loads(values["job"] or "{}")
+    values["stages"] = json.loads(values["stages"] or "{}")
+    return JournalEntry(**values)
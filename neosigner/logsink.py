@@ -0,0 +1,113 @@
+import logging
+import logging.handlers
+import os
+from collections import deque
+
+DEFAULT_MAX_LINES = 5000
+DEFAULT_FLUSH_MS = 50
+
+
+class LogSink:
+    """Feed log lines into a Tk Text widget in batches.
+
+    Lines are collected in a ring buffer and written to the widget at most
+    once every flush_ms, and the widget is trimmed to the newest max_lines,
+    so redraw cost and memory stay flat however much zsign prints. Every
+    line can also be mirrored to a rotating log file."""
+
+    def __init__(self, widget, max_lines=DEFAULT_MAX_LINES, flush_ms=DEFAULT_FLUSH_MS):
+        self.widget = widget
+        self.max_lines = max_lines
+        self.flush_ms = flush_ms
+        self.pending = deque(maxlen=max_lines)
+        self.line_count = 0
+        self.dropped = 0
+        self._file_lines = []
+        self._file_logger = None
+        self._scheduled = None
+
+    def write(self, text):
+        """Queue text (which may hold several lines) for the next flush"""
+        lines = text.split("\n")
+        if len(self.pending) + len(lines) > self.max_lines:
+            self.dropped += len(self.pending) + len(lines) - self.max_lines
+        self.pending.extend(lines)
+        if self._file_logger:
+            self._file_lines.extend(lines)
+        self._schedule()
+
+    def _schedule(self):
+        if self._scheduled is None:
+            self._scheduled = self.widget.after(self.flush_ms, self.flush)
+
+    def flush(self):
+        """Write every queued line to the widget (and log file) right away"""
+        if self._scheduled is not None:
+            self.widget.after_cancel(self._scheduled)
+            self._scheduled = None
+
+        if self._file_lines:
+            self._file_logger.info("\n".join(self._file_lines))
+            self._file_lines = []
+
+        if not self.pending and self.line_count <= self.max_lines:
+            return
+        lines = list(self.pending)
+        self.pending.clear()
+        if self.dropped:
+            # The marker takes the place of the oldest line so it survives trimming
+            lines[0] = f"... {self.dropped + 1} lines not shown ..."
+            self.dropped = 0
+
+        # Only follow the output if the user hasn't scrolled up to read something
+        at_bottom = self.widget.yview()[1] >= 0.999
+
+        self.widget.config(state="normal")
+        if lines:
+            self.widget.insert("end", "\n".join(lines) + "\n")
+            self.line_count += len(lines)
+        if self.line_count > self.max_lines:
+            excess = self.line_count - self.max_lines
+            self.widget.delete("1.0", f"{excess + 1}.0")
+            self.line_count = self.max_lines
+        if at_bottom:
+            self.widget.see("end")
+        self.widget.config(state="disabled")
+
+    def clear(self):
+        self.pending.clear()
+        self.dropped = 0
+        self.line_count = 0
+        self.widget.config(state="normal")
+        self.widget.delete("1.0", "end")
+        self.widget.config(state="disabled")
+
+    def set_max_lines(self, max_lines):
+        """Change the line cap, trimming the widget on the next flush"""
+        self.max_lines = max(1, max_lines)
+        self.pending = deque(self.pending, maxlen=self.max_lines)
+        self._schedule()
+
+    def open_file(self, path, max_bytes=5 * 1024 * 1024, backups=3):
+        """Mirror every line to path, rotating it once it reaches max_bytes"""
+        self.close_file()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes,
+                                                       backupCount=backups, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger = logging.getLogger(f"neosigner.logsink.{id(self)}")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(handler)
+        self._file_logger = logger
+
+    def close_file(self):
+        if not self._file_logger:
+            return
+        if self._file_lines:
+            self._file_logger.info("\n".join(self._file_lines))
+            self._file_lines = []
+        for handler in list(self._file_logger.handlers):
+            self._file_logger.removeHandler(handler)
+            handler.close()
+        self._file_logger = None
@@ -0,0 +1,264 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+from .paths import log_dir
+
+# Set to also keep a Prometheus textfile (for node_exporter's textfile
+# collector) up to date with totals from every job
+TEXTFILE_ENV = "NEOSIGNER_METRICS_TEXTFILE"
+
+METRICS_FILE = "metrics.jsonl"
+MAX_FILE_BYTES = 50 * 1024 * 1024
+
+# zsign prints a line as each phase finishes, e.g. ">>> Unzip OK! (1.234s)"
+PHASE_PATTERN = re.compile(r">>>\s*(Unzip|Sign|Signed|Archive|Install)\w*\s+OK", re.IGNORECASE)
+DURATION_PATTERN = re.compile(r"\(\s*([\d.]+)\s*s\s*\)")
+PHASE_NAMES = {"unzip": "unzip", "sign": "sign", "signed": "sign", "archive": "archive", "install": "install"}
+
+# Upper bounds, in seconds, of the job duration histogram buckets
+DURATION_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+
+@dataclass
+class JobRecord:
+    """Timings and sizes for one signing job, written as one JSON line"""
+    input: str = ""
+    output: str = ""
+    bundle_id: str = ""
+    certificate: str = ""
+    time: str = ""
+    returncode: int = None
+    cached: bool = False
+    bytes_in: int = 0
+    bytes_out: int = 0
+    total_seconds: float = 0.0
+    # "fast" or "disk" when a ScratchPolicy chose where the app was unpacked
+    scratch: str = ""
+    # What slimming took out before signing, and about how much time that saved
+    slimmed_files: int = 0
+    slimmed_bytes: int = 0
+    slim_saved_seconds: float = 0.0
+    # Compressed files copied from the app's last signed IPA instead of deflated again
+    reused_files: int = 0
+    reused_bytes: int = 0
+    stages: dict = field(default_factory=dict)
+
+    @classmethod
+    def for_job(cls, job):
+        return cls(
+            input=job.input_path,
+            output=job.output_path,
+            bundle_id=job.bundle_id,
+            certificate="ad-hoc" if job.adhoc else os.path.basename(job.pkey),
+            time=time.strftime("%Y-%m-%dT%H:%M:%S")
+        )
+
+    def add(self, stage, seconds):
+        self.stages[stage] = round(self.stages.get(stage, 0.0) + seconds, 4)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def summary(self):
+        stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.stages.items())
+        where = f" (unpacked on {self.scratch} scratch)" if self.scratch else ""
+        text = f"Timings: {stages}; total {self.total_seconds:.2f}s{where}"
+        if self.slimmed_files:
+            text += (f"; slimming removed {self.slimmed_files} files ({self.slimmed_bytes / (1024 * 1024):.2f} MB), "
+                     f"saving about {self.slim_saved_seconds:.1f}s")
+        if self.reused_files:
+            text += (f"; reused {self.reused_files} compressed files "
+                     f"({self.reused_bytes / (1024 * 1024):.2f} MB) from the last signing")
+        return text
+
+
+class PhaseTracker:
+    """Turn zsign's progress lines into per-phase timings.
+
+    Uses the duration zsign prints where there is one, and otherwise the
+    time since the previous phase finished."""
+
+    def __init__(self, record):
+        self.record = record
+        self.started = None
+        self.last_mark = None
+        self.phases = []
+
+    def start(self):
+        self.started = self.last_mark = time.monotonic()
+
+    def line(self, text):
+        match = PHASE_PATTERN.search(text)
+        if not match or self.started is None:
+            return
+        now = time.monotonic()
+        phase = PHASE_NAMES[match.group(1).lower()]
+        duration = DURATION_PATTERN.search(text[match.end():])
+        self.record.add(phase, float(duration.group(1)) if duration else now - self.last_mark)
+        self.phases.append(phase)
+        self.last_mark = now
+
+    def exit(self, install=False):
+        if self.started is None:
+            return
+        now = time.monotonic()
+        # zsign -i installs after archiving without a line of its own
+        if install and self.phases and "install" not in self.phases:
+            self.record.add("install", now - self.last_mark)
+        self.record.add("zsign", now - self.started)
+
+
+class MetricsWriter:
+    """Append JobRecords to a JSON lines file and, optionally, keep a
+    Prometheus textfile with running totals.
+
+    The totals are kept in a small JSON file next to the textfile so they
+    keep counting across runs, as Prometheus expects of counters. Each
+    update reloads them under a lock file, so the GUI, batch, watch and
+    service processes can share one textfile without undoing each other's
+    counts."""
+
+    def __init__(self, path=None, textfile=None):
+        self.path = path or log_dir(METRICS_FILE)
+        self.textfile = textfile if textfile is not None else os.environ.get(TEXTFILE_ENV, "")
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(asdict(record))
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            try:
+                if os.path.getsize(self.path) > MAX_FILE_BYTES:
+                    os.replace(self.path, f"{self.path}.1")
+            except OSError:
+                pass
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+            if self.textfile:
+                self._update_textfile(record)
+
+    def _state_path(self):
+        return f"{self.textfile}.state.json"
+
+    def _load_totals(self):
+        try:
+            with open(self._state_path()) as f:
+                totals = json.load(f)
+        except (OSError, ValueError):
+            totals = {}
+        for key in ("jobs", "stage_seconds", "stage_count"):
+            totals.setdefault(key, {})
+        totals.setdefault("buckets", [0] * (len(DURATION_BUCKETS) + 1))
+        for key in ("bytes_in", "bytes_out", "duration_sum"):
+            totals.setdefault(key, 0)
+        return totals
+
+    def _update_textfile(self, record):
+        os.makedirs(os.path.dirname(os.path.abspath(self.textfile)), exist_ok=True)
+        with _file_lock(f"{self.textfile}.lock"):
+            totals = self._load_totals()
+            _add_record(totals, record)
+            _write_atomic(self._state_path(), json.dumps(totals))
+            _write_atomic(self.textfile, render_prometheus(totals))
+
+
+def _add_record(totals, record):
+    result = "cached" if record.cached else ("ok" if record.returncode == 0 else "failed")
+    totals["jobs"][result] = totals["jobs"].get(result, 0) + 1
+    for stage, seconds in record.stages.items():
+        totals["stage_seconds"][stage] = totals["stage_seconds"].get(stage, 0.0) + seconds
+        totals["stage_count"][stage] = totals["stage_count"].get(stage, 0) + 1
+    totals["bytes_in"] += record.bytes_in
+    totals["bytes_out"] += record.bytes_out
+    totals["duration_sum"] += record.total_seconds
+    for i, bound in enumerate(DURATION_BUCKETS):
+        if record.total_seconds <= bound:
+            totals["buckets"][i] += 1
+            break
+    else:
+        totals["buckets"][-1] += 1
+
+
+def render_prometheus(totals):
+    lines = [
+        "# HELP neosigner_jobs_total Signing jobs by result.",
+        "# TYPE neosigner_jobs_total counter",
+    ]
+    for result, count in sorted(totals["jobs"].items()):
+        lines.append(f'neosigner_jobs_total{{result="{result}"}} {count}')
+
+    lines += [
+        "# HELP neosigner_stage_seconds_total Time spent in each stage of signing.",
+        "# TYPE neosigner_stage_seconds_total counter",
+    ]
+    for stage, seconds in sorted(totals["stage_seconds"].items()):
+        lines.append(f'neosigner_stage_seconds_total{{stage="{stage}"}} {seconds:.4f}')
+    lines += [
+        "# HELP neosigner_stage_runs_total Jobs that went through each stage.",
+        "# TYPE neosigner_stage_runs_total counter",
+    ]
+    for stage, count in sorted(totals["stage_count"].items()):
+        lines.append(f'neosigner_stage_runs_total{{stage="{stage}"}} {count}')
+
+    lines += [
+        "# HELP neosigner_bytes_total Bytes read from input IPAs and written to signed ones.",
+        "# TYPE neosigner_bytes_total counter",
+        f'neosigner_bytes_total{{direction="in"}} {totals["bytes_in"]}',
+        f'neosigner_bytes_total{{direction="out"}} {totals["bytes_out"]}',
+        "# HELP neosigner_job_duration_seconds Wall time of signing jobs.",
+        "# TYPE neosigner_job_duration_seconds histogram",
+    ]
+    cumulative = 0
+    for bound, count in zip(DURATION_BUCKETS, totals["buckets"]):
+        cumulative += count
+        lines.append(f'neosigner_job_duration_seconds_bucket{{le="{bound}"}} {cumulative}')
+    cumulative += totals["buckets"][-1]
+    lines.append(f'neosigner_job_duration_seconds_bucket{{le="+Inf"}} {cumulative}')
+    lines.append(f"neosigner_job_duration_seconds_sum {totals['duration_sum']:.4f}")
+    lines.append(f"neosigner_job_duration_seconds_count {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def _file_lock(path):
+    """Hold an exclusive lock on path, shared with other processes"""
+    with open(path, "a") as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        elif msvcrt:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            elif msvcrt:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _write_atomic(path, text):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
@@ -0,0 +1,193 @@
+import os
+import plistlib
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+
+# Same variable libimobiledevice reads, e.g. "UNIX:/var/run/usbmuxd" or "127.0.0.1:27015"
+SOCKET_ENV = "USBMUXD_SOCKET_ADDRESS"
+DEFAULT_SOCKET = "/var/run/usbmuxd"
+DEFAULT_PORT = 27015
+
+# How often idevice_id is asked when usbmuxd can't be subscribed to
+DEFAULT_POLL_SECONDS = 2.0
+
+# usbmuxd sends an Attached event for each device already connected right
+# after subscribing; they're reported together once it goes quiet this long
+SETTLE_SECONDS = 0.25
+
+PLIST_MESSAGE = 8
+HEADER = struct.Struct("<IIII")
+
+LISTENING = "usbmuxd"
+POLLING = "polling"
+
+
+def usbmuxd_address():
+    """(family, address) of usbmuxd's socket on this machine"""
+    value = os.environ.get(SOCKET_ENV, "")
+    if value.startswith("UNIX:"):
+        return socket.AF_UNIX, value[5:]
+    if value:
+        host, _, port = value.rpartition(":")
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    if sys.platform == "win32":
+        return socket.AF_INET, ("127.0.0.1", DEFAULT_PORT)
+    return socket.AF_UNIX, DEFAULT_SOCKET
+
+
+def _recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("usbmuxd closed the connection")
+        data += chunk
+    return data
+
+
+class DeviceMonitor:
+    """Keep track of which devices are connected, cheaply.
+
+    Subscribes to usbmuxd's attach/detach events where it can, and otherwise
+    polls 'idevice_id -l', which only asks usbmuxd for its device list. The
+    current UDIDs are cached, so checking for a device costs nothing, and
+    on_change(udids) is called from the monitor's thread when they change."""
+
+    def __init__(self, idevice_id_path=None, on_change=None, poll_seconds=DEFAULT_POLL_SECONDS,
+                 use_usbmuxd=True):
+        self.idevice_id_path = idevice_id_path
+        self.on_change = on_change
+        self.poll_seconds = poll_seconds
+        self.use_usbmuxd = use_usbmuxd
+        self.mode = None
+        self._udids = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._socket = None
+        self._thread = None
+
+    @property
+    def known(self):
+        """True once the monitor has found out which devices are connected"""
+        with self._lock:
+            return self._udids is not None
+
+    @property
+    def udids(self):
+        with self._lock:
+            return list(self._udids or ())
+
+    @property
+    def connected(self):
+        return bool(self.udids)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="device-monitor", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        sock = self._socket
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread:
+            self._thread.join(timeout=2)
+
+    def _set(self, udids):
+        with self._lock:
+            if udids == self._udids:
+                return
+            self._udids = list(udids)
+        if self.on_change:
+            self.on_change(list(udids))
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.use_usbmuxd:
+                try:
+                    self._listen()
+                except (OSError, ValueError, plistlib.InvalidFileException):
+                    pass
+                if self._stop.is_set():
+                    break
+            if not self.poll():
+                self.mode = None
+            self._stop.wait(self.poll_seconds)
+
+    def poll(self):
+        """Ask idevice_id for the connected devices; False if it can't be run"""
+        if not self.idevice_id_path:
+            return False
+        try:
+            result = subprocess.run([self.idevice_id_path, "-l"],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL,
+                                    text=True,
+                                    timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        if result.returncode != 0:
+            return False
+        udids = []
+        for line in result.stdout.splitlines():
+            udid = line.split()[0] if line.strip() else ""
+            if udid and udid not in udids:
+                udids.append(udid)
+        self.mode = POLLING
+        self._set(udids)
+        return True
+
+    def _listen(self):
+        """Subscribe to usbmuxd and follow attach/detach events until the
+        connection drops or stop() is called"""
+        family, address = usbmuxd_address()
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(2)
+        try:
+            sock.connect(address)
+            sock.settimeout(None)
+            self._socket = sock
+            payload = plistlib.dumps({
+                "MessageType": "Listen",
+                "ClientVersionString": "neosigner",
+                "ProgName": "neosigner",
+                "kLibUSBMuxVersion": 3,
+            })
+            sock.sendall(HEADER.pack(HEADER.size + len(payload), 1, PLIST_MESSAGE, 1) + payload)
+
+            attached = {}
+            settling = False
+            while not self._stop.is_set():
+                if settling and not select.select([sock], [], [], SETTLE_SECONDS)[0]:
+                    # The devices that were already connected have all been announced
+                    settling = False
+                    self._set(list(attached.values()))
+                    continue
+                length, _, _, _ = HEADER.unpack(_recv_exact(sock, HEADER.size))
+                message = plistlib.loads(_recv_exact(sock, length - HEADER.size))
+                kind = message.get("MessageType")
+                if kind == "Result":
+                    if message.get("Number", 0) != 0:
+                        raise ConnectionError(f"usbmuxd refused Listen: {message.get('Number')}")
+                    self.mode = LISTENING
+                    settling = True
+                elif kind == "Attached":
+                    properties = message.get("Properties", {})
+                    if properties.get("ConnectionType", "USB") == "USB":
+                        attached[message.get("DeviceID")] = properties.get("SerialNumber", "")
+                        if not settling:
+                            self._set(list(attached.values()))
+                elif kind == "Detached":
+                    if attached.pop(message.get("DeviceID"), None) is not None and not settling:
+                        self._set(list(attached.values()))
+        finally:
+            self._socket = None
+            sock.close()
@@ -0,0 +1,409 @@
+import os
+import stat
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+DEFAULT_LEVEL = 9
+
+# Formats that are compressed already; deflating them again costs CPU and
+# saves next to nothing, so they are stored as-is
+STORED_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".heic", ".car",
+    ".mp4", ".m4v", ".mov", ".mp3", ".m4a", ".aac", ".caf",
+    ".zip", ".gz", ".bz2", ".xz", ".lzma", ".ipa", ".jar", ".ktx", ".astc",
+}
+
+# Files above CHUNK_SIZE are deflated in pieces on several cores. Each piece
+# is primed with the 32 KB before it, so the ratio barely changes.
+CHUNK_SIZE = 4 * 1024 * 1024
+WINDOW_SIZE = 32 * 1024
+
+# Smaller files are sent to the pool in batches of up to CHUNK_SIZE bytes,
+# since apps often hold thousands of tiny files
+BATCH_MAX_FILES = 512
+MAX_PENDING_ENTRIES = 10000
+COPY_BUFFER = 1024 * 1024
+
+# Sizes, offsets and counts from these on go in ZIP64 records, with the
+# marker value in their usual field
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+ZIP64_MARKER = 0xFFFFFFFF
+ZIP64_COUNT_MARKER = 0xFFFF
+UTF8_FLAG = 0x800
+STORED = 0
+DEFLATED = 8
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+@dataclass
+class PackResult:
+    files: int = 0
+    stored: int = 0
+    raw_bytes: int = 0
+    packed_bytes: int = 0
+    elapsed: float = 0.0
+    reused: int = 0
+
+    def __str__(self):
+        reused = f", {self.reused} reused" if self.reused else ""
+        return (f"{self.files} files ({self.stored} stored{reused}) in {self.elapsed:.1f}s, "
+                f"{self.raw_bytes / (1024 * 1024):.2f} MB -> {self.packed_bytes / (1024 * 1024):.2f} MB")
+
+
+def shared_pool():
+    """One process pool for every packaging run, so concurrent jobs share
+    the cores instead of each starting a pool of their own"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _pool
+
+
+def deflate_pieces(pieces, level):
+    """Deflate each (path, offset, length, final) piece; runs in a worker"""
+    return [deflate_chunk(*piece, level) for piece in pieces]
+
+
+def deflate_chunk(path, offset, length, final, level):
+    """Raw-deflate length bytes of path starting at offset.
+
+    Non-final chunks end on a sync flush so the pieces concatenate into one
+    valid deflate stream."""
+    with open(path, "rb") as f:
+        zdict = b""
+        if offset:
+            start = max(0, offset - WINDOW_SIZE)
+            f.seek(start)
+            zdict = f.read(offset - start)
+        data = f.read(length)
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    out = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    return zlib.crc32(data), len(data), out
+
+
+def _gf2_times(matrix, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= matrix[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+def crc32_combine(crc1, crc2, len2):
+    """CRC-32 of A + B given crc32(A), crc32(B) and len(B), as in zlib"""
+    if len2 <= 0:
+        return crc1
+    if not crc1:
+        # Shifting zeros through the CRC register leaves them zero
+        return crc2
+    odd = [0xEDB88320] + [1 << i for i in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    while True:
+        even = _gf2_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+
+def dos_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def walk_entries(src):
+    """Yield (arcname, path, stat) for everything under src in a stable order,
+    folders before their contents and without following symlinks"""
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, src)
+        prefix = "" if rel_dir == "." else rel_dir.replace(os.sep, "/") + "/"
+        if prefix:
+            yield prefix, dirpath, os.lstat(dirpath)
+        links = [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]
+        for name in links:
+            dirnames.remove(name)
+        for name in sorted(filenames + links):
+            path = os.path.join(dirpath, name)
+            yield prefix + name, path, os.lstat(path)
+
+
+class ZipWriter:
+    """Minimal zip writer that takes entries already compressed elsewhere.
+
+    Writes ZIP64 records only where sizes, offsets or the entry count need
+    them, so ordinary IPAs stay readable by every unzip tool."""
+
+    def __init__(self, f):
+        self.f = f
+        self.records = []
+
+    def _local_header(self, name, flags, method, mtime, crc, csize, usize, zip64):
+        dtime, ddate = dos_time(mtime)
+        extra = b""
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, usize, csize)
+            csize = usize = ZIP64_MARKER
+        return struct.pack("<IHHHHHIIIHH", 0x04034B50, 45 if zip64 else 20, flags, method,
+                           dtime, ddate, crc, csize, usize, len(name), len(extra)) + name + extra
+
+    def add(self, arcname, st, method, crc, usize, chunks):
+        """Write one entry whose (possibly compressed) data is the bytes in chunks"""
+        name = arcname.encode("utf-8")
+        flags = UTF8_FLAG if not arcname.isascii() else 0
+        csize = sum(len(chunk) for chunk in chunks)
+        zip64 = usize >= ZIP64_LIMIT or csize >= ZIP64_LIMIT
+        offset = self.f.tell()
+        self.f.write(self._local_header(name, flags, method, st.st_mtime, crc, csize, usize, zip64))
+        for chunk in chunks:
+            self.f.write(chunk)
+        self.records.append((name, flags, method, st, crc, csize, usize, offset))
+        return csize
+
+    def add_stream(self, arcname, st, method, crc, csize, usize, src):
+        """Write one entry whose csize bytes of (possibly compressed) data are
+        read from src, e.g. an entry copied from another zip as it is"""
+        name = arcname.encode("utf-8")
+        flags = UTF8_FLAG if not arcname.isascii() else 0
+        zip64 = usize >= ZIP64_LIMIT or csize >= ZIP64_LIMIT
+        offset = self.f.tell()
+        self.f.write(self._local_header(name, flags, method, st.st_mtime, crc, csize, usize, zip64))
+        left = csize
+        while left:
+            block = src.read(min(left, COPY_BUFFER))
+            if not block:
+                raise OSError(f"{arcname} is cut short")
+            self.f.write(block)
+            left -= len(block)
+        self.records.append((name, flags, method, st, crc, csize, usize, offset))
+        return csize
+
+    def add_file(self, arcname, path, st):
+        """Store a file uncompressed, streaming it from disk"""
+        name = arcname.encode("utf-8")
+        flags = UTF8_FLAG if not arcname.isascii() else 0
+        size = st.st_size
+        zip64 = size >= ZIP64_LIMIT
+        offset = self.f.tell()
+        self.f.write(self._local_header(name, flags, STORED, st.st_mtime, 0, size, size, zip64))
+        crc = 0
+        with open(path, "rb") as src:
+            for block in iter(lambda: src.read(COPY_BUFFER), b""):
+                crc = zlib.crc32(block, crc)
+                self.f.write(block)
+        end = self.f.tell()
+        # The CRC is only known once the data is written, so patch it in
+        self.f.seek(offset + 14)
+        self.f.write(struct.pack("<I", crc))
+        self.f.seek(end)
+        self.records.append((name, flags, STORED, st, crc, size, size, offset))
+        return size
+
+    def close(self):
+        cd_offset = self.f.tell()
+        for name, flags, method, st, crc, csize, usize, offset in self.records:
+            dtime, ddate = dos_time(st.st_mtime)
+            extra_fields = []
+            if usize >= ZIP64_LIMIT:
+                extra_fields.append(usize)
+                usize = ZIP64_MARKER
+            if csize >= ZIP64_LIMIT:
+                extra_fields.append(csize)
+                csize = ZIP64_MARKER
+            if offset >= ZIP64_LIMIT:
+                extra_fields.append(offset)
+                offset = ZIP64_MARKER
+            extra = b""
+            if extra_fields:
+                extra = struct.pack(f"<HH{len(extra_fields)}Q", 1, 8 * len(extra_fields), *extra_fields)
+            version = 45 if extra_fields else 20
+            external = (st.st_mode & 0xFFFF) << 16
+            if stat.S_ISDIR(st.st_mode):
+                external |= 0x10
+            self.f.write(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014B50, (3 << 8) | version, version,
+                                     flags, method, dtime, ddate, crc, csize, usize, len(name),
+                                     len(extra), 0, 0, 0, external, offset) + name + extra)
+
+        cd_size = self.f.tell() - cd_offset
+        count = len(self.records)
+        if count >= ZIP64_COUNT_LIMIT or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            eocd64 = self.f.tell()
+            self.f.write(struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, (3 << 8) | 45, 45, 0, 0,
+                                     count, count, cd_size, cd_offset))
+            self.f.write(struct.pack("<IIQI", 0x07064B50, 0, eocd64, 1))
+            count = min(count, ZIP64_COUNT_MARKER)
+            cd_size = min(cd_size, ZIP64_MARKER)
+            cd_offset = min(cd_offset, ZIP64_MARKER)
+        self.f.write(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, count, count, cd_size, cd_offset, 0))
+
+
+def _is_stored(arcname, st, level, stored_extensions):
+    return level == 0 or not st.st_size or os.path.splitext(arcname)[1].lower() in stored_extensions
+
+
+class _Batch:
+    def __init__(self):
+        self.pieces = []
+        self.size = 0
+        self.future = None
+
+
+def pack_folder(src, output_path, level=DEFAULT_LEVEL, stored_extensions=STORED_EXTENSIONS, on_progress=None,
+                index=None):
+    """Zip the contents of src into output_path, deflating files on every core.
+
+    Files are compressed out of order by the shared process pool but written
+    in order, with only a bounded amount of data held in memory at once.
+    With an incremental.PackIndex, files unchanged since the last signing
+    of the app are copied from its IPA still compressed, and the index is
+    updated with the new entries. Returns a PackResult."""
+    start = time.monotonic()
+    result = PackResult()
+    pool = shared_pool() if level else None
+    window = 4 * (os.cpu_count() or 1) * CHUNK_SIZE
+    entries = iter(walk_entries(src))
+    pending = deque()
+    in_flight = 0
+    open_batch = None
+
+    def submit(batch):
+        nonlocal open_batch
+        batch.future = pool.submit(deflate_pieces, batch.pieces, level)
+        if batch is open_batch:
+            open_batch = None
+
+    def add_piece(piece):
+        nonlocal open_batch
+        if open_batch is None:
+            open_batch = _Batch()
+        batch = open_batch
+        batch.pieces.append(piece)
+        batch.size += piece[2]
+        if batch.size >= CHUNK_SIZE or len(batch.pieces) >= BATCH_MAX_FILES:
+            submit(batch)
+        return batch, len(batch.pieces) - 1
+
+    def queue_next():
+        nonlocal in_flight
+        try:
+            arcname, path, st = next(entries)
+        except StopIteration:
+            return False
+        pieces = None
+        if stat.S_ISREG(st.st_mode) and not _is_stored(arcname, st, level, stored_extensions):
+            reuse = index.match(arcname, path, st) if index else None
+            if reuse:
+                pending.append((arcname, path, st, reuse))
+                return True
+            pieces = []
+            for offset in range(0, st.st_size, CHUNK_SIZE):
+                length = min(CHUNK_SIZE, st.st_size - offset)
+                pieces.append(add_piece((path, offset, length, offset + length >= st.st_size)))
+            in_flight += st.st_size
+        pending.append((arcname, path, st, pieces))
+        return True
+
+    tmp = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            writer = ZipWriter(f)
+            more = True
+            while more or pending:
+                while more and in_flight < window and len(pending) < MAX_PENDING_ENTRIES:
+                    more = queue_next()
+                if not pending:
+                    continue
+                arcname, path, st, pieces = pending.popleft()
+                if isinstance(pieces, tuple):
+                    index.copy(writer, arcname, st, pieces)
+                    result.files += 1
+                    result.reused += 1
+                    result.raw_bytes += st.st_size
+                    if on_progress:
+                        on_progress(result)
+                    continue
+                chunks = None
+                if pieces is not None:
+                    in_flight -= st.st_size
+                    chunks = []
+                    for batch, position in pieces:
+                        if batch.future is None:
+                            submit(batch)
+                        chunks.append(batch.future.result()[position])
+                _write_entry(writer, arcname, path, st, chunks, result)
+                if on_progress:
+                    on_progress(result)
+            writer.close()
+        os.replace(tmp, output_path)
+        if index:
+            index.update(writer.records)
+    except BaseException:
+        for _, _, _, pieces in pending:
+            for batch, _ in pieces if isinstance(pieces, list) else ():
+                if batch.future:
+                    batch.future.cancel()
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+    result.packed_bytes = os.path.getsize(output_path)
+    result.elapsed = time.monotonic() - start
+    return result
+
+
+def _write_entry(writer, arcname, path, st, chunks, result):
+    if stat.S_ISDIR(st.st_mode):
+        writer.add(arcname, st, STORED, 0, 0, [])
+        return
+    if stat.S_ISLNK(st.st_mode):
+        target = os.readlink(path).encode("utf-8")
+        writer.add(arcname, st, STORED, zlib.crc32(target), len(target), [target])
+        return
+
+    result.files += 1
+    result.raw_bytes += st.st_size
+    if chunks is not None:
+        crc = 0
+        size = 0
+        for chunk_crc, length, _ in chunks:
+            crc = crc32_combine(crc, chunk_crc, length)
+            size += length
+        data = [chunk for _, _, chunk in chunks]
+        if sum(len(chunk) for chunk in data) < size:
+            writer.add(arcname, st, DEFLATED, crc, size, data)
+            return
+    writer.add_file(arcname, path, st)
+    result.stored += 1
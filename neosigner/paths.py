@@ -0,0 +1,38 @@
+import os
+import sys
+
+# Set to keep every cache, log and journal under one directory instead
+HOME_ENV = "NEOSIGNER_HOME"
+
+
+def _base(kind):
+    override = os.environ.get(HOME_ENV)
+    if override:
+        return os.path.join(override, kind)
+
+    home = os.path.expanduser("~")
+    if sys.platform == "darwin":
+        return os.path.join(home, "Library", {"cache": "Caches", "data": "Application Support",
+                                              "logs": "Logs"}[kind], "NeoSigner")
+    if sys.platform == "win32":
+        root = os.environ.get("LOCALAPPDATA") or os.path.join(home, "AppData", "Local")
+        return os.path.join(root, "NeoSigner", kind)
+
+    xdg = {"cache": ("XDG_CACHE_HOME", ".cache"),
+           "data": ("XDG_DATA_HOME", ".local/share"),
+           "logs": ("XDG_STATE_HOME", ".local/state")}[kind]
+    return os.path.join(os.environ.get(xdg[0]) or os.path.join(home, xdg[1]), "neosigner")
+
+
+def cache_dir(*parts):
+    """Directory for data that can be rebuilt, like discovered tool paths"""
+    return os.path.join(_base("cache"), *parts)
+
+
+def data_dir(*parts):
+    """Directory for data worth keeping, like the job journal"""
+    return os.path.join(_base("data"), *parts)
+
+
+def log_dir(*parts):
+    return os.path.join(_base("logs"), *parts)
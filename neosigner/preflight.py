@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import zipfile
+from dataclasses import asdict
+
+from .digest import hash_file
+from .engine import SignError
+from .paths import cache_dir
+from .profiles import (CERTIFICATE_EXTENSIONS, OPENSSL_MISSING, Certificate, Profile, parse_profile,
+                       read_certificate)
+
+CACHE_FILE = "preflight.json"
+MAX_ENTRIES = 2000
+
+# Bump when what is cached changes so old entries are checked again
+CACHE_VERSION = 1
+
+
+class PreflightCache:
+    """What preflight learned about each file, keyed by its content hash (or,
+    for IPAs, which can be gigabytes, by path, size, mtime and inode like the
+    digest memo). Only facts about the files are kept, like a profile's
+    expiry date; whether a job passes is decided again every time."""
+
+    def __init__(self, path=None):
+        self.path = path or cache_dir(CACHE_FILE)
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                self._entries = data.get("entries", {}) if data.get("version") == CACHE_VERSION else {}
+            except (OSError, ValueError, AttributeError):
+                self._entries = {}
+        return self._entries
+
+    def get(self, key):
+        with self._lock:
+            return self._load().get(key)
+
+    def put(self, key, value):
+        with self._lock:
+            entries = self._load()
+            entries[key] = value
+            while len(entries) > MAX_ENTRIES:
+                del entries[next(iter(entries))]
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, "w") as f:
+                    json.dump({"version": CACHE_VERSION, "entries": entries}, f)
+                os.replace(tmp, self.path)
+            except OSError:
+                pass
+
+    def remember(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = PreflightCache()
+        return _default_cache
+
+
+def ipa_problem(path):
+    """Why the IPA at path can't be signed, judged from its central directory
+    alone, or "" if it looks fine"""
+    try:
+        size = os.path.getsize(path)
+        with zipfile.ZipFile(path) as z:
+            infos = z.infolist()
+    except zipfile.BadZipFile as e:
+        return f"not a valid IPA ({str(e)}); the file may be truncated"
+    except OSError as e:
+        return str(e)
+    # A local header must start before the data it describes runs past the end
+    for info in infos:
+        if info.header_offset + info.compress_size > size:
+            return f"truncated: {info.filename} runs past the end of the file"
+    for info in infos:
+        parts = info.filename.split("/")
+        if len(parts) == 3 and parts[0] == "Payload" and parts[1].endswith(".app") and parts[2] == "Info.plist":
+            return ""
+    return "no Payload/*.app/Info.plist inside"
+
+
+def folder_problem(path):
+    payload = os.path.join(path, "Payload")
+    root = payload if os.path.isdir(payload) else path
+    if path.endswith(".app"):
+        apps = [path]
+    else:
+        apps = [os.path.join(root, name) for name in os.listdir(root) if name.endswith(".app")]
+    if not any(os.path.isfile(os.path.join(app, "Info.plist")) for app in apps):
+        return "no .app with an Info.plist inside"
+    return ""
+
+
+def _ipa_key(path):
+    st = os.stat(path)
+    return f"ipa|{os.path.realpath(path)}|{st.st_size}|{st.st_mtime_ns}|{st.st_ino}"
+
+
+def check(job, cache=None, now=None):
+    """Reject a job that zsign would fail on, before it unzips anything.
+
+    Checks that the input is a complete IPA (or app folder) with an app
+    inside, that the .p12 opens with the password, and that the profile
+    hasn't expired and allows the .p12's certificate. Raises SignError."""
+    cache = cache or default_cache()
+    now = time.time() if now is None else now
+    name = os.path.basename(job.input_path)
+
+    if os.path.isdir(job.input_path):
+        problem = folder_problem(job.input_path)
+    else:
+        problem = cache.remember(_ipa_key(job.input_path), lambda: ipa_problem(job.input_path))
+    if problem:
+        raise SignError(f"{name}: {problem}")
+
+    if job.adhoc:
+        return
+
+    profile_key = f"profile|{hash_file(job.prov)}"
+    profile = Profile(**cache.remember(profile_key, lambda: asdict(parse_profile(job.prov))))
+    if profile.error:
+        raise SignError(f"Can't read provisioning profile {os.path.basename(job.prov)}: {profile.error}")
+    if profile.expired(now):
+        raise SignError(f"Provisioning profile {profile} has expired.")
+
+    if not job.pkey.lower().endswith(CERTIFICATE_EXTENSIONS):
+        # A PEM private key has no certificate to compare with the profile
+        return
+    # The password only goes into the key hashed together with the file
+    secret = hashlib.sha256(f"{hash_file(job.pkey)}|{job.password}".encode()).hexdigest()
+    cached = cache.get(f"p12|{secret}")
+    certificate = Certificate(**cached) if cached else read_certificate(job.pkey, job.password)
+    if certificate.error == OPENSSL_MISSING:
+        # Nothing to check with; zsign will still report a wrong password
+        return
+    if not cached:
+        cache.put(f"p12|{secret}", asdict(certificate))
+    if certificate.error:
+        raise SignError(f"Can't open {os.path.basename(job.pkey)} with this password: {certificate.error}")
+    if certificate.expired(now):
+        raise SignError(f"Certificate {certificate.name} has expired.")
+    if profile.certificates and certificate.fingerprint not in profile.certificates:
+        raise SignError(f"Provisioning profile {profile} doesn't include certificate "
+                        f"{certificate.name or os.path.basename(job.pkey)}.")
@@ -0,0 +1,77 @@
+import json
+import os
+import threading
+from dataclasses import fields, replace
+
+from .engine import SignJob
+from .paths import data_dir
+from .profiles import ProfileLibrary
+
+PRESETS_FILE = "presets.json"
+
+# Job options a preset can't set: they come from the file being signed
+PRESET_EXCLUDED = ("input_path", "output_path", "install")
+# Path options in a preset file are relative to the file
+PRESET_PATHS = ("pkey", "prov", "cert", "entitlements", "dylib", "slim", "profiles")
+
+
+def load_presets(path):
+    """Named presets from a JSON file mapping each name to SignJob options,
+    e.g. {"adhoc": {"adhoc": true}, "team": {"pkey": "dist.p12", ...}}.
+    A preset may also name a "profiles" folder to pick the profile from."""
+    with open(path) as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: expected an object of named presets")
+    allowed = {f.name for f in fields(SignJob)} - set(PRESET_EXCLUDED) | {"profiles"}
+    base_dir = os.path.dirname(os.path.abspath(path))
+    presets = {}
+    for name, options in data.items():
+        if not isinstance(options, dict):
+            raise ValueError(f"{path}: preset {name} must be an object")
+        unknown = set(options) - allowed
+        if unknown:
+            raise ValueError(f"{path}: preset {name} has unknown options: {', '.join(sorted(unknown))}")
+        options = dict(options)
+        for key in PRESET_PATHS:
+            if options.get(key):
+                options[key] = os.path.join(base_dir, os.path.expanduser(options[key]))
+        presets[name] = options
+    return presets
+
+
+def default_presets_path():
+    return data_dir(PRESETS_FILE)
+
+
+class Presets:
+    """Named presets on top of a template job, keeping one ProfileLibrary
+    per profiles folder a preset names. Safe to use from several threads."""
+
+    def __init__(self, options=None, template=None):
+        self.options = options or {}
+        self.template = template or SignJob("")
+        self._libraries = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.options
+
+    def __iter__(self):
+        return iter(self.options)
+
+    def job(self, name, input_path, output_path, **overrides):
+        """(SignJob, Match or None) for a file signed with preset name ("" for
+        just the template), with the profile picked if the preset names a folder"""
+        options = dict(self.options.get(name, {})) if name else {}
+        library_dir = options.pop("profiles", "")
+        options.update(overrides)
+        job = replace(self.template, input_path=input_path, output_path=output_path, install=False, **options)
+        if not library_dir or job.adhoc:
+            return job, None
+        with self._lock:
+            library = self._libraries.get(library_dir)
+            if not library:
+                library = self._libraries[library_dir] = ProfileLibrary(library_dir, password=job.password)
+            library.scan()
+        return job, library.apply(job)
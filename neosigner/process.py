@@ -0,0 +1,108 @@
+import os
+import queue
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# Niceness of zsign runs from batches and other background work, so a job
+# started from the GUI gets the CPU first
+BACKGROUND_NICE = 10
+
+
+def background_command(cmd):
+    """cmd wrapped in nice and, on Linux, ionice's lowest best-effort class,
+    so it yields CPU and disk to interactive jobs. nice and ionice exec the
+    command, so it keeps the same PID and can still be killed."""
+    prefix = []
+    ionice, nice = shutil.which("ionice"), shutil.which("nice")
+    if ionice:
+        prefix += [ionice, "-c", "2", "-n", "7"]
+    if nice:
+        prefix += [nice, "-n", str(BACKGROUND_NICE)]
+    return prefix + list(cmd)
+
+
+def drain_queue(q, budget=0.02, limit=None):
+    """Pop items from q without blocking until it is empty, budget seconds
+    have passed or limit items have been taken"""
+    items = []
+    deadline = time.monotonic() + budget
+    while limit is None or len(items) < limit:
+        try:
+            items.append(q.get_nowait())
+        except queue.Empty:
+            break
+        if time.monotonic() >= deadline:
+            break
+    return items
+
+
+class ProcessStream:
+    """Run a command and read its output on a background thread.
+
+    Output lines are queued so the caller can drain them at its own pace,
+    e.g. from root.after, without ever blocking on the pipe."""
+
+    def __init__(self, cmd, env=None):
+        self.cmd = cmd
+        self.env = env
+        self.lines = queue.Queue()
+        self.process = None
+        self.returncode = None
+        self.cancelled = False
+        self._exited = threading.Event()
+
+    def start(self):
+        # Give the process its own group so cancel() also stops anything it
+        # spawns, like the ideviceinstaller run by zsign -i
+        self.process = subprocess.Popen(
+            self.cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            env=self.env,
+            start_new_session=sys.platform != "win32"
+        )
+        threading.Thread(target=self._read, name="process-stream", daemon=True).start()
+        return self
+
+    def _read(self):
+        try:
+            for line in self.process.stdout:
+                line = line.strip()
+                if line:
+                    self.lines.put(line)
+        finally:
+            self.process.stdout.close()
+            self.returncode = self.process.wait()
+            self._exited.set()
+
+    @property
+    def finished(self):
+        """True once the process has exited and every line has been drained"""
+        return self._exited.is_set() and self.lines.empty()
+
+    def drain(self, budget=0.02, limit=None):
+        return drain_queue(self.lines, budget, limit)
+
+    def wait(self, timeout=None):
+        """Block until the process exits; returns its exit code or None on timeout"""
+        self._exited.wait(timeout)
+        return self.returncode
+
+    def cancel(self):
+        """Kill the process (and its children) if it is still running"""
+        if not self.process or self.process.poll() is not None:
+            return
+        self.cancelled = True
+        try:
+            if sys.platform != "win32":
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except OSError:
+            pass
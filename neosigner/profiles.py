@@ -0,0 +1,326 @@
+import base64
+import hashlib
+import json
+import os
+import plistlib
+import re
+import shutil
+import ssl
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import timezone
+
+from .engine import SignError
+from .ipainfo import bundle_id_of, profile_plist
+from .paths import cache_dir
+
+# Default library folder for the GUI and CLI when none is given
+LIBRARY_ENV = "NEOSIGNER_PROFILES"
+
+CACHE_FILE = "profiles.json"
+
+# Bump when the cached fields change so old entries are parsed again
+CACHE_VERSION = 1
+
+PROFILE_EXTENSIONS = (".mobileprovision", ".provisionprofile")
+CERTIFICATE_EXTENSIONS = (".p12", ".pfx")
+
+PEM_PATTERN = re.compile(rb"-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----", re.DOTALL)
+SUBJECT_CN_PATTERN = re.compile(r"CN\s*=\s*([^,/\n]+)")
+
+OPENSSL_MISSING = "openssl not found"
+
+
+@dataclass
+class Profile:
+    """What NeoSigner needs from a provisioning profile's embedded plist"""
+    path: str
+    name: str = ""
+    uuid: str = ""
+    team_id: str = ""
+    team_name: str = ""
+    # The application identifier without the team prefix, e.g. "com.example.*"
+    app_id: str = ""
+    expires: float = 0.0
+    # SHA-1 fingerprints of the DER certificates the profile allows
+    certificates: list = field(default_factory=list)
+    devices: int = 0
+    all_devices: bool = False
+    error: str = ""
+
+    def expired(self, now=None):
+        return self.expires <= (time.time() if now is None else now)
+
+    def __str__(self):
+        expires = time.strftime("%Y-%m-%d", time.localtime(self.expires)) if self.expires else "?"
+        return f"{self.name or os.path.basename(self.path)} ({self.team_id}.{self.app_id}, expires {expires})"
+
+
+@dataclass
+class Certificate:
+    """The signing certificate in a .p12 file"""
+    path: str
+    fingerprint: str = ""
+    name: str = ""
+    expires: float = 0.0
+    error: str = ""
+
+    def expired(self, now=None):
+        return bool(self.expires) and self.expires <= (time.time() if now is None else now)
+
+
+@dataclass
+class Match:
+    profile: Profile
+    certificate: Certificate = None
+
+    def __str__(self):
+        text = str(self.profile)
+        if self.certificate:
+            text += f" with {self.certificate.name or os.path.basename(self.certificate.path)}"
+        return text
+
+
+def parse_profile(path):
+    profile = Profile(path)
+    try:
+        with open(path, "rb") as f:
+            info = profile_plist(f.read())
+    except (OSError, ValueError, plistlib.InvalidFileException) as e:
+        profile.error = str(e)
+        return profile
+
+    profile.name = info.get("Name", "")
+    profile.uuid = info.get("UUID", "")
+    teams = info.get("TeamIdentifier") or [""]
+    profile.team_id = teams[0]
+    profile.team_name = info.get("TeamName", "")
+    entitlements = info.get("Entitlements", {})
+    app_id = entitlements.get("application-identifier") or entitlements.get("com.apple.application-identifier", "")
+    prefix = f"{profile.team_id}."
+    if app_id.startswith(prefix):
+        app_id = app_id[len(prefix):]
+    else:
+        app_id = app_id.partition(".")[2] or app_id
+    profile.app_id = app_id
+    expires = info.get("ExpirationDate")
+    if expires:
+        # plistlib gives naive datetimes in UTC
+        profile.expires = expires.replace(tzinfo=expires.tzinfo or timezone.utc).timestamp()
+    profile.certificates = [hashlib.sha1(der).hexdigest() for der in info.get("DeveloperCertificates", [])]
+    profile.devices = len(info.get("ProvisionedDevices", []))
+    profile.all_devices = bool(info.get("ProvisionsAllDevices"))
+    return profile
+
+
+def _openssl(args, stdin=None, env=None):
+    openssl = shutil.which("openssl")
+    if not openssl:
+        raise ValueError(OPENSSL_MISSING)
+    return subprocess.run([openssl] + args, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          env={**os.environ, **(env or {})}, timeout=30)
+
+
+def read_certificate(path, password=""):
+    """Fingerprint, common name and expiry of the signing certificate in a
+    .p12, read with the openssl command line tool"""
+    certificate = Certificate(path)
+    try:
+        # The password goes through the environment to keep it out of ps
+        args = ["pkcs12", "-in", path, "-nokeys", "-clcerts", "-passin", "env:NEOSIGNER_P12_PASS"]
+        env = {"NEOSIGNER_P12_PASS": password}
+        result = _openssl(args, env=env)
+        if result.returncode != 0:
+            # OpenSSL 3 needs -legacy for the RC2 encryption older Keychain exports use
+            result = _openssl(args + ["-legacy"], env=env)
+        if result.returncode != 0:
+            raise ValueError(result.stderr.decode(errors="replace").strip().splitlines()[0]
+                             if result.stderr.strip() else "can't read certificate")
+        pem = PEM_PATTERN.search(result.stdout)
+        if not pem:
+            raise ValueError("no certificate in file")
+        der = base64.b64decode(b"".join(pem.group(1).split()))
+        certificate.fingerprint = hashlib.sha1(der).hexdigest()
+
+        details = _openssl(["x509", "-noout", "-subject", "-enddate", "-nameopt", "oneline"], stdin=pem.group(0))
+        for line in details.stdout.decode(errors="replace").splitlines():
+            if line.startswith("subject"):
+                name = SUBJECT_CN_PATTERN.search(line)
+                certificate.name = name.group(1).strip() if name else ""
+            elif line.startswith("notAfter="):
+                certificate.expires = float(ssl.cert_time_to_seconds(line[9:].strip()))
+    except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+        certificate.error = str(e)
+    return certificate
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def candidate_app_ids(bundle_id):
+    """App ID patterns that can match bundle_id, most specific first"""
+    parts = bundle_id.split(".")
+    patterns = [bundle_id]
+    for i in range(len(parts) - 1, 0, -1):
+        patterns.append(".".join(parts[:i]) + ".*")
+    patterns.append("*")
+    return patterns
+
+
+class ProfileLibrary:
+    """Every provisioning profile and .p12 certificate under a folder.
+
+    Each file is parsed once; what was read is kept in a JSON cache keyed
+    by path and only read again when the file's mtime or size changes.
+    Profiles are indexed by app ID pattern, so finding the best match for a
+    bundle ID costs a handful of dictionary lookups however many there are."""
+
+    def __init__(self, directory, password="", cache_path=None):
+        self.directory = os.path.abspath(directory)
+        self.password = password
+        self.cache_path = cache_path or cache_dir(CACHE_FILE)
+        self.profiles = []
+        self.certificates = []
+        self.parsed = 0
+        self._index = {}
+        self._by_fingerprint = {}
+        self._lock = threading.Lock()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+            return {}
+        return cache.get("files", {})
+
+    def _save_cache(self, files):
+        try:
+            cached = self._load_cache()
+            cached.update(files)
+            # Forget files that are gone, from this folder or any other
+            cached = {path: entry for path, entry in cached.items() if os.path.exists(path)}
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp = f"{self.cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({"version": CACHE_VERSION, "files": cached}, f)
+            os.replace(tmp, self.cache_path)
+        except OSError:
+            pass
+
+    def scan(self):
+        """Find every profile and certificate, parsing only new or changed files"""
+        if not os.path.isdir(self.directory):
+            raise ValueError(f"Profile folder not found: {self.directory}")
+        cached = self._load_cache()
+        password_key = hashlib.sha256(self.password.encode()).hexdigest()[:16]
+        files = {}
+        stale_profiles, stale_certificates = [], []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                lower = name.lower()
+                if not lower.endswith(PROFILE_EXTENSIONS + CERTIFICATE_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stamp = _stamp(path)
+                except OSError:
+                    continue
+                entry = cached.get(path)
+                is_profile = lower.endswith(PROFILE_EXTENSIONS)
+                # A certificate that couldn't be read is tried again with a different password
+                fresh = entry and entry.get("stamp") == stamp and (
+                    is_profile or not entry["data"].get("error") or entry.get("password") == password_key)
+                if fresh:
+                    files[path] = entry
+                elif is_profile:
+                    stale_profiles.append((path, stamp))
+                else:
+                    stale_certificates.append((path, stamp))
+
+        for path, stamp in stale_profiles:
+            files[path] = {"stamp": stamp, "kind": "profile", "data": asdict(parse_profile(path))}
+        if stale_certificates:
+            with ThreadPoolExecutor(max_workers=min(8, len(stale_certificates))) as pool:
+                read = pool.map(lambda item: read_certificate(item[0], self.password), stale_certificates)
+                for (path, stamp), certificate in zip(stale_certificates, read):
+                    files[path] = {"stamp": stamp, "kind": "certificate", "password": password_key,
+                                   "data": asdict(certificate)}
+        self.parsed = len(stale_profiles) + len(stale_certificates)
+        prefix = self.directory + os.sep
+        if self.parsed or any(path.startswith(prefix) and path not in files for path in cached):
+            self._save_cache(files)
+
+        profiles = [Profile(**entry["data"]) for entry in files.values() if entry["kind"] == "profile"]
+        certificates = [Certificate(**entry["data"]) for entry in files.values() if entry["kind"] == "certificate"]
+        self._build(profiles, certificates)
+        return self
+
+    def _build(self, profiles, certificates):
+        index = {}
+        for profile in profiles:
+            if profile.error or not profile.app_id:
+                continue
+            index.setdefault(profile.app_id, []).append(profile)
+        by_fingerprint = {}
+        for certificate in certificates:
+            if certificate.fingerprint:
+                by_fingerprint.setdefault(certificate.fingerprint, []).append(certificate)
+        with self._lock:
+            self.profiles = profiles
+            self.certificates = certificates
+            self._index = index
+            self._by_fingerprint = by_fingerprint
+
+    def certificate_for(self, profile, now=None):
+        """The unexpired library certificate the profile allows that lasts longest"""
+        found = [certificate
+                 for fingerprint in profile.certificates
+                 for certificate in self._by_fingerprint.get(fingerprint, ())
+                 if not certificate.expired(now)]
+        return max(found, key=lambda certificate: certificate.expires or float("inf"), default=None)
+
+    def matches(self, bundle_id, now=None):
+        """Every unexpired profile for bundle_id, best first: the most specific
+        app ID, then one whose certificate is in the library, then the one
+        that expires last"""
+        with self._lock:
+            index = self._index
+        found = []
+        for specificity, pattern in enumerate(candidate_app_ids(bundle_id)):
+            for profile in index.get(pattern, ()):
+                if profile.expired(now):
+                    continue
+                certificate = self.certificate_for(profile, now)
+                found.append((specificity, certificate is None, -profile.expires, Match(profile, certificate)))
+        found.sort(key=lambda item: item[:3])
+        return [item[3] for item in found]
+
+    def best_match(self, bundle_id, now=None):
+        """The best Match for bundle_id, or None"""
+        found = self.matches(bundle_id, now)
+        return found[0] if found else None
+
+    def apply(self, job):
+        """Fill in whichever of job's profile and certificate is missing from
+        the best match for its bundle ID, raising SignError if nothing fits"""
+        if job.adhoc or (job.pkey and job.prov):
+            return None
+        bundle_id = job.bundle_id or bundle_id_of(job.input_path)
+        if not bundle_id:
+            raise SignError(f"Can't read the bundle ID of {job.input_path}; set one to pick a profile.")
+        match = self.best_match(bundle_id)
+        if not match:
+            raise SignError(f"No unexpired provisioning profile for {bundle_id} in {self.directory}")
+        if not job.pkey and not match.certificate:
+            raise SignError(f"No certificate for profile {match.profile} in {self.directory}")
+        job.prov = job.prov or match.profile.path
+        job.pkey = job.pkey or match.certificate.path
+        return match
@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from .engine import SignError
+from .ipainfo import read_app_info
+
+# zsign hashes one file at a time, so its memory use hardly grows with the
+# app; this is a generous allowance per running job
+MEMORY_PER_JOB = 512 * 1024 ** 2
+
+# Left free on every filesystem a job writes to
+RESERVE_BYTES = 1024 ** 3
+
+# How often a waiting job looks again at free space and memory, which other
+# programs change too
+POLL_SECONDS = 1.0
+
+
+def available_cores():
+    """Cores this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory():
+    """Bytes of memory that can be used without swapping, or None if unknown"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _size(n):
+    if n >= 1024 ** 3:
+        return f"{n / 1024 ** 3:.1f} GB"
+    return f"{n / 1024 ** 2:.0f} MB"
+
+
+def _existing_dir(path):
+    """path, or the nearest folder above it that exists"""
+    path = os.path.abspath(path)
+    while not os.path.isdir(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+class Scheduler:
+    """Decide when each job of a batch may start.
+
+    A job is admitted when a core is free, when every filesystem it writes
+    to has room for it on top of what running jobs have claimed, and when
+    memory allows one more zsign. An IPA needs its uncompressed size, read
+    from the central directory, where it gets unzipped (the temp folder,
+    the workspace, or the scratch folder a ScratchPolicy would pick) and
+    about its own size again for the signed output. Free memory is read
+    afresh each time, so it already reflects the jobs that are running.
+    Jobs wait for one another rather than fail; a job that couldn't fit even
+    with nothing else running raises SignError."""
+
+    def __init__(self, max_jobs=None, temp_dir=None, memory_per_job=MEMORY_PER_JOB, reserve_bytes=RESERVE_BYTES):
+        self.max_jobs = max(1, max_jobs or available_cores())
+        self.temp_dir = temp_dir or tempfile.gettempdir()
+        self.memory_per_job = memory_per_job
+        self.reserve_bytes = reserve_bytes
+        self.waited = 0
+        self._running = 0
+        self._claimed_disk = {}
+        self._cond = threading.Condition()
+
+    def demand(self, job, workspace=None, scratch=None):
+        """{device: (folder, bytes)} of what the job will write, per filesystem"""
+        if not os.path.isfile(job.input_path):
+            # A folder is signed in place
+            return {}
+        unpacked = read_app_info(job.input_path).size
+        if workspace and workspace.accepts(job):
+            unzip_dir = workspace.root
+        elif scratch and job.output_path:
+            # Where engine.SignRun will unpack it, as things stand now
+            unzip_dir = scratch.directory_for(unpacked)
+        else:
+            unzip_dir = self.temp_dir
+        folders = {_existing_dir(unzip_dir): unpacked}
+        if job.output_path:
+            output_dir = _existing_dir(os.path.dirname(os.path.abspath(job.output_path)))
+            folders[output_dir] = folders.get(output_dir, 0) + os.path.getsize(job.input_path)
+
+        by_device = {}
+        for folder, size in folders.items():
+            device = os.stat(folder).st_dev
+            known = by_device.get(device)
+            by_device[device] = (known[0] if known else folder, (known[1] if known else 0) + size)
+        return by_device
+
+    def _disk_shortfall(self, disk):
+        for device, (folder, size) in disk.items():
+            free = shutil.disk_usage(folder).free - self._claimed_disk.get(device, 0) - self.reserve_bytes
+            if size > free:
+                return f"needs {_size(size)} in {folder}, {_size(max(0, free))} free"
+        return ""
+
+    def _other_shortfall(self):
+        if self._running >= self.max_jobs:
+            return f"all {self.max_jobs} job slots busy"
+        memory = available_memory()
+        if memory is not None and self.memory_per_job > memory:
+            return f"needs {_size(self.memory_per_job)} of memory"
+        return ""
+
+    @contextmanager
+    def admit(self, job, workspace=None, on_wait=None, cancelled=None, scratch=None):
+        """Block until the job may run and hold its resources until the block
+        ends. on_wait(reason) is called once if it has to wait; waiting stops
+        with SignError when the cancelled Event is set."""
+        disk = self.demand(job, workspace, scratch)
+        with self._cond:
+            waiting = False
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    raise SignError("Cancelled while waiting to start")
+                reason = self._disk_shortfall(disk)
+                if reason and not self._running:
+                    raise SignError(f"Not enough disk space: {reason}")
+                # Memory is only an estimate, so one job at a time always runs
+                reason = reason or (self._other_shortfall() if self._running else "")
+                if not reason:
+                    break
+                if not waiting:
+                    waiting = True
+                    self.waited += 1
+                    if on_wait:
+                        on_wait(reason)
+                self._cond.wait(POLL_SECONDS)
+            self._claim(disk, 1)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._claim(disk, -1)
+                self._cond.notify_all()
+
+    def _claim(self, disk, sign):
+        self._running += sign
+        for device, (_, size) in disk.items():
+            self._claimed_disk[device] = self._claimed_disk.get(device, 0) + sign * size
+
+    def stats(self):
+        return f"scheduler {self.max_jobs} slots, {self.waited} jobs waited for resources"
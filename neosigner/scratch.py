@@ -0,0 +1,157 @@
+import os
+import shutil
+import tempfile
+import threading
+from dataclasses import dataclass
+
+from .engine import SignError
+from .scheduler import available_memory
+from .workspace import pid_alive
+
+# Fast folder (e.g. a tmpfs like /dev/shm) for unpacking apps, and its
+# budget in GB, when not given with --scratch and --scratch-budget
+SCRATCH_ENV = "NEOSIGNER_SCRATCH"
+BUDGET_ENV = "NEOSIGNER_SCRATCH_BUDGET"
+
+FAST = "fast"
+DISK = "disk"
+
+# Scratch folders are named neosigner-<pid>-<random>, so those left by a
+# process that died can be told apart from ones still in use
+PREFIX = "neosigner-"
+
+# Left free on the disk scratch filesystem, and in memory when the fast folder is a tmpfs
+RESERVE_BYTES = 256 * 1024 ** 2
+
+
+@dataclass
+class Lease:
+    """A scratch folder handed to one job"""
+    path: str
+    tier: str
+    size: int = 0
+
+
+def sweep(directory):
+    """Remove scratch folders left behind by processes that have exited"""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        pid = name[len(PREFIX):].split("-")[0]
+        if name.startswith(PREFIX) and pid.isdigit() and not pid_alive(int(pid)):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def is_tmpfs(path):
+    """True if path is on a RAM-backed filesystem, as far as /proc/mounts tells"""
+    try:
+        with open("/proc/mounts") as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return False
+    path = os.path.realpath(path)
+    best = ("", "")
+    for fields in mounts:
+        if len(fields) < 3:
+            continue
+        mount_point = fields[1]
+        inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+        if inside and len(mount_point) > len(best[0]):
+            best = (mount_point, fields[2])
+    return best[1] in ("tmpfs", "ramfs")
+
+
+class ScratchPolicy:
+    """Where jobs unpack apps: the fast folder while the app's uncompressed
+    size fits what's left of budget_bytes (and the folder's free space, and
+    free memory for a tmpfs), otherwise the disk folder.
+
+    Folders left by a crashed process are removed when a policy is created,
+    so nothing piles up in a tmpfs across crashes."""
+
+    def __init__(self, fast_dir=None, budget_bytes=None, disk_dir=None):
+        self.fast_dir = os.path.abspath(fast_dir) if fast_dir else None
+        self.disk_dir = disk_dir or tempfile.gettempdir()
+        if self.fast_dir:
+            os.makedirs(self.fast_dir, exist_ok=True)
+        self.tmpfs = bool(self.fast_dir) and is_tmpfs(self.fast_dir)
+        if budget_bytes is None and self.fast_dir:
+            # Half of a tmpfs or fast disk, leaving the rest for everything else
+            budget_bytes = shutil.disk_usage(self.fast_dir).total // 2
+        self.budget_bytes = budget_bytes or 0
+        self.in_use = 0
+        self._lock = threading.Lock()
+        for directory in (self.fast_dir, self.disk_dir):
+            if directory:
+                sweep(directory)
+
+    def _fits(self, directory, size, reserve=RESERVE_BYTES):
+        try:
+            return shutil.disk_usage(directory).free - reserve >= size
+        except OSError:
+            return False
+
+    def _fits_fast(self, size):
+        if not self.fast_dir or self.in_use + size > self.budget_bytes:
+            return False
+        if self.tmpfs:
+            memory = available_memory()
+            if memory is not None and memory - RESERVE_BYTES < size:
+                return False
+        # The budget already keeps the fast folder from filling up
+        return self._fits(self.fast_dir, size, reserve=0)
+
+    def directory_for(self, size):
+        """The folder allocate(size) would pick right now"""
+        with self._lock:
+            return self.fast_dir if self._fits_fast(size) else self.disk_dir
+
+    def allocate(self, size):
+        """A Lease on a new scratch folder with room for size bytes; raises
+        SignError if neither tier has the space"""
+        with self._lock:
+            if self._fits_fast(size):
+                tier, directory = FAST, self.fast_dir
+                self.in_use += size
+            elif self._fits(self.disk_dir, size):
+                tier, directory = DISK, self.disk_dir
+            else:
+                raise SignError(f"Not enough free space to unpack {size / (1024 * 1024):.0f} MB "
+                                f"in {self.fast_dir or self.disk_dir}" +
+                                (f" or {self.disk_dir}" if self.fast_dir else ""))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = tempfile.mkdtemp(prefix=f"{PREFIX}{os.getpid()}-", dir=directory)
+        except OSError:
+            self._unclaim(tier, size)
+            raise
+        return Lease(path, tier, size)
+
+    def release(self, lease):
+        shutil.rmtree(lease.path, ignore_errors=True)
+        self._unclaim(lease.tier, lease.size)
+
+    def _unclaim(self, tier, size):
+        if tier == FAST:
+            with self._lock:
+                self.in_use -= size
+
+    def describe(self, lease):
+        if lease.tier == FAST:
+            return f"{'tmpfs' if self.tmpfs else 'fast'} scratch {self.fast_dir}"
+        return f"disk scratch {self.disk_dir}"
+
+
+def default_policy(fast_dir=None, budget_gb=None):
+    """A ScratchPolicy for fast_dir (or $NEOSIGNER_SCRATCH), or None if neither is set"""
+    fast_dir = fast_dir or os.environ.get(SCRATCH_ENV, "")
+    if not fast_dir:
+        return None
+    if budget_gb is None and os.environ.get(BUDGET_ENV):
+        try:
+            budget_gb = float(os.environ[BUDGET_ENV])
+        except ValueError:
+            budget_gb = None
+    return ScratchPolicy(fast_dir, int(budget_gb * 1024 ** 3) if budget_gb is not None else None)
@@ -0,0 +1,547 @@
+import asyncio
+import hmac
+import itertools
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+from . import engine
+from .batch import CANCELLED, FAILED, PENDING, RUNNING, SUCCEEDED
+from .engine import SignError
+from .paths import cache_dir
+from .verify import can_verify, verify_job
+from .workspace import pid_alive
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8788
+
+# Read when --token isn't given, to keep the token out of argv
+TOKEN_ENV = "NEOSIGNER_SERVICE_TOKEN"
+
+DEFAULT_MAX_UPLOAD = 8 * 1024 ** 3
+MAX_JSON_BYTES = 1024 * 1024
+HEADER_LIMIT = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+# Finished jobs (and their signed apps) kept for download, oldest dropped first
+KEEP_FINISHED = 200
+
+# Options a client may set on top of a preset. Certificates, profiles and
+# anything else that names a file on this machine only come from presets.
+CLIENT_OPTIONS = {
+    "bundle_id": str,
+    "bundle_name": str,
+    "bundle_version": str,
+    "zip_level": int,
+    "adhoc": bool,
+    "force": bool,
+    "sha256_only": bool,
+    "weak": bool,
+}
+
+REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden",
+           404: "Not Found", 405: "Method Not Allowed", 409: "Conflict", 411: "Length Required",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class ServiceJob:
+    """A job submitted to the service, from queued to downloadable"""
+    id: str
+    input_path: str
+    directory: str
+    name: str = ""
+    preset: str = ""
+    options: dict = field(default_factory=dict)
+    priority: int = 0
+    uploaded: bool = False
+    status: str = PENDING
+    submitted: float = 0.0
+    started: float = 0.0
+    finished: float = 0.0
+    returncode: int = None
+    cached: bool = False
+    output_size: int = 0
+    error: str = ""
+    log: list = field(default_factory=list, repr=False)
+    subscribers: list = field(default_factory=list, repr=False)
+    process: object = field(default=None, repr=False)
+    cancelled: bool = False
+
+    @property
+    def output_path(self):
+        return os.path.join(self.directory, "signed.ipa")
+
+    @property
+    def done(self):
+        return self.status in (SUCCEEDED, FAILED, CANCELLED)
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "preset": self.preset,
+            "priority": self.priority,
+            "status": self.status,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "returncode": self.returncode,
+            "cached": self.cached,
+            "output_size": self.output_size,
+            "error": self.error,
+            "download": f"/jobs/{self.id}/download" if self.status == SUCCEEDED else "",
+        }
+
+
+def content_disposition(filename):
+    """An attachment header for any file name: a plain ASCII fallback for old
+    clients, and the name itself percent-encoded as RFC 5987 asks"""
+    fallback = "".join(c if c.isascii() else "_" for c in filename if c.isprintable() and c not in '"\\')
+    return f"Content-Disposition: attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+
+def parse_option(name, value):
+    kind = CLIENT_OPTIONS.get(name)
+    if kind is None:
+        raise HTTPError(400, f"Unknown option: {name}")
+    if kind is bool:
+        if isinstance(value, bool):
+            return value
+        return str(value).lower() in ("1", "true", "yes", "on")
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, f"Bad value for {name}: {value}")
+
+
+class SigningService:
+    """Sign apps for clients over HTTP on one machine that holds the certificates.
+
+    Jobs come in as uploads or as paths under allowed_roots, wait in a
+    priority queue and run at most max_concurrent at a time. Each job's log
+    and status changes stream as server-sent events, and the signed app can
+    be downloaded until KEEP_FINISHED newer jobs have finished. on_event
+    gets a line for each job submitted and finished. With verify, a job
+    only succeeds once its signed app has passed verification."""
+
+    def __init__(self, zsign_path, presets, root=None, max_concurrent=2, allowed_roots=(), token="",
+                 max_upload=DEFAULT_MAX_UPLOAD, default_preset="", cache=None, workspace=None, metrics=None,
+                 on_event=None, scheduler=None, scratch=None, verify=False):
+        if default_preset and default_preset not in presets:
+            raise SignError(f"Unknown preset: {default_preset}")
+        self.zsign_path = zsign_path
+        self.presets = presets
+        self.root = root or cache_dir("service")
+        # Job folders of this instance; other services may share root
+        self.jobs_dir = os.path.join(self.root, f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        self.max_concurrent = max(1, max_concurrent)
+        self.allowed_roots = [os.path.realpath(path) for path in allowed_roots]
+        self.token = token
+        self.max_upload = max_upload
+        self.default_preset = default_preset
+        self.cache = cache
+        self.workspace = workspace
+        self.metrics = metrics
+        self.scheduler = scheduler
+        self.scratch = scratch
+        self.verify = verify
+        self.on_event = on_event
+        self.jobs = {}
+        self._sequence = itertools.count()
+        self._queue = None
+        self._loop = None
+        self._executor = None
+        self._workers = []
+
+    def _event(self, message):
+        if self.on_event:
+            self.on_event(message)
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """Start listening and the workers; returns the asyncio server"""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.PriorityQueue()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="service")
+        self._sweep()
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrent)]
+        return await asyncio.start_server(self._handle, host, port, limit=HEADER_LIMIT)
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        server = await self.start(host, port)
+        address = server.sockets[0].getsockname()
+        self._event(f"Listening on http://{address[0]}:{address[1]} with {self.max_concurrent} zsign processes")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        for job in self.jobs.values():
+            if not job.done:
+                self._cancel(job)
+        for worker in self._workers:
+            worker.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        shutil.rmtree(self.jobs_dir, ignore_errors=True)
+
+    def _sweep(self):
+        """Remove job folders left behind by services that have exited"""
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+        for name in names:
+            pid = name.split("-")[0]
+            if pid.isdigit() and not pid_alive(int(pid)):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    # Jobs
+
+    def submit(self, input_path, directory, name="", preset="", options=None, priority=0, uploaded=False,
+               job_id=None):
+        preset = preset or self.default_preset
+        if preset and preset not in self.presets:
+            raise HTTPError(400, f"Unknown preset: {preset}")
+        job = ServiceJob(job_id or uuid.uuid4().hex[:12], input_path, directory,
+                         name=name or os.path.basename(input_path), preset=preset, options=options or {},
+                         priority=priority, uploaded=uploaded, submitted=time.time())
+        self.jobs[job.id] = job
+        # Highest priority first, then first come first served
+        self._queue.put_nowait((-priority, next(self._sequence), job.id))
+        self._event(f"[{job.id}] Queued {job.name} (priority {priority})")
+        return job
+
+    def _publish(self, job, event, data):
+        if event == "log":
+            job.log.append(data)
+        for queue in list(job.subscribers):
+            queue.put_nowait((event, data))
+
+    def _set_status(self, job, status):
+        job.status = status
+        self._publish(job, "status", job.summary())
+        if job.done:
+            self._publish(job, "done", job.summary())
+
+    def _cancel(self, job):
+        job.cancelled = True
+        if job.status == PENDING:
+            job.finished = time.time()
+            self._set_status(job, CANCELLED)
+        elif job.process:
+            try:
+                job.process.kill()
+            except OSError:
+                pass
+
+    async def _worker(self):
+        while True:
+            _, _, job_id = await self._queue.get()
+            job = self.jobs.get(job_id)
+            if not job or job.status != PENDING:
+                continue
+            job.started = time.time()
+            self._set_status(job, RUNNING)
+            try:
+                result = await self._loop.run_in_executor(self._executor, self._run_job, job)
+                job.returncode = result.returncode
+                job.cached = result.cached
+                job.output_size = result.output_size
+                if result.ok:
+                    status = await self._verified(job, result)
+                elif job.cancelled:
+                    status = CANCELLED
+                else:
+                    status = FAILED
+                    job.error = f"zsign exited with code {result.returncode}"
+            except (SignError, OSError, ValueError) as e:
+                status = FAILED
+                job.error = str(e)
+                self._publish(job, "log", f"Error: {str(e)}")
+            except Exception as e:
+                # A bug shouldn't leave the job running forever or take this worker with it
+                status = FAILED
+                job.error = f"{type(e).__name__}: {str(e)}"
+                self._publish(job, "log", f"Error: {job.error}")
+                self._event(f"[{job.id}] Unexpected error: {job.error}")
+            job.process = None
+            job.finished = time.time()
+            if job.uploaded:
+                try:
+                    os.remove(job.input_path)
+                except OSError:
+                    pass
+            self._set_status(job, status)
+            self._event(f"[{job.id}] {job.name} {status} in {job.finished - job.started:.1f}s")
+            self._prune()
+
+    async def _verified(self, job, result):
+        """SUCCEEDED, or FAILED if verifying the signed app finds a problem"""
+        if not self.verify or not can_verify(result.job):
+            return SUCCEEDED
+        try:
+            verification = await asyncio.wrap_future(verify_job(result.job))
+        except Exception as e:
+            self._publish(job, "log", f"Could not verify the signed app: {str(e) or type(e).__name__}")
+            return SUCCEEDED
+        self._publish(job, "log", str(verification))
+        if verification.ok:
+            return SUCCEEDED
+        job.error = f"output failed verification: {'; '.join(verification.problems)}"
+        return FAILED
+
+    def _run_job(self, job):
+        """Sign on an executor thread, sending log lines back to the event loop"""
+        def emit(line):
+            self._loop.call_soon_threadsafe(self._publish, job, "log", line)
+
+        def started(process):
+            job.process = process
+            if job.cancelled:
+                process.kill()
+
+        sign_job, match = self.presets.job(job.preset, job.input_path, job.output_path, **job.options)
+        if match:
+            emit(f"Using {match}")
+        admitted = nullcontext()
+        if self.scheduler:
+            admitted = self.scheduler.admit(sign_job, self.workspace, scratch=self.scratch,
+                                            on_wait=lambda reason: emit(f"Waiting to start: {reason}"))
+        with admitted:
+            return engine.run(self.zsign_path, sign_job, on_output=emit, on_start=started, cache=self.cache,
+                              workspace=self.workspace, metrics=self.metrics, background=True,
+                              scratch=self.scratch)
+
+    def _prune(self):
+        finished = sorted((job for job in self.jobs.values() if job.done), key=lambda job: job.finished)
+        for job in finished[:max(0, len(finished) - KEEP_FINISHED)]:
+            if not job.subscribers:
+                del self.jobs[job.id]
+                shutil.rmtree(job.directory, ignore_errors=True)
+
+    # HTTP
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            lines = head.decode("latin-1").split("\r\n")
+            try:
+                method, target, _ = lines[0].split(" ", 2)
+            except ValueError:
+                await self._send_json(writer, 400, {"error": "Bad request line"})
+                return
+            headers = {}
+            for line in lines[1:]:
+                key, _, value = line.partition(":")
+                if key:
+                    headers[key.strip().lower()] = value.strip()
+            url = urlsplit(target)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            try:
+                self._authorize(headers)
+                await self._route(method, unquote(url.path), query, headers, reader, writer)
+            except HTTPError as e:
+                await self._send_json(writer, e.status, {"error": str(e)})
+        except ConnectionError:
+            pass
+        except Exception as e:
+            self._event(f"Error handling a request: {type(e).__name__}: {str(e)}")
+            try:
+                await self._send_json(writer, 500, {"error": "Internal error"})
+            except ConnectionError:
+                pass
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def _authorize(self, headers):
+        if not self.token:
+            return
+        given = headers.get("authorization", "")
+        if not hmac.compare_digest(given.encode(), f"Bearer {self.token}".encode()):
+            raise HTTPError(401, "Missing or wrong token")
+
+    async def _route(self, method, path, query, headers, reader, writer):
+        parts = [part for part in path.split("/") if part]
+        if parts == ["health"] and method == "GET":
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            await self._send_json(writer, 200, {"ok": True, "jobs": counts, "max_concurrent": self.max_concurrent})
+        elif parts == ["presets"] and method == "GET":
+            await self._send_json(writer, 200, {"presets": list(self.presets), "default": self.default_preset})
+        elif parts == ["jobs"] and method == "GET":
+            jobs = sorted(self.jobs.values(), key=lambda job: job.submitted)
+            await self._send_json(writer, 200, {"jobs": [job.summary() for job in jobs]})
+        elif parts == ["jobs"] and method == "POST":
+            job = await self._create_job(query, headers, reader)
+            await self._send_json(writer, 202, job.summary())
+        elif len(parts) >= 2 and parts[0] == "jobs":
+            job = self.jobs.get(parts[1])
+            if not job:
+                raise HTTPError(404, f"No job {parts[1]}")
+            action = parts[2] if len(parts) > 2 else ""
+            if action == "" and method == "GET":
+                await self._send_json(writer, 200, job.summary())
+            elif action == "" and method == "DELETE":
+                if job.done:
+                    raise HTTPError(409, f"Job {job.id} already {job.status}")
+                self._cancel(job)
+                await self._send_json(writer, 202, job.summary())
+            elif action == "events" and method == "GET":
+                await self._stream_events(job, writer)
+            elif action == "download" and method == "GET":
+                await self._send_download(job, writer)
+            else:
+                raise HTTPError(405 if action in ("", "events", "download") else 404, f"Can't {method} {path}")
+        else:
+            raise HTTPError(404, f"Nothing at {path}")
+
+    async def _create_job(self, query, headers, reader):
+        length = headers.get("content-length")
+        if length is None:
+            raise HTTPError(411, "Content-Length is required")
+        try:
+            length = int(length)
+        except ValueError:
+            raise HTTPError(400, "Bad Content-Length")
+
+        job_id = uuid.uuid4().hex[:12]
+        directory = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            if headers.get("content-type", "").split(";")[0].strip() == "application/json":
+                return await self._create_from_path(job_id, directory, length, reader)
+            return await self._create_from_upload(job_id, directory, length, query, reader)
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+    async def _create_from_path(self, job_id, directory, length, reader):
+        if length > MAX_JSON_BYTES:
+            raise HTTPError(413, "Request too large")
+        try:
+            request = json.loads(await reader.readexactly(length) or b"{}")
+        except ValueError:
+            raise HTTPError(400, "Body is not valid JSON")
+        if not isinstance(request, dict) or not request.get("path"):
+            raise HTTPError(400, "Give the path of an IPA on this machine, or upload one")
+        input_path = self._allowed_path(request["path"])
+        options = {name: parse_option(name, value) for name, value in (request.get("options") or {}).items()}
+        return self.submit(input_path, directory, name=os.path.basename(input_path), preset=request.get("preset", ""),
+                           options=options, priority=self._priority(request.get("priority", 0)), job_id=job_id)
+
+    async def _create_from_upload(self, job_id, directory, length, query, reader):
+        """Stream the request body to disk as the job's input"""
+        if length > self.max_upload:
+            raise HTTPError(413, f"Uploads are limited to {self.max_upload} bytes")
+        options = {name: parse_option(name, value) for name, value in query.items() if name in CLIENT_OPTIONS}
+        priority = self._priority(query.get("priority", 0))
+        input_path = os.path.join(directory, "input.ipa")
+        with open(input_path, "wb") as f:
+            remaining = length
+            while remaining:
+                chunk = await reader.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise HTTPError(400, "Upload ended early")
+                # Off the event loop, so a slow disk doesn't stall other clients
+                await self._loop.run_in_executor(None, f.write, chunk)
+                remaining -= len(chunk)
+        return self.submit(input_path, directory, name=os.path.basename(query.get("name", "")) or "app.ipa",
+                           preset=query.get("preset", ""), options=options, priority=priority, uploaded=True,
+                           job_id=job_id)
+
+    def _priority(self, value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise HTTPError(400, f"Bad priority: {value}")
+
+    def _allowed_path(self, path):
+        real = os.path.realpath(path)
+        if not any(real == root or real.startswith(root + os.sep) for root in self.allowed_roots):
+            raise HTTPError(403, f"{path} is not under a folder this service signs from")
+        if not os.path.exists(real):
+            raise HTTPError(400, f"Input path does not exist: {path}")
+        return real
+
+    async def _send_head(self, writer, status, content_type, length=None, extra=()):
+        lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", f"Content-Type: {content_type}",
+                 "Connection: close", "Cache-Control: no-cache"]
+        if length is not None:
+            lines.append(f"Content-Length: {length}")
+        lines.extend(extra)
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def _send_json(self, writer, status, data):
+        body = json.dumps(data).encode()
+        await self._send_head(writer, status, "application/json", len(body))
+        writer.write(body)
+        await writer.drain()
+
+    async def _send_event(self, writer, event, data):
+        payload = data if isinstance(data, str) else json.dumps(data)
+        writer.write(f"event: {event}\ndata: {payload}\n\n".encode())
+        await writer.drain()
+
+    async def _stream_events(self, job, writer):
+        """Replay the job's log so far, then follow it until the job is done"""
+        queue = asyncio.Queue()
+        job.subscribers.append(queue)
+        # Taken before the first await, so nothing is missed or sent twice
+        backlog = list(job.log)
+        summary = job.summary()
+        done = job.done
+        try:
+            await self._send_head(writer, 200, "text/event-stream")
+            for line in backlog:
+                await self._send_event(writer, "log", line)
+            await self._send_event(writer, "status", summary)
+            if done:
+                await self._send_event(writer, "done", summary)
+                return
+            while True:
+                event, data = await queue.get()
+                await self._send_event(writer, event, data)
+                if event == "done":
+                    break
+        finally:
+            job.subscribers.remove(queue)
+
+    async def _send_download(self, job, writer):
+        if job.status != SUCCEEDED or not os.path.exists(job.output_path):
+            raise HTTPError(409 if not job.done else 404, f"Job {job.id} has no signed app ({job.status})")
+        stem = os.path.splitext(job.name)[0]
+        size = os.path.getsize(job.output_path)
+        await self._send_head(writer, 200, "application/octet-stream", size,
+                              [content_disposition(f"{stem}_signed.ipa")])
+        with open(job.output_path, "rb") as f:
+            while True:
+                chunk = await self._loop.run_in_executor(None, f.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
@@ -0,0 +1,198 @@
+import fnmatch
+import json
+import os
+import plistlib
+import shutil
+import struct
+import time
+import zipfile
+from dataclasses import dataclass, field, fields
+from types import SimpleNamespace
+
+from .ipainfo import app_prefix
+from .packaging import ZipWriter
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+
+# Storyboards and nibs are only complete with Base.lproj, so it's never dropped
+BASE_LOCALIZATION = "base"
+
+# Folders an app keeps its extensions in
+EXTENSION_FOLDERS = ("PlugIns", "Extensions")
+
+
+@dataclass
+class SlimRules:
+    """What to leave out of an app before it's signed, read from a JSON
+    file such as {"watch": true, "keep_localizations": ["en"]}. Paths are
+    relative to the .app folder."""
+    # Drop the Watch folder and the watchOS app in it
+    watch: bool = False
+    # Drop SC_Info folders, App Store DRM data a re-signed app can't use
+    sc_info: bool = False
+    # Localizations to keep, e.g. ["en", "de"]; empty keeps them all
+    keep_localizations: list = field(default_factory=list)
+    # App extensions to drop, by name or pattern, e.g. ["Widget", "*Intents*"] or ["*"]
+    extensions: list = field(default_factory=list)
+    # Any other files or folders to drop, as patterns, e.g. ["Frameworks/Debug*.framework"]
+    remove: list = field(default_factory=list)
+
+    def removes(self, rel_path):
+        """True if the file or folder at rel_path inside the app is left out"""
+        parts = rel_path.strip("/").split("/")
+        if self.watch and parts[0] == "Watch":
+            return True
+        if self.sc_info and "SC_Info" in parts:
+            return True
+        if self.keep_localizations:
+            keep = {name.lower() for name in self.keep_localizations} | {BASE_LOCALIZATION}
+            if any(part.endswith(".lproj") and part[:-len(".lproj")].lower() not in keep for part in parts):
+                return True
+        if self.extensions and len(parts) > 1 and parts[0] in EXTENSION_FOLDERS and parts[1].endswith(".appex"):
+            stem = parts[1][:-len(".appex")]
+            if any(fnmatch.fnmatchcase(stem, p) or fnmatch.fnmatchcase(parts[1], p) for p in self.extensions):
+                return True
+        return any(fnmatch.fnmatchcase("/".join(parts[:i]), pattern)
+                   for pattern in self.remove for i in range(1, len(parts) + 1))
+
+
+@dataclass
+class SlimResult:
+    """What slimming an app took out"""
+    files: int = 0
+    bytes: int = 0
+    kept_files: int = 0
+    kept_bytes: int = 0
+    elapsed: float = 0.0
+
+    def __str__(self):
+        return (f"Slimmed app: removed {self.files} files ({self.bytes / (1024 * 1024):.2f} MB) in "
+                f"{self.elapsed:.1f}s, {self.kept_files} files ({self.kept_bytes / (1024 * 1024):.2f} MB) left")
+
+
+def load_rules(path):
+    """SlimRules from a JSON file; raises ValueError if it isn't valid"""
+    with open(path) as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"{path}: {str(e)}")
+    if not isinstance(data, dict):
+        raise ValueError(f"{path}: expected an object of slimming rules")
+    known = {f.name: f for f in fields(SlimRules)}
+    unknown = set(data) - set(known)
+    if unknown:
+        raise ValueError(f"{path}: unknown slimming rules: {', '.join(sorted(unknown))}")
+    for name, value in data.items():
+        if known[name].type is bool and not isinstance(value, bool):
+            raise ValueError(f"{path}: {name} must be true or false")
+        if known[name].type is list and not (isinstance(value, list) and all(isinstance(v, str) for v in value)):
+            raise ValueError(f"{path}: {name} must be a list of names")
+    return SlimRules(**data)
+
+
+def _protected(info_plist):
+    """The app's own Info.plist and executable, which no rule may remove"""
+    try:
+        executable = plistlib.loads(info_plist).get("CFBundleExecutable", "")
+    except (plistlib.InvalidFileException, ValueError):
+        executable = ""
+    return {"Info.plist", executable} - {""}
+
+
+def _entry_stat(info):
+    mode = info.external_attr >> 16 or (0o40755 if info.is_dir() else 0o100644)
+    return SimpleNamespace(st_mode=mode, st_mtime=time.mktime(info.date_time + (0, 0, -1)))
+
+
+def slim_ipa(input_path, output_path, rules):
+    """Write a copy of an IPA without what rules remove and return a
+    SlimResult. Kept entries are copied still compressed, so this costs
+    about a read and a write of the IPA."""
+    start = time.monotonic()
+    result = SlimResult()
+    tmp = f"{output_path}.{os.getpid()}.tmp"
+    try:
+        with zipfile.ZipFile(input_path) as z, open(input_path, "rb") as src, open(tmp, "wb") as out:
+            infos = z.infolist()
+            prefix = app_prefix(info.filename for info in infos)
+            if not prefix:
+                raise ValueError(f"{os.path.basename(input_path)}: no Payload/*.app/Info.plist inside")
+            protected = _protected(z.read(prefix + "Info.plist"))
+            writer = ZipWriter(out)
+            for info in infos:
+                rel = info.filename[len(prefix):] if info.filename.startswith(prefix) else ""
+                if rel and rel not in protected and rules.removes(rel):
+                    if not info.is_dir():
+                        result.files += 1
+                        result.bytes += info.file_size
+                    continue
+                src.seek(info.header_offset)
+                header = LOCAL_HEADER.unpack(src.read(LOCAL_HEADER.size))
+                src.seek(info.header_offset + LOCAL_HEADER.size + header[9] + header[10])
+                writer.add_stream(info.filename, _entry_stat(info), info.compress_type, info.CRC,
+                                  info.compress_size, info.file_size, src)
+                if not info.is_dir():
+                    result.kept_files += 1
+                    result.kept_bytes += info.file_size
+            writer.close()
+        os.replace(tmp, output_path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    result.elapsed = time.monotonic() - start
+    return result
+
+
+def _find_app(folder):
+    if folder.rstrip(os.sep).endswith(".app"):
+        return folder
+    payload = os.path.join(folder, "Payload")
+    root = payload if os.path.isdir(payload) else folder
+    apps = sorted(name for name in os.listdir(root) if name.endswith(".app"))
+    if not apps:
+        raise ValueError(f"{folder}: no .app inside")
+    return os.path.join(root, apps[0])
+
+
+def _remove_tree(path, result):
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            result.files += 1
+            result.bytes += os.lstat(os.path.join(dirpath, name)).st_size
+    shutil.rmtree(path)
+
+
+def slim_tree(folder, rules):
+    """Remove what rules leave out from an extracted app, in place, and
+    return a SlimResult. Only for copies: a workspace checkout or an app
+    unpacked for this job, never the user's own folder."""
+    start = time.monotonic()
+    result = SlimResult()
+    app = _find_app(folder)
+    with open(os.path.join(app, "Info.plist"), "rb") as f:
+        protected = _protected(f.read())
+    for dirpath, dirnames, filenames in os.walk(app):
+        rel_dir = os.path.relpath(dirpath, app).replace(os.sep, "/")
+        rel_dir = "" if rel_dir == "." else rel_dir + "/"
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            if rules.removes(rel_dir + name):
+                dirnames.remove(name)
+                if os.path.islink(path):
+                    os.remove(path)
+                    result.files += 1
+                else:
+                    _remove_tree(path, result)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            size = os.lstat(path).st_size
+            if rel_dir + name not in protected and rules.removes(rel_dir + name):
+                os.remove(path)
+                result.files += 1
+                result.bytes += size
+            else:
+                result.kept_files += 1
+                result.kept_bytes += size
+    result.elapsed = time.monotonic() - start
+    return result
@@ -0,0 +1,234 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+
+from .paths import cache_dir
+
+# Directory containing zsign_gui.py (and the bundled bin/ folder)
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def zsign_search_paths(base_dir=BASE_DIR):
+    """Candidate zsign locations for this platform, most preferred first"""
+    # Get home directory
+    home_dir = os.path.expanduser("~")
+
+    if sys.platform == "darwin":
+        # macOS
+        paths = [
+            os.path.join(base_dir, "bin", "zsign"),                  # Local bin directory
+            os.path.join(base_dir, "zsign_exe"),
+            os.path.join(base_dir, "zsign/bin/zsign"),
+            os.path.join(base_dir, "build", "macos", "zsign"),
+            os.path.join(base_dir, "zsign"),
+            "/usr/local/bin/zsign",
+            "/opt/homebrew/bin/zsign",                               # Homebrew on Apple Silicon
+            os.path.join(home_dir, "zsign/bin/zsign"),               # User's home directory
+            os.path.join(home_dir, "bin/zsign"),
+            os.path.join(home_dir, ".local/bin/zsign"),
+            "/usr/local/zsign/bin/zsign",
+            "/usr/local/bin/zsign",
+            "/usr/local/zsign/bin/zsign",
+            "/zsign/bin/zsign"
+        ]
+
+        # Look for zsign in PATH
+        path = shutil.which("zsign")
+        if path:
+            paths.insert(0, path)  # Add to beginning of list
+
+    elif sys.platform.startswith("linux"):
+        # Linux
+        paths = [
+            os.path.join(base_dir, "bin", "zsign"),
+            os.path.join(base_dir, "build", "linux", "zsign"),
+            os.path.join(base_dir, "zsign"),
+            os.path.join(home_dir, "zsign/bin/zsign"),
+            os.path.join(home_dir, "bin/zsign"),
+            os.path.join(home_dir, ".local/bin/zsign"),
+            "/usr/local/bin/zsign",
+            "/usr/bin/zsign"
+        ]
+    elif sys.platform == "win32":
+        # Windows
+        paths = [
+            os.path.join(base_dir, "bin", "zsign.exe"),
+            os.path.join(base_dir, "build", "windows", "vs2022", "x64", "Release", "zsign.exe"),
+            os.path.join(base_dir, "zsign.exe")
+        ]
+    else:
+        # Unknown platform
+        paths = []
+
+    return paths
+
+
+def _is_executable(path):
+    return os.path.isfile(path) and (sys.platform == "win32" or os.access(path, os.X_OK))
+
+
+def find_zsign_binary(base_dir=BASE_DIR, verbose=False, use_cache=True):
+    """Return the path of the first usable zsign binary, or None.
+
+    The result is cached on disk and reused while the file's mtime and inode
+    are unchanged, so most launches skip the search entirely."""
+    if use_cache:
+        path = cached_tool_path("zsign")
+        if path:
+            if verbose:
+                print(f"Using cached zsign binary: {path}")
+            return path
+
+    paths = zsign_search_paths(base_dir)
+
+    if verbose:
+        # Print search paths to output for debugging
+        print(f"Searching for zsign binary in the following paths:")
+        for path in paths:
+            print(f"  - {path}")
+
+    # Check if binary exists and is executable; zsign may also be the cloned
+    # source directory next to the script, which we skip
+    for path in paths:
+        if _is_executable(path):
+            if verbose:
+                print(f"Found zsign binary at: {path}")
+            remember_tool("zsign", path)
+            return path
+
+    return None
+
+
+def find_ideviceinstaller(use_cache=True):
+    """Find ideviceinstaller binary for easy installation to device"""
+    if use_cache:
+        path = cached_tool_path("ideviceinstaller")
+        if path:
+            return path
+
+    if sys.platform == "darwin":
+        # Check common paths on macOS, then PATH
+        paths = [
+            "/usr/local/bin/ideviceinstaller",
+            "/opt/homebrew/bin/ideviceinstaller",
+            shutil.which("ideviceinstaller")
+        ]
+
+        for path in paths:
+            if path and _is_executable(path):
+                remember_tool("ideviceinstaller", path)
+                return path
+
+    return None
+
+
+def find_idevice_tool(name, use_cache=True):
+    """Find a libimobiledevice tool such as idevice_id or ideviceinfo,
+    looking next to ideviceinstaller first"""
+    if use_cache:
+        path = cached_tool_path(name)
+        if path:
+            return path
+
+    paths = []
+    installer = cached_tool_path("ideviceinstaller")
+    if installer:
+        paths.append(os.path.join(os.path.dirname(installer), name))
+    if sys.platform == "darwin":
+        paths.extend([f"/usr/local/bin/{name}", f"/opt/homebrew/bin/{name}"])
+    paths.append(shutil.which(name))
+
+    for path in paths:
+        if path and _is_executable(path):
+            remember_tool(name, path)
+            return path
+
+    return None
+
+
+def get_zsign_version(zsign_path):
+    """Return what 'zsign -v' prints, cached alongside the binary's path"""
+    entry = _cached_entry("zsign")
+    if entry and entry.get("path") == zsign_path and entry.get("version") is not None:
+        return entry["version"]
+
+    result = subprocess.run([zsign_path, "-v"],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            text=True)
+    version = result.stdout.strip() or result.stderr.strip()
+    if result.returncode == 0:
+        remember_tool("zsign", zsign_path, version=version)
+    return version
+
+
+# On-disk cache of resolved tool paths, keyed by tool name
+CACHE_FILE = "tools.json"
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return {"mtime_ns": st.st_mtime_ns, "ino": st.st_ino, "size": st.st_size}
+
+
+def _load_cache():
+    global _cache
+    if _cache is None:
+        try:
+            with open(cache_dir(CACHE_FILE)) as f:
+                _cache = json.load(f)
+            if not isinstance(_cache, dict):
+                _cache = {}
+        except (OSError, ValueError):
+            _cache = {}
+    return _cache
+
+
+def _cached_entry(name):
+    """Return the cache entry for a tool if the file hasn't changed since"""
+    with _cache_lock:
+        entry = _load_cache().get(name)
+    if not isinstance(entry, dict) or not entry.get("path"):
+        return None
+    try:
+        if _stamp(entry["path"]) != entry.get("stamp") or not _is_executable(entry["path"]):
+            return None
+    except OSError:
+        return None
+    return entry
+
+
+def cached_tool_path(name):
+    entry = _cached_entry(name)
+    return entry["path"] if entry else None
+
+
+def remember_tool(name, path, **extra):
+    """Record a tool's path (and extras like its version) in the cache"""
+    try:
+        entry = {"path": path, "stamp": _stamp(path)}
+    except OSError:
+        return
+    with _cache_lock:
+        cache = _load_cache()
+        previous = cache.get(name)
+        if isinstance(previous, dict) and previous.get("path") == path and previous.get("stamp") == entry["stamp"]:
+            entry = {**previous, **entry}
+        entry.update(extra)
+        cache[name] = entry
+
+        path = cache_dir(CACHE_FILE)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(cache, f, indent=2)
+            os.replace(tmp, path)
+        except OSError:
+            pass
@@ -0,0 +1,310 @@
+import fnmatch
+import os
+import plistlib
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+from .ipainfo import app_prefix, bundle_id_of, profile_plist
+
+# Verifying reads every byte of the IPA; two processes keep up with signing
+# without taking the cores zsign and packaging are using
+MAX_WORKERS = 2
+READ_SIZE = 1024 * 1024
+
+# Problems listed in a one-line summary before the rest are counted
+SHOWN_PROBLEMS = 3
+
+MH_MAGIC = 0xFEEDFACE
+MH_MAGIC_64 = 0xFEEDFACF
+FAT_MAGIC = 0xCAFEBABE
+FAT_MAGIC_64 = 0xCAFEBABF
+# Java class files share the fat magic, but their version number, where a
+# fat header has its slice count, is always above this
+MAX_FAT_SLICES = 30
+LC_CODE_SIGNATURE = 0x1D
+CSMAGIC_EMBEDDED_SIGNATURE = 0xFADE0CC0
+# Anything claiming more load commands than this is damaged
+MAX_LOAD_COMMANDS_SIZE = 16 * 1024 * 1024
+
+BUNDLE_EXTENSIONS = (".app", ".appex", ".framework")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+@dataclass
+class Verification:
+    """What checking a signed IPA found; no problems means it's fine to ship"""
+    path: str
+    entries: int = 0
+    binaries: int = 0
+    bytes_read: int = 0
+    elapsed: float = 0.0
+    problems: list = field(default_factory=list)
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    def __str__(self):
+        name = os.path.basename(self.path)
+        if self.ok:
+            return (f"Verified {name}: {self.entries} entries intact, {self.binaries} binaries signed "
+                    f"({self.bytes_read / (1024 * 1024):.2f} MB in {self.elapsed:.1f}s)")
+        text = "; ".join(self.problems[:SHOWN_PROBLEMS])
+        if len(self.problems) > SHOWN_PROBLEMS:
+            text += f" and {len(self.problems) - SHOWN_PROBLEMS} more problems"
+        return f"Verification of {name} failed: {text}"
+
+
+class _MachO:
+    """Reads what it needs of one file as its bytes stream past: the Mach-O
+    header, each slice's load commands and the start of its code signature.
+    Linkers lay these out in that order, so one pass is enough."""
+
+    def __init__(self):
+        self.position = 0
+        self.wants = []
+        self.macho = False
+        self.slices = 0
+        self.unsigned = 0
+        self.damaged = 0
+        self._want(0, 8, self._magic)
+
+    def _want(self, start, length, handler):
+        if start < self.position:
+            self.damaged += 1
+            return
+        self.wants.append([start, length, bytearray(), handler])
+
+    def feed(self, chunk):
+        end = self.position + len(chunk)
+        progress = True
+        while progress:
+            progress = False
+            for want in list(self.wants):
+                start, length, data, handler = want
+                need = start + len(data)
+                if not self.position <= need < end:
+                    continue
+                data += chunk[need - self.position:min(start + length, end) - self.position]
+                if len(data) == length:
+                    self.wants.remove(want)
+                    handler(bytes(data))
+                    progress = True
+        self.position = end
+
+    def _magic(self, data):
+        magic, count = struct.unpack(">II", data)
+        if magic in (FAT_MAGIC, FAT_MAGIC_64):
+            if 0 < count <= MAX_FAT_SLICES:
+                self.macho = True
+                size = 32 if magic == FAT_MAGIC_64 else 20
+                self._want(8, count * size, lambda archs: self._fat(archs, magic == FAT_MAGIC_64))
+        elif magic in (MH_MAGIC, MH_MAGIC_64) or struct.unpack("<I", data[:4])[0] in (MH_MAGIC, MH_MAGIC_64):
+            self.macho = True
+            self._slice(0)
+
+    def _fat(self, archs, wide):
+        arch = struct.Struct(">iiQQII" if wide else ">iiIII")
+        offsets = sorted(arch.unpack_from(archs, i * arch.size)[2] for i in range(len(archs) // arch.size))
+        for offset in offsets:
+            self._slice(offset)
+
+    def _slice(self, base):
+        self.slices += 1
+        self._want(base, 28, lambda header: self._header(base, header))
+
+    def _header(self, base, header):
+        for order in "<>":
+            magic, = struct.unpack_from(f"{order}I", header)
+            if magic in (MH_MAGIC, MH_MAGIC_64):
+                break
+        else:
+            self.damaged += 1
+            return
+        ncmds, size = struct.unpack_from(f"{order}II", header, 16)
+        if size > MAX_LOAD_COMMANDS_SIZE:
+            self.damaged += 1
+            return
+        start = base + (32 if magic == MH_MAGIC_64 else 28)
+        self._want(start, size, lambda commands: self._commands(base, order, ncmds, commands))
+
+    def _commands(self, base, order, ncmds, commands):
+        offset = 0
+        for _ in range(ncmds):
+            if offset + 8 > len(commands):
+                break
+            cmd, size = struct.unpack_from(f"{order}II", commands, offset)
+            if cmd == LC_CODE_SIGNATURE and offset + 16 <= len(commands):
+                dataoff, _ = struct.unpack_from(f"{order}II", commands, offset + 8)
+                self._want(base + dataoff, 4, self._signature)
+                return
+            if size < 8:
+                break
+            offset += size
+        self.unsigned += 1
+
+    def _signature(self, blob):
+        if struct.unpack(">I", blob)[0] != CSMAGIC_EMBEDDED_SIGNATURE:
+            self.damaged += 1
+
+    def problem(self):
+        """Why this Mach-O isn't properly signed, or "" if it is"""
+        if self.damaged or self.wants:
+            return "code signature is damaged or cut short"
+        if self.unsigned:
+            return "not signed" if self.unsigned == self.slices else "not every architecture is signed"
+        return ""
+
+
+def _is_bundle_plist(name, prefix):
+    """True for the Info.plist at the root of the app or of a bundle inside it"""
+    folder, _, base = name.rpartition("/")
+    return base == "Info.plist" and name.startswith(prefix) and folder.endswith(BUNDLE_EXTENSIONS)
+
+
+def verify_ipa(path, bundle_id="", profile="", dylib=""):
+    """Check a signed IPA from end to end and return a Verification.
+
+    Every entry is read through, so zipfile checks its CRC; every Mach-O
+    file in the app must carry a code signature, including the main
+    executable and those of frameworks and plugins, which must also exist.
+    The app's bundle ID must be bundle_id, with plugins' IDs under it, the
+    embedded profile must be the one at profile, and an injected dylib
+    must be in the app. Meant for a worker process, so only paths go in."""
+    start = time.monotonic()
+    verification = Verification(path)
+    problems = verification.problems
+    plists = {}
+    binaries = {}
+    try:
+        with zipfile.ZipFile(path) as z:
+            infos = [info for info in z.infolist() if not info.is_dir()]
+            prefix = app_prefix(info.filename for info in infos)
+            if not prefix:
+                problems.append("no Payload/*.app/Info.plist inside")
+                return verification
+            for info in infos:
+                name = info.filename
+                inside = name.startswith(prefix)
+                scanner = _MachO() if inside else None
+                keep = inside and (_is_bundle_plist(name, prefix) or name == prefix + "embedded.mobileprovision")
+                kept = bytearray()
+                try:
+                    with z.open(info) as f:
+                        for chunk in iter(lambda: f.read(READ_SIZE), b""):
+                            verification.bytes_read += len(chunk)
+                            if scanner and (scanner.wants or not scanner.position):
+                                scanner.feed(chunk)
+                            if keep:
+                                kept += chunk
+                except (zipfile.BadZipFile, zipfile.LargeZipFile, zlib.error, NotImplementedError, RuntimeError,
+                        EOFError, OSError) as e:
+                    # zipfile raises BadZipFile for a CRC mismatch
+                    message = str(e) or type(e).__name__
+                    problems.append(message if name in message else f"{name}: {message}")
+                    continue
+                verification.entries += 1
+                if scanner and scanner.macho:
+                    binaries[name[len(prefix):]] = scanner.problem()
+                if keep:
+                    plists[name[len(prefix):]] = bytes(kept)
+    except (zipfile.BadZipFile, OSError) as e:
+        problems.append(f"not a readable IPA: {str(e)}")
+        return verification
+    finally:
+        verification.binaries = sum(1 for problem in binaries.values() if not problem)
+        verification.elapsed = time.monotonic() - start
+
+    for name, problem in sorted(binaries.items()):
+        if problem:
+            problems.append(f"{name}: {problem}")
+    if "_CodeSignature/CodeResources" not in {info.filename[len(prefix):] for info in infos}:
+        problems.append("_CodeSignature/CodeResources is missing")
+    main_id = _check_bundles(plists, binaries, bundle_id, problems)
+    if profile:
+        _check_profile(plists.get("embedded.mobileprovision"), profile, main_id, problems)
+    if dylib and not any(os.path.basename(name) == dylib for name in binaries):
+        problems.append(f"injected {dylib} is not in the app")
+    return verification
+
+
+def _check_bundles(plists, binaries, bundle_id, problems):
+    """Check each bundle's executable and ID and return the app's bundle ID"""
+    main_id = ""
+    for name, data in sorted(plists.items(), key=lambda item: item[0].count("/")):
+        if not name.endswith("Info.plist"):
+            continue
+        folder = name[:-len("Info.plist")]
+        try:
+            info = plistlib.loads(data)
+        except (plistlib.InvalidFileException, ValueError) as e:
+            problems.append(f"{name}: can't be read ({str(e)})")
+            continue
+        executable = info.get("CFBundleExecutable", "")
+        if executable and folder + executable not in binaries:
+            problems.append(f"{folder + executable}: executable is missing or not a Mach-O file")
+        identifier = info.get("CFBundleIdentifier", "")
+        if not folder:
+            main_id = identifier
+            if bundle_id and identifier != bundle_id:
+                problems.append(f"bundle ID is {identifier or 'missing'}, expected {bundle_id}")
+        elif folder.rstrip("/").endswith(".appex") and main_id and not identifier.startswith(main_id + "."):
+            problems.append(f"{folder.rstrip('/')}: bundle ID {identifier} is not under {main_id}")
+    return main_id
+
+
+def _check_profile(embedded, profile, bundle_id, problems):
+    if embedded is None:
+        problems.append("embedded.mobileprovision is missing")
+        return
+    try:
+        with open(profile, "rb") as f:
+            expected = f.read()
+    except OSError as e:
+        problems.append(f"can't read requested profile: {str(e)}")
+        return
+    try:
+        info = profile_plist(embedded)
+        if embedded != expected:
+            wanted = profile_plist(expected).get("UUID", "?")
+            problems.append(f"embedded profile {info.get('UUID', '?')} is not the requested "
+                            f"{os.path.basename(profile)} ({wanted})")
+            return
+    except (ValueError, plistlib.InvalidFileException) as e:
+        problems.append(f"embedded.mobileprovision can't be read ({str(e)})")
+        return
+    entitlements = info.get("Entitlements", {})
+    app_id = entitlements.get("application-identifier") or entitlements.get("com.apple.application-identifier", "")
+    # The team ID comes first, e.g. ABCDE12345.com.example.*
+    pattern = app_id.partition(".")[2]
+    if pattern and bundle_id and not fnmatch.fnmatchcase(bundle_id, pattern):
+        problems.append(f"profile {info.get('Name', '')} is for {pattern}, not {bundle_id}")
+
+
+def verify_pool():
+    """The process pool verifications run in, started on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=MAX_WORKERS)
+        return _pool
+
+
+def verify_job(job):
+    """Start verifying a signed job's output against what the job asked for
+    and return a Future of its Verification"""
+    bundle_id = job.bundle_id or bundle_id_of(job.input_path)
+    return verify_pool().submit(verify_ipa, job.output_path, bundle_id, "" if job.adhoc else job.prov,
+                                os.path.basename(job.dylib) if job.dylib else "")
+
+
+def can_verify(job):
+    """True if the job leaves a signed IPA behind to verify"""
+    return bool(job.output_path) and os.path.isfile(job.output_path)
@@ -0,0 +1,344 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import shutil
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from . import engine
+from .engine import SignError
+from .presets import Presets
+from .verify import can_verify, verify_job
+
+# A file counts as written once its size and mtime hold still this long
+DEFAULT_SETTLE_SECONDS = 2.0
+# How often the inbox is listed when inotify isn't available
+POLL_SECONDS = 1.0
+# Listed anyway now and then with inotify, in case an event was missed
+RESCAN_SECONDS = 30.0
+
+INPUT_EXTENSIONS = (".ipa",)
+
+# Folders the watcher keeps inside the inbox and outbox; skipped when listing
+PROCESSING_DIR = ".processing"
+INCOMING_DIR = ".incoming"
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct("iIII")
+
+
+class _Inotify:
+    """Just enough of Linux's inotify, through ctypes, to wake up when
+    something is written to or moved into a folder and to tell which files
+    are still open for writing"""
+
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = {}
+        # Files created or written to that haven't been closed yet
+        self.writing = set()
+
+    def watch(self, path):
+        if path in self.watched.values():
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"can't watch {path}")
+        self.watched[wd] = path
+
+    def drain(self):
+        """Read every pending event and note which files are being written"""
+        try:
+            while True:
+                data = os.read(self.fd, 65536)
+                if not data:
+                    break
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = EVENT.unpack_from(data, offset)
+                    name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+                    offset += EVENT.size + length
+                    folder = self.watched.get(wd)
+                    if not folder or not name:
+                        continue
+                    path = os.path.join(folder, os.fsdecode(name))
+                    if mask & (IN_CREATE | IN_MODIFY):
+                        self.writing.add(path)
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        self.writing.discard(path)
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """Sign every IPA that lands in an inbox folder.
+
+    Files directly in the inbox are signed with the default preset and files
+    in a subfolder named after a preset with that one. Once a file has
+    settled it is moved under inbox/.processing and signed by one of
+    max_workers threads; the signed app goes to the same place under outbox
+    and the input is removed, or on failure the input and its log go to the
+    failed folder. on_event(message) reports progress from any thread. With
+    verify, a signed app only reaches the outbox once it has passed
+    verification, which runs after the job has given up its scheduler slot."""
+
+    def __init__(self, zsign_path, inbox, outbox, failed_dir, template, presets=None, default_preset="",
+                 max_workers=2, settle_seconds=DEFAULT_SETTLE_SECONDS, cache=None, workspace=None, metrics=None,
+                 on_event=None, use_inotify=True, scheduler=None, scratch=None, verify=False):
+        self.presets = Presets(presets, template)
+        if default_preset and default_preset not in self.presets:
+            raise SignError(f"Unknown preset: {default_preset}")
+        self.zsign_path = zsign_path
+        self.inbox = os.path.abspath(inbox)
+        self.outbox = os.path.abspath(outbox)
+        self.failed_dir = os.path.abspath(failed_dir)
+        self.default_preset = default_preset
+        self.max_workers = max(1, max_workers)
+        self.settle_seconds = settle_seconds
+        self.cache = cache
+        self.workspace = workspace
+        self.metrics = metrics
+        self.scheduler = scheduler
+        self.scratch = scratch
+        self.verify = verify
+        self.on_event = on_event
+        self.use_inotify = use_inotify and sys.platform.startswith("linux")
+        self.signed = 0
+        self.failed = 0
+        self._seen = {}
+        self._running = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._wake_pipe = None
+
+    def _event(self, message):
+        if self.on_event:
+            self.on_event(message)
+
+    def stop(self):
+        """Stop taking new files; run() returns once the running jobs finish"""
+        self._stop.set()
+        self.wake()
+
+    def wake(self):
+        self._wake.set()
+        if self._wake_pipe:
+            try:
+                os.write(self._wake_pipe[1], b"x")
+            except OSError:
+                pass
+
+    def run(self):
+        for path in (self.inbox, self.outbox, self.failed_dir):
+            os.makedirs(path, exist_ok=True)
+        self._requeue_interrupted()
+
+        inotify = None
+        if self.use_inotify:
+            try:
+                inotify = _Inotify()
+                self._wake_pipe = os.pipe()
+            except (OSError, AttributeError) as e:
+                self._event(f"inotify unavailable ({str(e)}), polling every {POLL_SECONDS:.0f}s")
+                inotify = None
+        self._event(f"Watching {self.inbox} with {self.max_workers} workers"
+                    f"{' (inotify)' if inotify else ''}")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="watch") as pool:
+            try:
+                while not self._stop.is_set():
+                    folders = self._folders()
+                    if inotify:
+                        for folder in folders:
+                            inotify.watch(folder)
+                    settled = self._settled(folders, inotify.writing if inotify else ())
+                    if inotify:
+                        # Forget files that were deleted before they were closed
+                        inotify.writing &= set(self._seen)
+                    for path, preset in settled:
+                        with self._lock:
+                            if self._running >= self.max_workers:
+                                break
+                            self._running += 1
+                        claimed = self._claim(path, preset)
+                        if claimed:
+                            pool.submit(self._sign, claimed, preset)
+                        else:
+                            with self._lock:
+                                self._running -= 1
+                    self._wait(inotify)
+            finally:
+                if inotify:
+                    inotify.close()
+                if self._wake_pipe:
+                    for fd in self._wake_pipe:
+                        os.close(fd)
+                    self._wake_pipe = None
+        self._event(f"Stopped: {self.signed} signed, {self.failed} failed")
+
+    def _wait(self, inotify):
+        """Sleep until something changes, a job finishes or a pending file may have settled"""
+        timeout = POLL_SECONDS
+        if inotify:
+            timeout = self.settle_seconds / 2 if self._seen else RESCAN_SECONDS
+            ready, _, _ = select.select([inotify.fd, self._wake_pipe[0]], [], [], timeout)
+            if inotify.fd in ready:
+                inotify.drain()
+            if self._wake_pipe[0] in ready:
+                os.read(self._wake_pipe[0], 4096)
+        else:
+            self._wake.wait(timeout)
+        self._wake.clear()
+
+    def _folders(self):
+        """The inbox and its preset subfolders"""
+        folders = [self.inbox]
+        for name in self.presets:
+            path = os.path.join(self.inbox, name)
+            if os.path.isdir(path):
+                folders.append(path)
+        return folders
+
+    def _settled(self, folders, writing=()):
+        """(path, preset) of each input whose size and mtime have held still
+        for settle_seconds, oldest first, leaving out files inotify saw
+        opened for writing and not closed yet"""
+        now = time.monotonic()
+        present = set()
+        ready = []
+        for folder in folders:
+            preset = self.default_preset if folder == self.inbox else os.path.basename(folder)
+            try:
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.name.lower().endswith(INPUT_EXTENSIONS):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if not entry.is_file():
+                    continue
+                present.add(entry.path)
+                stamp = (st.st_size, st.st_mtime_ns)
+                seen = self._seen.get(entry.path)
+                if not seen or seen[0] != stamp:
+                    self._seen[entry.path] = (stamp, now)
+                elif now - seen[1] >= self.settle_seconds and entry.path not in writing:
+                    ready.append((st.st_mtime_ns, entry.path, preset))
+        for path in list(self._seen):
+            if path not in present:
+                del self._seen[path]
+        ready.sort()
+        return [(path, preset) for _, path, preset in ready]
+
+    def _claim(self, path, preset):
+        """Move a settled input under .processing so no one else picks it up"""
+        self._seen.pop(path, None)
+        dest = os.path.join(self.inbox, PROCESSING_DIR, os.path.relpath(path, self.inbox))
+        try:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(path, dest)
+        except OSError as e:
+            self._event(f"Could not take {path}: {str(e)}")
+            return None
+        return dest
+
+    def _requeue_interrupted(self):
+        """Put back inputs left in .processing by a watcher that was stopped mid-job"""
+        processing = os.path.join(self.inbox, PROCESSING_DIR)
+        for dirpath, _, names in os.walk(processing):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                dest = os.path.join(self.inbox, os.path.relpath(path, processing))
+                try:
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    os.replace(path, dest)
+                    self._event(f"Retrying interrupted {os.path.relpath(dest, self.inbox)}")
+                except OSError:
+                    pass
+
+    def _sign(self, path, preset):
+        relative = os.path.relpath(path, os.path.join(self.inbox, PROCESSING_DIR))
+        name = os.path.basename(path)
+        output = os.path.join(self.outbox, relative)
+        incoming = os.path.join(self.outbox, INCOMING_DIR, relative)
+        log = []
+        try:
+            os.makedirs(os.path.dirname(incoming), exist_ok=True)
+            job, match = self.presets.job(preset, path, incoming)
+            if match:
+                self._event(f"[{name}] Using {match}")
+            admitted = nullcontext()
+            if self.scheduler:
+                admitted = self.scheduler.admit(job, self.workspace, scratch=self.scratch,
+                                                on_wait=lambda reason: self._event(f"[{name}] Waiting: {reason}"))
+            with admitted:
+                self._event(f"[{name}] Signing{f' with preset {preset}' if preset else ''}")
+                result = engine.run(self.zsign_path, job, on_output=log.append, cache=self.cache,
+                                    workspace=self.workspace, metrics=self.metrics, background=True,
+                                    scratch=self.scratch)
+            if not result.ok:
+                raise SignError(f"zsign exited with code {result.returncode}")
+            if self.verify and can_verify(job):
+                try:
+                    verification = verify_job(job).result()
+                except Exception as e:
+                    raise SignError(f"Could not verify the signed app: {str(e) or type(e).__name__}")
+                log.append(str(verification))
+                if not verification.ok:
+                    raise SignError(f"output failed verification: {'; '.join(verification.problems)}")
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            # Only complete files ever appear in the outbox
+            os.replace(incoming, output)
+            os.remove(path)
+            with self._lock:
+                self.signed += 1
+            self._event(f"[{name}] Signed in {result.elapsed:.1f}s -> {output}")
+        except Exception as e:
+            # A bug fails the file too, rather than leaving it in processing uncounted
+            error = str(e) if isinstance(e, (SignError, OSError, ValueError)) else f"{type(e).__name__}: {str(e)}"
+            with self._lock:
+                self.failed += 1
+            log.append(f"Error: {error}")
+            self._fail(path, relative, log)
+            self._event(f"[{name}] Failed: {error}")
+        finally:
+            try:
+                os.remove(incoming)
+            except OSError:
+                pass
+            with self._lock:
+                self._running -= 1
+            self.wake()
+
+    def _fail(self, path, relative, log):
+        dest = os.path.join(self.failed_dir, relative)
+        try:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.move(path, dest)
+            with open(f"{dest}.log", "w") as f:
+                f.write("\n".join(log) + "\n")
+        except OSError as e:
+            self._event(f"Could not move {path} to {self.failed_dir}: {str(e)}")
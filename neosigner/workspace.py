@@ -0,0 +1,325 @@
+import json
+import os
+import shutil
+import stat
+import threading
+import time
+import uuid
+import zipfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .digest import file_digest
+from .paths import cache_dir
+
+DEFAULT_QUOTA_BYTES = 20 * 1024 ** 3
+
+# Files zsign rewrites while signing a folder. Everything else is hardlinked
+# into each checkout, so only these need a private copy.
+MUTABLE_NAMES = {"Info.plist", "embedded.mobileprovision", "PkgInfo", "CodeResources"}
+MACHO_MAGICS = {
+    b"\xfe\xed\xfa\xce", b"\xce\xfa\xed\xfe",   # 32-bit
+    b"\xfe\xed\xfa\xcf", b"\xcf\xfa\xed\xfe",   # 64-bit
+    b"\xca\xfe\xba\xbe", b"\xbe\xba\xfe\xca",   # fat
+}
+
+COPY_BUFFER = 1024 * 1024
+
+# ioctl that makes a copy-on-write clone of a file on btrfs, XFS and other
+# Linux filesystems with reflinks
+FICLONE = 0x40049409
+
+
+def is_macho_header(data):
+    return data[:4] in MACHO_MAGICS
+
+
+def is_mutable(rel_path, header):
+    """True for files zsign may rewrite in place: Mach-O binaries, bundle
+    plists, profiles and anything under _CodeSignature"""
+    parts = rel_path.split("/")
+    return parts[-1] in MUTABLE_NAMES or "_CodeSignature" in parts or is_macho_header(header)
+
+
+def safe_member_path(root, name):
+    """Where a zip member should be extracted, or None if it would escape root"""
+    name = name.replace("\\", "/")
+    if name.startswith("/") or any(part == ".." for part in name.split("/")):
+        return None
+    return os.path.join(root, *[part for part in name.split("/") if part])
+
+
+def _inside(root, path):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def extract_ipa(ipa_path, dest):
+    """Extract an IPA into dest, keeping file modes and symlinks.
+
+    Members that would land outside dest, directly or through a symlink,
+    and symlinks that point outside it are skipped. Returns (total_bytes,
+    file_count, mutable_files) where mutable_files are the relative paths
+    zsign may rewrite."""
+    total = 0
+    count = 0
+    mutable = []
+    os.makedirs(dest, exist_ok=True)
+    root = os.path.realpath(dest)
+    with zipfile.ZipFile(ipa_path) as zf:
+        for info in zf.infolist():
+            target = safe_member_path(dest, info.filename)
+            if target is None or target == dest:
+                continue
+            # A symlink extracted earlier mustn't lead a member out of dest
+            if not _inside(root, os.path.realpath(os.path.dirname(target))) or os.path.islink(target):
+                continue
+            mode = info.external_attr >> 16
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            rel = os.path.relpath(target, dest).replace(os.sep, "/")
+            if stat.S_ISLNK(mode):
+                link = zf.read(info).decode("utf-8")
+                resolved = os.path.realpath(os.path.join(os.path.dirname(target), link))
+                if not os.path.isabs(link) and _inside(root, resolved) and not os.path.lexists(target):
+                    os.symlink(link, target)
+                continue
+
+            with zf.open(info) as src, open(target, "wb") as out:
+                header = src.read(COPY_BUFFER)
+                out.write(header)
+                shutil.copyfileobj(src, out, COPY_BUFFER)
+            if mode & 0o777:
+                os.chmod(target, mode & 0o777)
+            if is_mutable(rel, header):
+                mutable.append(rel)
+            total += info.file_size
+            count += 1
+    return total, count, mutable
+
+
+def copy_file(source, target):
+    """Copy a file with its mode and times, as a reflink that shares the
+    data blocks until either side is written when the filesystem can"""
+    if fcntl:
+        try:
+            with open(source, "rb") as src, open(target, "wb") as out:
+                fcntl.ioctl(out.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, target)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, target)
+
+
+def clone_tree(src, dest, mutable=None):
+    """Recreate src at dest using hardlinks, with real copies of the files
+    listed in mutable (relative paths) so writes to them stay private.
+    Those are reflinked where possible, so a variant only pays for the
+    blocks zsign actually rewrites. Falls back to copying when hardlinks
+    aren't possible."""
+    mutable = set(mutable or ())
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel_dir = os.path.relpath(dirpath, src)
+        out_dir = dest if rel_dir == "." else os.path.join(dest, rel_dir)
+        os.makedirs(out_dir, exist_ok=True)
+        for name in dirnames + filenames:
+            source = os.path.join(dirpath, name)
+            target = os.path.join(out_dir, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                if name in dirnames:
+                    dirnames.remove(name)
+                continue
+            if name in dirnames:
+                continue
+
+            rel = name if rel_dir == "." else f"{rel_dir.replace(os.sep, '/')}/{name}"
+            if rel in mutable:
+                copy_file(source, target)
+                continue
+            try:
+                os.link(source, target)
+            except OSError:
+                copy_file(source, target)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class Workspace:
+    """Extracted copies of IPAs, keyed by the IPA's content hash.
+
+    Each distinct IPA is unzipped once. Every signing then gets a cheap
+    checkout (hardlinks, plus private copies of the files zsign rewrites)
+    that zsign signs as a folder. Least recently used extractions are
+    removed once the workspace grows past quota_bytes."""
+
+    def __init__(self, root=None, quota_bytes=DEFAULT_QUOTA_BYTES):
+        self.root = root or cache_dir("workspace")
+        self.quota_bytes = quota_bytes
+        self.reused = 0
+        self.extracted = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._in_use = {}
+        self._checkouts = {}
+        self.sweep_scratch()
+
+    def accepts(self, job):
+        """Only .ipa inputs that are signed into a separate output file"""
+        return bool(job.output_path) and os.path.isfile(job.input_path)
+
+    def _entry(self, key):
+        return os.path.join(self.root, "apps", key)
+
+    def _scratch_root(self):
+        return os.path.join(self.root, "scratch")
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _read_meta(self, entry):
+        with open(os.path.join(entry, "meta.json")) as f:
+            return json.load(f)
+
+    def extract(self, ipa_path):
+        """Return (entry, meta) for an IPA, extracting it the first time"""
+        key = file_digest(ipa_path)
+        entry = self._entry(key)
+        with self._key_lock(key):
+            try:
+                meta = self._read_meta(entry)
+                os.utime(os.path.join(entry, "meta.json"))
+                with self._lock:
+                    self.reused += 1
+                return entry, meta
+            except (OSError, ValueError):
+                pass
+
+            # Extract next to the final location and rename it into place, so
+            # a crash never leaves a half-extracted entry behind
+            tmp = f"{entry}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+            os.makedirs(tmp)
+            try:
+                start = time.monotonic()
+                size, files, mutable = extract_ipa(ipa_path, os.path.join(tmp, "tree"))
+                meta = {
+                    "source": os.path.abspath(ipa_path),
+                    "size": size,
+                    "files": files,
+                    "mutable": mutable,
+                    "extract_seconds": round(time.monotonic() - start, 3),
+                }
+                with open(os.path.join(tmp, "meta.json"), "w") as f:
+                    json.dump(meta, f)
+                try:
+                    os.rename(tmp, entry)
+                except OSError:
+                    try:
+                        # Another process extracted the same IPA first
+                        meta = self._read_meta(entry)
+                        shutil.rmtree(tmp, ignore_errors=True)
+                    except (OSError, ValueError):
+                        # A broken entry is in the way; this extraction replaces it
+                        broken = f"{entry}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+                        os.rename(entry, broken)
+                        shutil.rmtree(broken, ignore_errors=True)
+                        os.rename(tmp, entry)
+            except BaseException:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            with self._lock:
+                self.extracted += 1
+
+        self.evict(keep={key})
+        return entry, meta
+
+    def checkout(self, ipa_path):
+        """Return a private folder holding the IPA's Payload, ready for zsign.
+        Pass it to release() once signing is done."""
+        entry, meta = self.extract(ipa_path)
+        key = os.path.basename(entry)
+        with self._lock:
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+
+            scratch = os.path.join(self._scratch_root(), f"{os.getpid()}-{uuid.uuid4().hex}")
+            self._checkouts[scratch] = key
+        try:
+            clone_tree(os.path.join(entry, "tree"), scratch, meta.get("mutable"))
+        except BaseException:
+            self.release(scratch)
+            raise
+        return scratch
+
+    def release(self, scratch):
+        """Delete a checkout made by checkout()"""
+        shutil.rmtree(scratch, ignore_errors=True)
+        with self._lock:
+            key = self._checkouts.pop(scratch, None)
+            if key in self._in_use:
+                self._in_use[key] -= 1
+                if not self._in_use[key]:
+                    del self._in_use[key]
+
+    def sweep_scratch(self):
+        """Remove checkouts and half-finished extractions left behind by
+        processes that have exited"""
+        for root, separator in ((self._scratch_root(), "-"), (os.path.join(self.root, "apps"), ".")):
+            try:
+                names = os.listdir(root)
+            except OSError:
+                continue
+            for name in names:
+                if separator == "." and not name.endswith(".tmp"):
+                    continue
+                pid = name.split(separator)[0 if separator == "-" else 1]
+                if pid.isdigit() and not pid_alive(int(pid)):
+                    shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+    def evict(self, keep=()):
+        """Remove the least recently used extractions until under quota"""
+        apps = os.path.join(self.root, "apps")
+        entries = []
+        try:
+            names = os.listdir(apps)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith(".tmp"):
+                continue
+            entry = os.path.join(apps, name)
+            try:
+                meta = self._read_meta(entry)
+                used = os.stat(os.path.join(entry, "meta.json")).st_mtime
+            except (OSError, ValueError):
+                continue
+            entries.append((used, meta.get("size", 0), name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.quota_bytes:
+                break
+            with self._lock:
+                busy = name in self._in_use
+            if busy or name in keep:
+                continue
+            shutil.rmtree(os.path.join(apps, name), ignore_errors=True)
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            return f"workspace {self.reused} reused, {self.extracted} extracted"
@@ -376,6 +376,7 @@ a = Analysis(
     datas=[
         ('resources/bin', 'bin'),
         ('zsign_gui.py', '.'),
+        ('neosigner', 'neosigner'),
         ('assets/Icon.png', 'assets'),
     ],
     hiddenimports=['tkinter', 'tkinter.ttk', 'tkinter.filedialog', 'tkinter.messagebox', 'tkinter.scrolledtext'],
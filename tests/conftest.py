@@ -0,0 +1,41 @@
+import os
+import stat
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synth import make_ipa  # noqa: E402
+
+FAKE_ZSIGN = os.path.join(ROOT, "benchmarks", "fake_zsign.py")
+STUB_IDEVICE = os.path.join(ROOT, "benchmarks", "stub_idevice.py")
+
+
+def executable(path):
+    if not os.access(path, os.X_OK):
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    """Keep caches, journals and metrics of every test in its own folder"""
+    path = tmp_path / "home"
+    monkeypatch.setenv("NEOSIGNER_HOME", str(path))
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    return path
+
+
+@pytest.fixture
+def fake_zsign(monkeypatch):
+    monkeypatch.setenv("FAKE_ZSIGN_DELAY", "0")
+    return executable(FAKE_ZSIGN)
+
+
+@pytest.fixture
+def ipa(tmp_path):
+    path = str(tmp_path / "app.ipa")
+    make_ipa(path, 512 * 1024, 20)
+    return path
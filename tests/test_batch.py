@@ -0,0 +1,66 @@
+import shutil
+import threading
+from concurrent.futures import Future
+
+from neosigner import batch
+from neosigner.engine import SignJob
+from neosigner.journal import Journal
+from neosigner.verify import Verification
+
+
+def test_item_verified_at_once_is_finished_once(fake_zsign, ipa, tmp_path, monkeypatch):
+    def verify_job(job):
+        # Already done, so add_done_callback runs _verified on the batch thread
+        future = Future()
+        future.set_result(Verification(job.output_path))
+        return future
+
+    monkeypatch.setattr(batch, "verify_job", verify_job)
+    journal = Journal(str(tmp_path / "journal.db"))
+    finished = []
+    finish = journal.finish
+    monkeypatch.setattr(journal, "finish", lambda entry_id, status, *args: finished.append(status)
+                        or finish(entry_id, status, *args))
+    updates = []
+    items = batch.prepare_jobs([batch.BatchItem(ipa)], SignJob("", adhoc=True), str(tmp_path / "out"))
+    runner = batch.BatchRunner(fake_zsign, items, journal=journal, verify=True,
+                               on_update=lambda item: updates.append(item.status))
+    summary = runner.run()
+
+    assert summary.succeeded == 1
+    assert finished == [batch.SUCCEEDED]
+    assert updates[-2:] == [batch.VERIFYING, batch.SUCCEEDED]
+    assert updates.count(batch.SUCCEEDED) == 1
+    assert [entry.status for entry in journal.history()] == [batch.SUCCEEDED]
+
+
+def test_journal_queues_every_job_and_hashes_on_the_pool(fake_zsign, ipa, tmp_path, monkeypatch):
+    inputs = []
+    for i in range(3):
+        path = tmp_path / f"app{i}.ipa"
+        shutil.copy(ipa, path)
+        inputs.append(str(path))
+    journal = Journal(str(tmp_path / "journal.db"))
+    hashed_on = []
+    job_key = batch.job_key
+    monkeypatch.setattr(batch, "job_key", lambda *args: hashed_on.append(threading.current_thread().name)
+                        or job_key(*args))
+    queued_at_start = []
+
+    def on_update(item):
+        if item.status == batch.RUNNING and not queued_at_start:
+            queued_at_start.append(len(journal.history()))
+
+    def run():
+        items = batch.prepare_jobs([batch.BatchItem(path) for path in inputs], SignJob("", adhoc=True),
+                                   str(tmp_path / "out"))
+        return batch.BatchRunner(fake_zsign, items, max_workers=1, journal=journal, on_update=on_update).run()
+
+    assert run().succeeded == 3
+    assert queued_at_start == [3]
+    assert len(hashed_on) == 3 and all(name.startswith("zsign-batch") for name in hashed_on)
+
+    # Run again, every output is intact so nothing is signed or journaled
+    assert run().succeeded == 3
+    assert [entry.status for entry in journal.history()] == [batch.SUCCEEDED] * 3
+    assert journal.interrupted() == []
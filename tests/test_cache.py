@@ -0,0 +1,14 @@
+from neosigner.cache import SignedCache
+
+
+def test_fetch_counts_a_hit_only_once_the_ipa_is_placed(ipa, tmp_path):
+    cache = SignedCache(str(tmp_path / "signed"))
+    cache.store("key", ipa)
+
+    assert not cache.fetch("key", str(tmp_path / "missing" / "out.ipa"))
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert not cache.fetch("other", str(tmp_path / "out.ipa"))
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert cache.fetch("key", str(tmp_path / "out.ipa"))
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert (tmp_path / "out.ipa").read_bytes() == open(ipa, "rb").read()
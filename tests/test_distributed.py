@@ -0,0 +1,57 @@
+import os
+import shutil
+import threading
+import zipfile
+
+from neosigner import batch, distributed
+from neosigner.engine import SignJob
+
+WORKER_ARGS = ["-j", "1", "--no-cache", "--no-scheduler", "--no-verify"]
+
+
+def test_jobs_of_a_killed_worker_are_signed_by_another(fake_zsign, ipa, tmp_path, monkeypatch):
+    # Long enough that the first worker is still signing when it is killed
+    monkeypatch.setenv("FAKE_ZSIGN_DELAY", "2")
+    inputs = []
+    for i in range(3):
+        path = str(tmp_path / f"app{i}.ipa")
+        shutil.copy(ipa, path)
+        inputs.append(path)
+    items = batch.prepare_jobs([batch.BatchItem(path) for path in inputs], SignJob("", adhoc=True),
+                               str(tmp_path / "out"))
+
+    workers = []
+    killed = threading.Event()
+    log = []
+
+    def on_output(item, line):
+        log.append((item.name, line))
+        if line == "Sent to worker local-1" and not killed.is_set():
+            killed.set()
+            # Once the job has arrived and zsign is running on it
+            threading.Timer(1.0, workers[0].kill).start()
+
+    coordinator = distributed.Coordinator(
+        items,
+        host="127.0.0.1",
+        port=0,
+        on_output=on_output,
+        on_ready=lambda address: workers.extend(
+            distributed.start_local_workers(address, 2, WORKER_ARGS + ["--zsign", fake_zsign])))
+    try:
+        summary = coordinator.run()
+    finally:
+        distributed.stop_local_workers(workers)
+
+    assert killed.is_set()
+    assert workers[0].returncode != 0
+    assert summary.succeeded == 3, log
+    lost = [name for name, line in log if "was lost" in line]
+    assert lost
+    for name in lost:
+        assert "Sent to worker local-2" in [line for item, line in log if item == name]
+    for item in items:
+        assert item.status == batch.SUCCEEDED
+        with zipfile.ZipFile(item.job.output_path) as zf:
+            assert zf.testzip() is None
+    assert sorted(os.listdir(tmp_path / "out")) == [f"app{i}_signed.ipa" for i in range(3)]
@@ -0,0 +1,115 @@
+import os
+import plistlib
+import queue
+import socket
+import threading
+
+import pytest
+
+from conftest import STUB_IDEVICE, executable
+from neosigner import monitor
+from neosigner.monitor import DeviceMonitor
+
+TIMEOUT = 10
+
+
+def next_change(changes):
+    return changes.get(timeout=TIMEOUT)
+
+
+@pytest.fixture
+def stub_tools(tmp_path, monkeypatch):
+    """idevice_id and friends from the stub, with the devices listed in a file"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name in ("idevice_id", "ideviceinfo", "ideviceinstaller"):
+        os.symlink(executable(STUB_IDEVICE), bin_dir / name)
+    devices = tmp_path / "devices.txt"
+    devices.write_text("")
+    monkeypatch.setenv("STUB_IDEVICE_FILE", str(devices))
+    return bin_dir, devices
+
+
+def test_polling_follows_attach_and_detach(stub_tools):
+    bin_dir, devices = stub_tools
+    changes = queue.Queue()
+    device_monitor = DeviceMonitor(str(bin_dir / "idevice_id"), on_change=changes.put, poll_seconds=0.1,
+                                   use_usbmuxd=False).start()
+    try:
+        assert next_change(changes) == []
+        assert device_monitor.mode == monitor.POLLING
+
+        devices.write_text("UDID-A\nUDID-B\n")
+        assert next_change(changes) == ["UDID-A", "UDID-B"]
+        assert device_monitor.connected
+
+        devices.write_text("UDID-B\n")
+        assert next_change(changes) == ["UDID-B"]
+
+        devices.write_text("")
+        assert next_change(changes) == []
+        assert not device_monitor.connected
+    finally:
+        device_monitor.stop()
+
+
+class FakeUsbmuxd:
+    """A usbmuxd socket that answers Listen and then sends the given events"""
+
+    def __init__(self, path):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.conn = None
+        self.connected = threading.Event()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        self.conn, _ = self.server.accept()
+        header = self.conn.recv(monitor.HEADER.size)
+        length = monitor.HEADER.unpack(header)[0]
+        message = plistlib.loads(self.conn.recv(length - monitor.HEADER.size))
+        assert message["MessageType"] == "Listen"
+        self.send({"MessageType": "Result", "Number": 0})
+        self.connected.set()
+
+    def send(self, message):
+        payload = plistlib.dumps(message)
+        self.conn.sendall(monitor.HEADER.pack(monitor.HEADER.size + len(payload), 1, monitor.PLIST_MESSAGE, 1)
+                          + payload)
+
+    def attach(self, device_id, udid):
+        self.send({"MessageType": "Attached", "DeviceID": device_id,
+                   "Properties": {"SerialNumber": udid, "ConnectionType": "USB"}})
+
+    def detach(self, device_id):
+        self.send({"MessageType": "Detached", "DeviceID": device_id})
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+        self.server.close()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix sockets")
+def test_usbmuxd_reports_devices_already_attached_at_once(tmp_path, monkeypatch):
+    path = str(tmp_path / "usbmuxd")
+    usbmuxd = FakeUsbmuxd(path)
+    monkeypatch.setenv(monitor.SOCKET_ENV, f"UNIX:{path}")
+    changes = queue.Queue()
+    device_monitor = DeviceMonitor(on_change=changes.put).start()
+    try:
+        assert usbmuxd.connected.wait(TIMEOUT)
+        for i in range(5):
+            usbmuxd.attach(i, f"UDID-{i}")
+        assert next_change(changes) == [f"UDID-{i}" for i in range(5)]
+        assert device_monitor.mode == monitor.LISTENING
+
+        usbmuxd.detach(2)
+        assert next_change(changes) == ["UDID-0", "UDID-1", "UDID-3", "UDID-4"]
+        usbmuxd.attach(7, "UDID-7")
+        assert next_change(changes) == ["UDID-0", "UDID-1", "UDID-3", "UDID-4", "UDID-7"]
+        assert changes.empty()
+    finally:
+        device_monitor.stop()
+        usbmuxd.close()
@@ -0,0 +1,109 @@
+import os
+import random
+import stat
+import zipfile
+import zlib
+
+import pytest
+
+from neosigner import packaging
+from neosigner.incremental import PackIndex
+from neosigner.packaging import crc32_combine, pack_folder
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """An app folder with every kind of entry, and one file big enough to be
+    deflated in several pieces"""
+    monkeypatch.setattr(packaging, "CHUNK_SIZE", 64 * 1024)
+    rng = random.Random(0)
+    root = tmp_path / "src"
+    app = root / "Payload" / "Bench.app"
+    (app / "Base.lproj").mkdir(parents=True)
+    (app / "Info.plist").write_bytes(b"<plist>" * 100)
+    (app / "Base.lproj" / "Main.strings").write_text("hello = world;\n" * 50)
+    (app / "empty.txt").write_bytes(b"")
+    (app / "icon.png").write_bytes(bytes(rng.getrandbits(8) for _ in range(5000)))
+    (app / "résumé.json").write_text('{"a": 1}\n' * 200)
+    words = [b"alpha", b"beta", b"gamma", b"delta", bytes(rng.getrandbits(8) for _ in range(8))]
+    (app / "big.bin").write_bytes(b" ".join(rng.choice(words) for _ in range(60000)))
+    os.symlink("Info.plist", app / "link.plist")
+    return root
+
+
+def check(path, src):
+    """The zip at path is intact and holds exactly what src does"""
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        names = set()
+        for info in zf.infolist():
+            names.add(info.filename)
+            source = src / info.filename.rstrip("/")
+            mode = info.external_attr >> 16
+            if info.is_dir():
+                assert source.is_dir()
+            elif stat.S_ISLNK(mode):
+                assert zf.read(info).decode() == os.readlink(source)
+            else:
+                assert zf.read(info) == source.read_bytes()
+    assert names == {arcname for arcname, _, _ in packaging.walk_entries(str(src))}
+
+
+def test_pack_folder(app, tmp_path):
+    output = tmp_path / "app.ipa"
+    result = pack_folder(str(app), str(output), level=6)
+    check(output, app)
+    assert result.files == 6
+    # The .png and the empty file
+    assert result.stored == 2
+    with zipfile.ZipFile(output) as zf:
+        assert zf.getinfo("Payload/Bench.app/big.bin").compress_type == zipfile.ZIP_DEFLATED
+        assert zf.getinfo("Payload/Bench.app/icon.png").compress_type == zipfile.ZIP_STORED
+
+
+@pytest.mark.parametrize("length", [0, 1, 7, 1000, 100_000])
+def test_crc32_combine_matches_zlib(length):
+    rng = random.Random(length)
+    data = bytes(rng.getrandbits(8) for _ in range(length))
+    for split in sorted({0, length // 3, length // 2, length}):
+        a, b = data[:split], data[split:]
+        assert crc32_combine(zlib.crc32(a), zlib.crc32(b), len(b)) == zlib.crc32(data)
+
+
+def test_zip64_records(app, tmp_path, monkeypatch):
+    # Low limits, so small files take the path of a 4 GB one or 65535 entries
+    monkeypatch.setattr(packaging, "ZIP64_LIMIT", 1000)
+    monkeypatch.setattr(packaging, "ZIP64_COUNT_LIMIT", 3)
+    output = tmp_path / "app.ipa"
+    pack_folder(str(app), str(output), level=6)
+    check(output, app)
+    data = output.read_bytes()
+    assert b"PK\x06\x06" in data and b"PK\x06\x07" in data
+    with zipfile.ZipFile(output) as zf:
+        # Sizes of the big file, and the offset of the last entry
+        last = max(zf.infolist(), key=lambda info: info.header_offset)
+        for info in (zf.getinfo("Payload/Bench.app/big.bin"), last):
+            assert info.extra[:2] == b"\x01\x00"
+        assert last.header_offset >= 1000
+
+
+def test_incremental_pack_is_byte_identical(app, tmp_path):
+    index = PackIndex.load("com.example.bench", 6)
+    pack_folder(str(app), str(tmp_path / "first.ipa"), level=6, index=index)
+    index.save(str(tmp_path / "first.ipa"))
+    index.close()
+
+    # The next build changes one file
+    changed = app / "Payload" / "Bench.app" / "Info.plist"
+    changed.write_bytes(b"<plist version=2>" * 100)
+    index = PackIndex.load("com.example.bench", 6)
+    try:
+        reused = pack_folder(str(app), str(tmp_path / "second.ipa"), level=6, index=index)
+    finally:
+        index.close()
+    fresh = pack_folder(str(app), str(tmp_path / "fresh.ipa"), level=6)
+
+    check(tmp_path / "second.ipa", app)
+    assert reused.reused == 3
+    assert fresh.reused == 0
+    assert (tmp_path / "second.ipa").read_bytes() == (tmp_path / "fresh.ipa").read_bytes()
@@ -0,0 +1,115 @@
+import asyncio
+import http.client
+import json
+import os
+import re
+import subprocess
+import sys
+import zipfile
+from urllib.parse import quote, unquote
+
+import pytest
+
+from conftest import ROOT
+from neosigner.service import SigningService
+
+TIMEOUT = 60
+
+
+@pytest.fixture
+def service(fake_zsign):
+    """A signing service on a free loopback port, run from the command line"""
+    process = subprocess.Popen([sys.executable, "-m", "neosigner", "serve", "-a", "--zsign", fake_zsign,
+                                "--port", "0", "--no-scheduler"],
+                               cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        for line in process.stdout:
+            match = re.search(r"Listening on http://([\d.]+):(\d+)", line)
+            if match:
+                break
+        else:
+            pytest.fail("the service exited before listening")
+        yield match.group(1), int(match.group(2))
+    finally:
+        process.terminate()
+        process.wait(TIMEOUT)
+
+
+def request(address, method, path, body=None):
+    conn = http.client.HTTPConnection(*address, timeout=TIMEOUT)
+    conn.request(method, path, body=body)
+    return conn.getresponse()
+
+
+def events(response):
+    """(event, data) for each server-sent event in a response"""
+    event = None
+    for raw in response:
+        line = raw.decode().rstrip("\n")
+        if line.startswith("event: "):
+            event = line[7:]
+        elif line.startswith("data: "):
+            yield event, line[6:]
+
+
+@pytest.mark.parametrize("name", ["app.ipa", "日本.ipa", 'bad"\r\nX-Injected: 1.ipa'])
+def test_upload_follow_and_download(service, ipa, tmp_path, name):
+    with open(ipa, "rb") as f:
+        response = request(service, "POST", f"/jobs?name={quote(name)}", f.read())
+    assert response.status == 202
+    job = json.load(response)
+    assert job["name"] == name
+
+    lines = []
+    for event, data in events(request(service, "GET", f"/jobs/{job['id']}/events")):
+        if event == "log":
+            lines.append(data)
+        elif event == "done":
+            done = json.loads(data)
+            break
+    else:
+        pytest.fail("the event stream ended without a done event")
+    assert done["status"] == "succeeded", "\n".join(lines)
+    assert any("Signed OK" in line for line in lines)
+
+    response = request(service, "GET", done["download"])
+    assert response.status == 200
+    assert response.getheader("X-Injected") is None
+    disposition = response.getheader("Content-Disposition")
+    fallback = re.search(r'filename="([^"]*)"', disposition).group(1)
+    assert fallback.isascii() and "\r" not in fallback and "\n" not in fallback
+    encoded = re.search(r"filename\*=UTF-8''(\S+)", disposition).group(1)
+    assert unquote(encoded) == f"{name[:-len('.ipa')]}_signed.ipa"
+
+    signed = tmp_path / "signed.ipa"
+    signed.write_bytes(response.read())
+    with zipfile.ZipFile(signed) as zf:
+        assert zf.testzip() is None
+        assert any(entry.endswith(".app/_CodeSignature/CodeResources") for entry in zf.namelist())
+
+
+def test_unknown_job(service):
+    response = request(service, "GET", "/jobs/nope")
+    assert response.status == 404
+    assert "error" in json.load(response)
+
+
+def test_services_sharing_a_root_keep_their_own_jobs(fake_zsign, tmp_path):
+    root = tmp_path / "service"
+    (root / "999999999-dead" / "job").mkdir(parents=True)
+
+    async def run():
+        first = SigningService(fake_zsign, {}, root=str(root))
+        second = SigningService(fake_zsign, {}, root=str(root))
+        servers = [await first.start("127.0.0.1", 0)]
+        open(os.path.join(first.jobs_dir, "marker"), "w").close()
+        servers.append(await second.start("127.0.0.1", 0))
+        assert os.path.exists(os.path.join(first.jobs_dir, "marker"))
+        assert sorted(os.listdir(root)) == sorted(os.path.basename(service.jobs_dir) for service in (first, second))
+        for server in servers:
+            server.close()
+        await first.close()
+        assert os.listdir(root) == [os.path.basename(second.jobs_dir)]
+        await second.close()
+
+    asyncio.run(run())
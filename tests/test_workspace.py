@@ -0,0 +1,66 @@
+import os
+import stat
+import zipfile
+
+import pytest
+
+from neosigner.workspace import Workspace, extract_ipa
+
+
+def add_symlink(zf, name, target):
+    info = zipfile.ZipInfo(name)
+    info.external_attr = (stat.S_IFLNK | 0o777) << 16
+    zf.writestr(info, target)
+
+
+def test_symlinks_cannot_lead_outside_the_extraction(tmp_path):
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    ipa = tmp_path / "evil.ipa"
+    with zipfile.ZipFile(ipa, "w") as zf:
+        zf.writestr("Payload/X.app/Info.plist", b"plist")
+        add_symlink(zf, "Payload/X.app/up", "../../../outside")
+        add_symlink(zf, "Payload/X.app/abs", str(outside))
+        zf.writestr("Payload/X.app/up/pwned.txt", b"pwned")
+        zf.writestr("Payload/X.app/abs/pwned2.txt", b"pwned")
+        # A framework's Versions/Current link stays inside and is kept
+        zf.writestr("Payload/X.app/Frameworks/F.framework/Versions/A/F", b"binary")
+        add_symlink(zf, "Payload/X.app/Frameworks/F.framework/Versions/Current", "A")
+        zf.writestr("Payload/X.app/Frameworks/F.framework/Versions/Current/extra", b"ok")
+
+    dest = tmp_path / "dest"
+    extract_ipa(str(ipa), str(dest))
+
+    assert os.listdir(outside) == []
+    app = dest / "Payload" / "X.app"
+    assert not os.path.islink(app / "up")
+    assert not os.path.islink(app / "abs")
+    current = app / "Frameworks" / "F.framework" / "Versions" / "Current"
+    assert os.readlink(current) == "A"
+    assert (current / "F").read_bytes() == b"binary"
+    assert (current / "extra").read_bytes() == b"ok"
+
+
+@pytest.mark.filterwarnings("ignore:Duplicate name")
+def test_member_cannot_write_through_a_link(tmp_path):
+    ipa = tmp_path / "evil.ipa"
+    with zipfile.ZipFile(ipa, "w") as zf:
+        zf.writestr("Payload/X.app/Info.plist", b"plist")
+        add_symlink(zf, "Payload/X.app/plist", "Info.plist")
+        zf.writestr(zipfile.ZipInfo("Payload/X.app/plist"), b"pwned")
+    dest = tmp_path / "dest"
+    extract_ipa(str(ipa), str(dest))
+    app = dest / "Payload" / "X.app"
+    assert os.readlink(app / "plist") == "Info.plist"
+    assert (app / "Info.plist").read_bytes() == b"plist"
+
+
+def test_broken_workspace_entry_is_extracted_again(tmp_path, ipa):
+    workspace = Workspace(str(tmp_path / "workspace"))
+    entry, meta = workspace.extract(ipa)
+    with open(os.path.join(entry, "meta.json"), "w") as f:
+        f.write("{half")
+    again, meta_again = workspace.extract(ipa)
+    assert again == entry
+    assert meta_again["files"] == meta["files"]
+    assert workspace.extracted == 2
@@ -1,9 +1,41 @@
+import time
+
+# Taken first so the startup report includes the cost of the imports below
+STARTED_AT = time.perf_counter()
+
 import os
 import sys
-import subprocess
+import json
+import multiprocessing
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk, filedialog, scrolledtext, messagebox
 
+from neosigner.cache import SignedCache
+from neosigner.engine import SignError, SignJob
+from neosigner import batch, devices, engine, tools
+from neosigner.logsink import LogSink
+from neosigner.metrics import MetricsWriter
+from neosigner.ipainfo import read_app_info
+from neosigner.journal import Journal
+from neosigner.monitor import DeviceMonitor
+from neosigner.profiles import LIBRARY_ENV, ProfileLibrary
+from neosigner.scheduler import Scheduler
+from neosigner.scratch import SCRATCH_ENV, default_policy
+from neosigner.paths import log_dir
+from neosigner.process import ProcessStream, drain_queue
+from neosigner.verify import can_verify, verify_job
+from neosigner.workspace import Workspace
+
+# How often to check a running process for output, and how long to spend
+# writing its output to the Logs tab each time
+PROCESS_POLL_MS = 50
+OUTPUT_BATCH_SECONDS = 0.02
+
+# How often to pick up device connection changes from the device monitor
+MONITOR_POLL_MS = 250
+
 class ZsignGUI:
     def __init__(self, root):
         self.root = root
@@ -11,6 +43,8 @@ class ZsignGUI:
         self.root.geometry("800x600")
         
         # Get the path to the zsign executable
+        self.startup_times = {"imports": time.perf_counter() - STARTED_AT}
+        mark = time.perf_counter()
         self.zsign_path = self.find_zsign_binary()
         if not self.zsign_path:
             self.prompt_for_zsign_path()
@@ -18,8 +52,35 @@ class ZsignGUI:
                 root.destroy()
                 return
         
-        # Check for ideviceinstaller
-        self.ideviceinstaller_path = self.find_ideviceinstaller()
+        # Use ideviceinstaller straight away if it was found last time; the
+        # full search runs in the background once the window is up
+        self.ideviceinstaller_path = tools.cached_tool_path("ideviceinstaller")
+        self.startup_times["discovery"] = time.perf_counter() - mark
+        mark = time.perf_counter()
+        
+        # The zsign or ideviceinstaller run currently streaming to the Logs tab
+        self.process_stream = None
+        
+        # Connected devices, followed in the background once the window is up
+        self.device_monitor = None
+        self.device_events = queue.Queue()
+        # ideviceinfo's answers by UDID, so each device is only described once per connection
+        self.device_details = {}
+        
+        # Signed apps from earlier runs, reused when the same job comes up again
+        self.signed_cache = SignedCache()
+        
+        # Extracted copies of IPAs for re-signing, created once it's turned on
+        self.workspace = None
+        
+        # Where apps are unpacked, set up for the folder on the Advanced tab
+        self.scratch = None
+        
+        # Per-job timings, appended to metrics.jsonl in the log folder
+        self.metrics = MetricsWriter()
+        
+        # Batch jobs as they start and finish, so a crashed batch can carry on
+        self.journal = Journal()
         
         # Create a notebook (tabs)
         self.notebook = ttk.Notebook(root)
@@ -28,24 +89,123 @@ class ZsignGUI:
         # Create frames for each tab
         self.basic_frame = ttk.Frame(self.notebook)
         self.advanced_frame = ttk.Frame(self.notebook)
+        self.batch_frame = ttk.Frame(self.notebook)
+        self.devices_frame = ttk.Frame(self.notebook)
         self.output_frame = ttk.Frame(self.notebook)
         
         self.notebook.add(self.basic_frame, text="Basic")
         self.notebook.add(self.advanced_frame, text="Advanced")
+        self.notebook.add(self.batch_frame, text="Batch")
+        self.notebook.add(self.devices_frame, text="Devices")
         self.notebook.add(self.output_frame, text="Logs")
         
         # Create the UI elements
         self.create_basic_tab()
         self.create_advanced_tab()
+        self.create_batch_tab()
+        self.create_devices_tab()
         self.create_output_tab()
         
-        # Append zsign version to output
-        try:
-            self.get_zsign_version()
-            if self.ideviceinstaller_path:
-                self.append_output(f"ideviceinstaller found: {self.ideviceinstaller_path}")
-        except Exception as e:
-            self.append_output(f"Warning: Could not get zsign version: {str(e)}")
+        self.startup_times["ui"] = time.perf_counter() - mark
+        
+        # Probe zsign's version and look for ideviceinstaller after the first paint
+        self.root.after_idle(self.on_first_paint)
+    
+    def on_first_paint(self):
+        """Report startup time and start the probes deferred from __init__"""
+        self.startup_times["first_paint"] = time.perf_counter() - STARTED_AT
+        self.append_output("Window ready in {:.0f} ms (imports {:.0f} ms, tool discovery {:.0f} ms, UI {:.0f} ms)".format(
+            *(self.startup_times[k] * 1000 for k in ("first_paint", "imports", "discovery", "ui"))))
+        
+        self.run_in_background(self.record_startup_time, lambda result, error: None)
+        self.run_in_background(lambda: tools.get_zsign_version(self.zsign_path), self.zsign_version_ready)
+        self.run_in_background(self.find_ideviceinstaller, self.ideviceinstaller_ready)
+        self.run_in_background(lambda: tools.find_idevice_tool("idevice_id"), self.start_device_monitor)
+        self.run_in_background(self.requeue_interrupted, self.interrupted_requeued)
+    
+    def record_startup_time(self):
+        """Append this launch's startup timings to startup.jsonl in the log directory"""
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "platform": sys.platform}
+        record.update({f"{k}_ms": round(v * 1000, 1) for k, v in self.startup_times.items()})
+        path = log_dir("startup.jsonl")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    
+    def run_in_background(self, func, on_done):
+        """Call func on a worker thread, then on_done(result, error) on the Tk thread"""
+        results = queue.Queue(maxsize=1)
+        
+        def worker():
+            try:
+                results.put((func(), None))
+            except Exception as e:
+                results.put((None, e))
+        
+        def poll():
+            try:
+                result, error = results.get_nowait()
+            except queue.Empty:
+                self.root.after(PROCESS_POLL_MS, poll)
+                return
+            on_done(result, error)
+        
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(PROCESS_POLL_MS, poll)
+    
+    def zsign_version_ready(self, version, error):
+        """Display the zsign version in the output tab"""
+        if error:
+            self.append_output(f"Error checking zsign version: {str(error)}")
+            return
+        self.append_output(f"Zsign binary found: {self.zsign_path}")
+        self.append_output(f"Version: {version}")
+    
+    def ideviceinstaller_ready(self, path, error):
+        if error or not path:
+            return
+        self.ideviceinstaller_path = path
+        self.append_output(f"ideviceinstaller found: {self.ideviceinstaller_path}")
+        if not self.install_button.winfo_manager():
+            self.install_button.grid(row=6, column=1, padx=5, pady=20)
+    
+    def start_device_monitor(self, idevice_id_path, error):
+        """Follow device connections so installs don't have to look for a device first"""
+        self.device_monitor = DeviceMonitor(idevice_id_path, on_change=self.device_events.put).start()
+        self.root.after(MONITOR_POLL_MS, self.poll_device_monitor)
+    
+    def poll_device_monitor(self):
+        udids = None
+        for udids in drain_queue(self.device_events, OUTPUT_BATCH_SECONDS):
+            pass
+        if udids is not None:
+            self.devices_changed(udids)
+        self.root.after(MONITOR_POLL_MS, self.poll_device_monitor)
+    
+    def devices_changed(self, udids):
+        count = len(udids)
+        self.append_output(f"{count} device{'s' if count != 1 else ''} connected ({self.device_monitor.mode})")
+        self.update_install_button()
+        for udid in list(self.device_details):
+            if udid not in udids:
+                del self.device_details[udid]
+        if self.device_installer:
+            return
+        new = [udid for udid in udids if udid not in self.device_details]
+        if new:
+            self.refresh_devices(new)
+        else:
+            self.show_devices(self.known_devices())
+    
+    def known_devices(self):
+        """The devices the monitor says are connected, as far as they've been described"""
+        return [self.device_details[udid] for udid in self.device_monitor.udids if udid in self.device_details]
+    
+    def update_install_button(self):
+        """Only offer Install to Device while a device is connected, when we know"""
+        monitor = self.device_monitor
+        connected = monitor.connected if monitor and monitor.known else True
+        self.install_button.config(state="normal" if connected else "disabled")
     
     def prompt_for_zsign_path(self):
         """Prompt the user to manually locate the zsign binary"""
@@ -69,6 +229,7 @@ class ZsignGUI:
                         messagebox.showerror("Error", "Selected file is not executable.")
                         return
                     self.zsign_path = path
+                    tools.remember_tool("zsign", path)
                     messagebox.showinfo("Success", f"Using zsign binary at: {path}")
                 else:
                     messagebox.showerror("Error", "Selected file does not exist.")
@@ -78,126 +239,10 @@ class ZsignGUI:
     
     def find_ideviceinstaller(self):
         """Find ideviceinstaller binary for easy installation to device"""
-        if sys.platform == "darwin":
-            # Check common paths on macOS
-            paths = [
-                "/usr/local/bin/ideviceinstaller",
-                "/opt/homebrew/bin/ideviceinstaller"
-            ]
-            
-            for path in paths:
-                if os.path.exists(path) and os.access(path, os.X_OK):
-                    return path
-            
-            # Try to find in PATH
-            try:
-                result = subprocess.run(["which", "ideviceinstaller"], 
-                                      stdout=subprocess.PIPE, 
-                                      stderr=subprocess.PIPE,
-                                      text=True)
-                if result.returncode == 0:
-                    path = result.stdout.strip()
-                    if path and os.path.exists(path):
-                        return path
-            except:
-                pass
-        
-        return None
-    
-    def get_zsign_version(self):
-        """Get the zsign version and display it in the output tab"""
-        try:
-            result = subprocess.run([self.zsign_path, "-v"], 
-                                   stdout=subprocess.PIPE, 
-                                   stderr=subprocess.PIPE,
-                                   text=True)
-            version = result.stdout.strip() or result.stderr.strip()
-            self.append_output(f"Zsign binary found: {self.zsign_path}")
-            self.append_output(f"Version: {version}")
-        except Exception as e:
-            self.append_output(f"Error checking zsign version: {str(e)}")
+        return tools.find_ideviceinstaller()
     
     def find_zsign_binary(self):
-        # Base directory is the directory containing this script
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        
-        # Get home directory
-        home_dir = os.path.expanduser("~")
-        
-        if sys.platform == "darwin":
-            # macOS
-            paths = [
-                os.path.join(base_dir, "bin", "zsign"),                  # Local bin directory
-                os.path.join(base_dir, "zsign_exe"),
-                os.path.join(base_dir, "zsign/bin/zsign"),
-                os.path.join(base_dir, "build", "macos", "zsign"),
-                os.path.join(base_dir, "zsign"),
-                "/usr/local/bin/zsign",
-                "/opt/homebrew/bin/zsign",                               # Homebrew on Apple Silicon
-                os.path.join(home_dir, "zsign/bin/zsign"),               # User's home directory
-                os.path.join(home_dir, "bin/zsign"),
-                os.path.join(home_dir, ".local/bin/zsign"),
-                "/usr/local/zsign/bin/zsign",
-                "/usr/local/bin/zsign",
-                "/usr/local/zsign/bin/zsign",
-                "/zsign/bin/zsign"
-            ]
-            
-            # Try to run 'which zsign' to find it in PATH
-            try:
-                result = subprocess.run(["which", "zsign"], 
-                                      stdout=subprocess.PIPE, 
-                                      stderr=subprocess.PIPE,
-                                      text=True)
-                if result.returncode == 0 and result.stdout.strip():
-                    path = result.stdout.strip()
-                    if os.path.exists(path):
-                        paths.insert(0, path)  # Add to beginning of list
-            except:
-                pass
-                
-        elif sys.platform.startswith("linux"):
-            # Linux
-            paths = [
-                os.path.join(base_dir, "bin", "zsign"),
-                os.path.join(base_dir, "build", "linux", "zsign"),
-                os.path.join(base_dir, "zsign"),
-                os.path.join(home_dir, "zsign/bin/zsign"),
-                os.path.join(home_dir, "bin/zsign"),
-                os.path.join(home_dir, ".local/bin/zsign"),
-                "/usr/local/bin/zsign",
-                "/usr/bin/zsign"
-            ]
-        elif sys.platform == "win32":
-            # Windows
-            paths = [
-                os.path.join(base_dir, "bin", "zsign.exe"),
-                os.path.join(base_dir, "build", "windows", "vs2022", "x64", "Release", "zsign.exe"),
-                os.path.join(base_dir, "zsign.exe")
-            ]
-        else:
-            # Unknown platform
-            return None
-        
-        # Print search paths to output for debugging
-        print(f"Searching for zsign binary in the following paths:")
-        for path in paths:
-            print(f"  - {path}")
-            
-        # Check if binary exists and is executable
-        for path in paths:
-            if os.path.exists(path):
-                if sys.platform != "win32":
-                    # On Unix-like systems, check if the file is executable
-                    if os.access(path, os.X_OK):
-                        print(f"Found zsign binary at: {path}")
-                        return path
-                else:
-                    # On Windows, just check if it exists
-                    print(f"Found zsign binary at: {path}")
-                    return path
-        
-        return None
+        return tools.find_zsign_binary(verbose=True)
     
     def create_basic_tab(self):
         frame = self.basic_frame
@@ -224,6 +269,7 @@ class ZsignGUI:
         self.prov_entry = ttk.Entry(frame, width=50)
         self.prov_entry.grid(row=3, column=1, sticky="we", padx=5, pady=5)
         ttk.Button(frame, text="Browse", command=self.browse_prov).grid(row=3, column=2, padx=5, pady=5)
+        ttk.Button(frame, text="Auto-Select", command=self.auto_select_profile).grid(row=3, column=3, padx=5, pady=5)
         
         # Output file
         ttk.Label(frame, text="Signed App Location:").grid(row=4, column=0, sticky="w", padx=5, pady=5)
@@ -239,8 +285,15 @@ class ZsignGUI:
         ttk.Button(frame, text="Sign App", command=self.sign).grid(row=6, column=0, padx=5, pady=20)
         
         # Install button (only show if ideviceinstaller is available)
+        self.install_button = ttk.Button(frame, text="Install to Device", command=self.install_to_device)
         if self.ideviceinstaller_path:
-            ttk.Button(frame, text="Install to Device", command=self.install_to_device).grid(row=6, column=1, padx=5, pady=20)
+            self.install_button.grid(row=6, column=1, padx=5, pady=20)
+        
+        # What the chosen app says about itself, read without unzipping it
+        self.app_info = None
+        self.prefilled = {}
+        self.app_info_label = ttk.Label(frame, text="", wraplength=600, justify="left")
+        self.app_info_label.grid(row=7, column=0, columnspan=4, sticky="w", padx=5, pady=5)
         
         # Add some stretching
         frame.columnconfigure(1, weight=1)
@@ -302,8 +355,134 @@ class ZsignGUI:
         self.zip_level_var = tk.StringVar(value="9")
         ttk.Spinbox(frame, from_=0, to=9, textvariable=self.zip_level_var, width=5).grid(row=8, column=1, sticky="w", padx=5, pady=5)
         
+        # Cache checkbox
+        self.cache_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(frame, text="Reuse Cached Signed Apps", variable=self.cache_var).grid(row=9, column=0, columnspan=2, sticky="w", padx=5, pady=5)
+        
+        # Workspace checkbox
+        self.workspace_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(frame, text="Keep Extracted Apps for Re-signing", variable=self.workspace_var).grid(row=10, column=0, columnspan=2, sticky="w", padx=5, pady=5)
+        
+        # Parallel compression checkbox
+        self.parallel_zip_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(frame, text="Compress Output on All Cores", variable=self.parallel_zip_var).grid(row=11, column=0, columnspan=2, sticky="w", padx=5, pady=5)
+        
+        # Profile library
+        ttk.Label(frame, text="Profile Library:").grid(row=12, column=0, sticky="w", padx=5, pady=5)
+        self.profiles_entry = ttk.Entry(frame, width=50)
+        self.profiles_entry.insert(0, os.environ.get(LIBRARY_ENV, ""))
+        self.profiles_entry.grid(row=12, column=1, sticky="we", padx=5, pady=5)
+        ttk.Button(frame, text="Browse", command=self.browse_profiles).grid(row=12, column=2, padx=5, pady=5)
+        
+        # Fast folder for unpacking apps, e.g. a tmpfs
+        ttk.Label(frame, text="Fast Scratch Folder:").grid(row=13, column=0, sticky="w", padx=5, pady=5)
+        self.scratch_entry = ttk.Entry(frame, width=50)
+        self.scratch_entry.insert(0, os.environ.get(SCRATCH_ENV, ""))
+        self.scratch_entry.grid(row=13, column=1, sticky="we", padx=5, pady=5)
+        ttk.Button(frame, text="Browse", command=self.browse_scratch).grid(row=13, column=2, padx=5, pady=5)
+        
+        # Verification checkbox
+        self.verify_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(frame, text="Verify Signed Apps", variable=self.verify_var).grid(row=14, column=0, columnspan=2, sticky="w", padx=5, pady=5)
+        
+        # Slimming rules, e.g. to drop Watch apps and unused localizations
+        ttk.Label(frame, text="Slimming Rules:").grid(row=15, column=0, sticky="w", padx=5, pady=5)
+        self.slim_entry = ttk.Entry(frame, width=50)
+        self.slim_entry.grid(row=15, column=1, sticky="we", padx=5, pady=5)
+        ttk.Button(frame, text="Browse", command=self.browse_slim).grid(row=15, column=2, padx=5, pady=5)
+        
+        # Add some stretching
+        frame.columnconfigure(1, weight=1)
+    
+    def create_batch_tab(self):
+        frame = self.batch_frame
+        self.batch_items = []
+        self.batch_runner = None
+        self.batch_queue = queue.Queue()
+        
+        ttk.Label(frame, text="Jobs use the certificate, profile and options from the Basic and Advanced tabs. "
+                              "Load a CSV manifest for per-job overrides.",
+                  wraplength=700).grid(row=0, column=0, columnspan=4, sticky="w", padx=5, pady=5)
+        
+        # Job list
+        columns = ("input", "output", "bundle_id", "profile", "dylib", "status", "attempts")
+        self.batch_tree = ttk.Treeview(frame, columns=columns, show="headings", height=12)
+        for column, heading, width in (("input", "Input", 160), ("output", "Output", 160),
+                                       ("bundle_id", "Bundle ID", 110), ("profile", "Profile", 100),
+                                       ("dylib", "Dylib", 80), ("status", "Status", 80),
+                                       ("attempts", "Tries", 40)):
+            self.batch_tree.heading(column, text=heading)
+            self.batch_tree.column(column, width=width)
+        self.batch_tree.grid(row=1, column=0, columnspan=4, sticky="nsew", padx=5, pady=5)
+        
+        # List buttons
+        ttk.Button(frame, text="Add IPAs", command=self.batch_add_files).grid(row=2, column=0, sticky="w", padx=5, pady=5)
+        ttk.Button(frame, text="Load Manifest", command=self.batch_load_manifest).grid(row=2, column=1, sticky="w", padx=5, pady=5)
+        ttk.Button(frame, text="Remove Selected", command=self.batch_remove_selected).grid(row=2, column=2, sticky="w", padx=5, pady=5)
+        ttk.Button(frame, text="Clear", command=self.batch_clear).grid(row=2, column=3, sticky="w", padx=5, pady=5)
+        
+        # Output folder for jobs without an explicit output
+        ttk.Label(frame, text="Output Folder:").grid(row=3, column=0, sticky="w", padx=5, pady=5)
+        self.batch_output_entry = ttk.Entry(frame, width=50)
+        self.batch_output_entry.grid(row=3, column=1, columnspan=2, sticky="we", padx=5, pady=5)
+        ttk.Button(frame, text="Browse", command=self.browse_batch_output).grid(row=3, column=3, sticky="w", padx=5, pady=5)
+        
+        # Concurrency and retries
+        ttk.Label(frame, text="Concurrent Jobs:").grid(row=4, column=0, sticky="w", padx=5, pady=5)
+        self.batch_workers_var = tk.StringVar(value=str(min(4, os.cpu_count() or 1)))
+        ttk.Spinbox(frame, from_=1, to=32, textvariable=self.batch_workers_var, width=5).grid(row=4, column=1, sticky="w", padx=5, pady=5)
+        ttk.Label(frame, text="Retries:").grid(row=5, column=0, sticky="w", padx=5, pady=5)
+        self.batch_retries_var = tk.StringVar(value="1")
+        ttk.Spinbox(frame, from_=0, to=5, textvariable=self.batch_retries_var, width=5).grid(row=5, column=1, sticky="w", padx=5, pady=5)
+        
+        # Run and cancel buttons
+        self.batch_run_button = ttk.Button(frame, text="Run Batch", command=self.run_batch)
+        self.batch_run_button.grid(row=6, column=0, padx=5, pady=20)
+        self.batch_cancel_button = ttk.Button(frame, text="Cancel Batch", command=self.cancel_batch, state="disabled")
+        self.batch_cancel_button.grid(row=6, column=1, sticky="w", padx=5, pady=20)
+        
+        # Add some stretching
+        frame.columnconfigure(1, weight=1)
+        frame.rowconfigure(1, weight=1)
+    
+    def create_devices_tab(self):
+        frame = self.devices_frame
+        self.devices = []
+        self.device_installer = None
+        self.device_queue = queue.Queue()
+        
+        ttk.Label(frame, text="Installs the app from \"Signed App Location\" on the Basic tab. "
+                              "Select several devices (or Select All) to install on them in parallel.",
+                  wraplength=700).grid(row=0, column=0, columnspan=4, sticky="w", padx=5, pady=5)
+        
+        # Device list
+        columns = ("name", "model", "ios", "udid", "status", "progress")
+        self.device_tree = ttk.Treeview(frame, columns=columns, show="headings", height=12, selectmode="extended")
+        for column, heading, width in (("name", "Name", 140), ("model", "Model", 90), ("ios", "iOS", 50),
+                                       ("udid", "UDID", 220), ("status", "Status", 80),
+                                       ("progress", "Progress", 60)):
+            self.device_tree.heading(column, text=heading)
+            self.device_tree.column(column, width=width)
+        self.device_tree.grid(row=1, column=0, columnspan=4, sticky="nsew", padx=5, pady=5)
+        
+        # List buttons
+        ttk.Button(frame, text="Refresh Devices", command=self.refresh_devices).grid(row=2, column=0, sticky="w", padx=5, pady=5)
+        ttk.Button(frame, text="Select All", command=lambda: self.device_tree.selection_set(self.device_tree.get_children())).grid(row=2, column=1, sticky="w", padx=5, pady=5)
+        
+        # Parallel installs
+        ttk.Label(frame, text="Parallel Installs:").grid(row=3, column=0, sticky="w", padx=5, pady=5)
+        self.device_parallel_var = tk.StringVar(value=str(devices.DEFAULT_MAX_PARALLEL))
+        ttk.Spinbox(frame, from_=1, to=20, textvariable=self.device_parallel_var, width=5).grid(row=3, column=1, sticky="w", padx=5, pady=5)
+        
+        # Install and cancel buttons
+        self.device_install_button = ttk.Button(frame, text="Install to Selected", command=self.install_to_selected)
+        self.device_install_button.grid(row=4, column=0, padx=5, pady=20)
+        self.device_cancel_button = ttk.Button(frame, text="Cancel Install", command=self.cancel_device_install, state="disabled")
+        self.device_cancel_button.grid(row=4, column=1, sticky="w", padx=5, pady=20)
+        
         # Add some stretching
         frame.columnconfigure(1, weight=1)
+        frame.rowconfigure(1, weight=1)
     
     def create_output_tab(self):
         frame = self.output_frame
@@ -312,9 +491,23 @@ class ZsignGUI:
         self.output_text = scrolledtext.ScrolledText(frame, width=80, height=30)
         self.output_text.pack(fill="both", expand=True, padx=5, pady=5)
         self.output_text.config(state="disabled")
+        self.log_sink = LogSink(self.output_text)
+        
+        # Clear and cancel buttons
+        buttons = ttk.Frame(frame)
+        buttons.pack(pady=5)
+        ttk.Button(buttons, text="Clear Logs", command=self.clear_output).pack(side="left", padx=5)
+        self.cancel_button = ttk.Button(buttons, text="Cancel", command=self.cancel_process, state="disabled")
+        self.cancel_button.pack(side="left", padx=5)
         
-        # Clear button
-        ttk.Button(frame, text="Clear Logs", command=self.clear_output).pack(pady=5)
+        # Line cap and log file
+        ttk.Label(buttons, text="Keep Lines:").pack(side="left", padx=(20, 5))
+        self.log_lines_var = tk.StringVar(value=str(self.log_sink.max_lines))
+        self.log_lines_var.trace_add("write", self.update_log_lines)
+        ttk.Spinbox(buttons, from_=100, to=100000, increment=1000, textvariable=self.log_lines_var, width=7).pack(side="left")
+        self.log_file_var = tk.BooleanVar()
+        ttk.Checkbutton(buttons, text="Save Logs to File", variable=self.log_file_var,
+                        command=self.toggle_log_file).pack(side="left", padx=5)
     
     def browse_input(self):
         path = filedialog.askopenfilename(filetypes=[("IPA files", "*.ipa"), ("All files", "*.*")])
@@ -323,6 +516,45 @@ class ZsignGUI:
         if path:
             self.input_entry.delete(0, tk.END)
             self.input_entry.insert(0, path)
+            self.inspect_input(path)
+    
+    def inspect_input(self, path):
+        """Show the app's details and prefill the overrides on the Advanced tab"""
+        self.app_info = None
+        self.app_info_label.config(text="Reading app...")
+        self.run_in_background(lambda: read_app_info(path), self.input_inspected)
+    
+    def input_inspected(self, app_info, error):
+        if app_info and app_info.path != self.input_entry.get().strip():
+            return
+        if error or app_info.error:
+            self.app_info_label.config(text=f"Can't read app: {str(error or app_info.error)}")
+            return
+        self.app_info = app_info
+        self.app_info_label.config(text=str(app_info))
+        self.append_output(f"App: {app_info}")
+        
+        # Only replace what is empty or was prefilled for the previous app
+        for name, entry, value in (("bundle_id", self.bundle_id_entry, app_info.bundle_id),
+                                   ("name", self.bundle_name_entry, app_info.name),
+                                   ("version", self.bundle_version_entry, app_info.version)):
+            current = entry.get().strip()
+            if not current or current == self.prefilled.get(name):
+                entry.delete(0, tk.END)
+                entry.insert(0, value)
+                self.prefilled[name] = value
+        
+        # Picked now that the bundle ID above belongs to this app
+        if self.profiles_entry.get().strip():
+            self.auto_select_profile(quiet=True)
+    
+    def form_override(self, entry, field):
+        """An override's value, or "" while it still matches the app's own"""
+        value = entry.get().strip()
+        app_info = self.app_info
+        if app_info and app_info.path == self.input_entry.get().strip() and value == getattr(app_info, field):
+            return ""
+        return value
     
     def browse_pkey(self):
         path = filedialog.askopenfilename(filetypes=[("Certificate files", "*.p12"), ("Key files", "*.pem"), ("All files", "*.*")])
@@ -336,6 +568,63 @@ class ZsignGUI:
             self.prov_entry.delete(0, tk.END)
             self.prov_entry.insert(0, path)
     
+    def browse_profiles(self):
+        path = filedialog.askdirectory()
+        if path:
+            self.profiles_entry.delete(0, tk.END)
+            self.profiles_entry.insert(0, path)
+    
+    def browse_scratch(self):
+        path = filedialog.askdirectory()
+        if path:
+            self.scratch_entry.delete(0, tk.END)
+            self.scratch_entry.insert(0, path)
+    
+    def browse_slim(self):
+        path = filedialog.askopenfilename(filetypes=[("Slimming rules", "*.json"), ("All files", "*.*")])
+        if path:
+            self.slim_entry.delete(0, tk.END)
+            self.slim_entry.insert(0, path)
+    
+    def auto_select_profile(self, quiet=False):
+        """Fill in the profile and certificate from the profile library that
+        best fit the app's bundle ID (or the override on the Advanced tab).
+        When quiet, ones the user chose by hand are left alone."""
+        directory = self.profiles_entry.get().strip()
+        if not directory:
+            messagebox.showerror("Error", "Choose a Profile Library folder on the Advanced tab first.")
+            return
+        job = self.job_from_form()
+        chosen = {"prov": job.prov, "pkey": job.pkey}
+        job.pkey = job.prov = ""
+        job.adhoc = False
+        
+        def pick():
+            library = ProfileLibrary(directory, password=job.password).scan()
+            return library.apply(job)
+        
+        def picked(match, error):
+            if error:
+                self.append_output(f"No profile selected: {str(error)}")
+                if not quiet:
+                    messagebox.showerror("Error", str(error))
+                return
+            if quiet and job.input_path != self.input_entry.get().strip():
+                return
+            # Picking for a new app keeps files the user chose by hand
+            kept = [name for name, path in chosen.items() if quiet and path and path != self.prefilled.get(name)]
+            if kept:
+                self.append_output(f"Found {match}, keeping the certificate and profile chosen by hand")
+                return
+            for name, entry, path in (("prov", self.prov_entry, match.profile.path),
+                                      ("pkey", self.pkey_entry, match.certificate.path)):
+                entry.delete(0, tk.END)
+                entry.insert(0, path)
+                self.prefilled[name] = path
+            self.append_output(f"Using {match}")
+        
+        self.run_in_background(pick, picked)
+    
     def browse_output(self):
         path = filedialog.asksaveasfilename(defaultextension=".ipa", filetypes=[("IPA files", "*.ipa"), ("All files", "*.*")])
         if path:
@@ -360,92 +649,438 @@ class ZsignGUI:
             self.dylib_entry.delete(0, tk.END)
             self.dylib_entry.insert(0, path)
     
+    def browse_batch_output(self):
+        path = filedialog.askdirectory()
+        if path:
+            self.batch_output_entry.delete(0, tk.END)
+            self.batch_output_entry.insert(0, path)
+    
+    def batch_add_files(self):
+        paths = filedialog.askopenfilenames(filetypes=[("IPA files", "*.ipa"), ("All files", "*.*")])
+        for path in paths:
+            self.batch_items.append(batch.BatchItem(path))
+        self.refresh_batch_tree()
+    
+    def batch_load_manifest(self):
+        path = filedialog.askopenfilename(filetypes=[("CSV files", "*.csv"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            self.batch_items.extend(batch.load_manifest(path))
+        except Exception as e:
+            messagebox.showerror("Error", f"Could not load manifest: {str(e)}")
+            return
+        self.refresh_batch_tree()
+    
+    def requeue_interrupted(self):
+        """Batch items for the jobs a crashed or killed run left unfinished,
+        signed with the options they were first run with. The journal only
+        counts them as resumed once the batch runs them."""
+        items = []
+        for entry in self.journal.interrupted():
+            job = entry.sign_job()
+            items.append(batch.BatchItem(entry.input_path, resumed_job=job, resumes=entry.id))
+        return items
+    
+    def interrupted_requeued(self, items, error):
+        if error:
+            self.append_output(f"Could not read the job journal: {str(error)}")
+            return
+        if not items:
+            return
+        self.batch_items.extend(items)
+        self.refresh_batch_tree()
+        self.append_output(f"Added {len(items)} jobs left unfinished by the last run to the Batch tab; "
+                           "run the batch to resume them")
+    
+    def batch_remove_selected(self):
+        if self.batch_runner:
+            return
+        selected = {int(iid) for iid in self.batch_tree.selection()}
+        self.batch_items = [item for i, item in enumerate(self.batch_items) if i not in selected]
+        self.refresh_batch_tree()
+    
+    def batch_clear(self):
+        if self.batch_runner:
+            return
+        self.batch_items = []
+        self.refresh_batch_tree()
+    
+    def refresh_batch_tree(self):
+        self.batch_tree.delete(*self.batch_tree.get_children())
+        for i, item in enumerate(self.batch_items):
+            self.batch_tree.insert("", tk.END, iid=str(i), values=self.batch_row(item))
+    
+    def batch_row(self, item):
+        job = item.job or item.resumed_job
+        overrides = vars(job) if job else item.overrides
+        return (
+            os.path.basename(item.input_path),
+            os.path.basename(overrides.get("output_path", "")),
+            overrides.get("bundle_id", ""),
+            os.path.basename(overrides.get("prov", "")),
+            os.path.basename(overrides.get("dylib", "")),
+            item.status,
+            item.attempts
+        )
+    
+    def job_from_form(self, input_path=None):
+        """Build a SignJob from the Basic and Advanced tabs"""
+        try:
+            zip_level = int(self.zip_level_var.get())
+        except ValueError:
+            zip_level = None
+        
+        return SignJob(
+            input_path=self.input_entry.get().strip() if input_path is None else input_path,
+            output_path=self.output_entry.get().strip(),
+            pkey=self.pkey_entry.get().strip(),
+            prov=self.prov_entry.get().strip(),
+            password=self.password_entry.get(),
+            adhoc=self.adhoc_var.get(),
+            cert=self.cert_entry.get().strip(),
+            bundle_id=self.form_override(self.bundle_id_entry, "bundle_id"),
+            bundle_name=self.form_override(self.bundle_name_entry, "name"),
+            bundle_version=self.form_override(self.bundle_version_entry, "version"),
+            entitlements=self.entitlements_entry.get().strip(),
+            dylib=self.dylib_entry.get().strip(),
+            weak=self.weak_var.get(),
+            force=self.force_var.get(),
+            sha256_only=self.sha256_var.get(),
+            install=self.install_var.get(),
+            zip_level=zip_level,
+            parallel_zip=self.parallel_zip_var.get(),
+            slim=self.slim_entry.get().strip()
+        )
+    
+    def run_batch(self):
+        if self.batch_runner:
+            return
+        if not self.batch_items:
+            messagebox.showerror("Error", "Add at least one IPA to the batch.")
+            return
+        
+        # Reset any previous results
+        for item in self.batch_items:
+            item.job = None
+            item.status = batch.PENDING
+            item.attempts = 0
+            item.returncode = None
+            item.error = ""
+        
+        try:
+            workers = max(1, int(self.batch_workers_var.get()))
+            retries = max(0, int(self.batch_retries_var.get()))
+        except ValueError:
+            messagebox.showerror("Error", "Concurrent jobs and retries must be numbers.")
+            return
+        
+        # The batch never installs to a device; that stays a per-app action
+        template = self.job_from_form(input_path="")
+        template.install = False
+        template.output_path = ""
+        
+        try:
+            batch.prepare_jobs(self.batch_items, template, self.batch_output_entry.get().strip())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        
+        for item in self.batch_items:
+            try:
+                engine.validate(item.job)
+            except SignError as e:
+                messagebox.showerror("Error", f"{os.path.basename(item.input_path)}: {str(e)}")
+                return
+        
+        self.refresh_batch_tree()
+        self.append_output(f"Starting batch of {len(self.batch_items)} jobs with {workers} concurrent zsign processes")
+        self.batch_runner = batch.BatchRunner(
+            self.zsign_path,
+            self.batch_items,
+            max_workers=workers,
+            retries=retries,
+            on_update=lambda item: self.batch_queue.put(("update", item)),
+            on_output=lambda item, line: self.batch_queue.put(("output", f"[{os.path.basename(item.input_path)}] {line}")),
+            cache=self.signed_cache if self.cache_var.get() else None,
+            workspace=self.signing_workspace(),
+            metrics=self.metrics,
+            journal=self.journal,
+            scheduler=Scheduler(max_jobs=workers),
+            scratch=self.signing_scratch(),
+            verify=self.verify_var.get()
+        )
+        self.batch_run_button.config(state="disabled")
+        self.batch_cancel_button.config(state="normal")
+        
+        runner = self.batch_runner
+        threading.Thread(target=lambda: self.batch_queue.put(("done", runner.run())), daemon=True).start()
+        self.root.after(PROCESS_POLL_MS, self.poll_batch_queue)
+    
+    def cancel_batch(self):
+        if self.batch_runner:
+            self.append_output("Cancelling batch...")
+            self.batch_runner.cancel()
+    
+    def poll_batch_queue(self):
+        for kind, payload in drain_queue(self.batch_queue, OUTPUT_BATCH_SECONDS):
+            if kind == "update":
+                index = self.batch_items.index(payload)
+                self.batch_tree.item(str(index), values=self.batch_row(payload))
+            elif kind == "output":
+                self.append_output(payload)
+            elif kind == "done":
+                self.finish_batch(payload)
+                return
+        
+        delay = 1 if not self.batch_queue.empty() else PROCESS_POLL_MS
+        self.root.after(delay, self.poll_batch_queue)
+    
+    def finish_batch(self, summary):
+        self.batch_runner = None
+        self.batch_run_button.config(state="normal")
+        self.batch_cancel_button.config(state="disabled")
+        
+        for item in self.batch_items:
+            if item.status == batch.FAILED:
+                self.append_output(f"Failed: {item.input_path} ({item.error})")
+        self.append_output(str(summary))
+        
+        if summary.failed:
+            messagebox.showerror("Batch", str(summary))
+        else:
+            messagebox.showinfo("Batch", str(summary))
+    
+    def refresh_devices(self, udids=None):
+        """List connected devices off the Tk thread, or describe the newly
+        connected UDIDs the device monitor reported"""
+        def find():
+            if udids is not None:
+                return devices.describe(udids, tools.find_idevice_tool("ideviceinfo"))
+            idevice_id_path = tools.find_idevice_tool("idevice_id")
+            if not idevice_id_path:
+                raise SignError("idevice_id not found. Please install libimobiledevice first.")
+            return devices.list_devices(idevice_id_path, tools.find_idevice_tool("ideviceinfo"))
+        
+        self.run_in_background(find, lambda found, error: self.devices_listed(found, error, quiet=udids is not None))
+    
+    def devices_listed(self, found, error, quiet=False):
+        if error:
+            self.append_output(f"Error listing devices: {str(error)}")
+            if not quiet:
+                messagebox.showerror("Error", str(error))
+            return
+        if quiet:
+            # Answers can come back in any order; only the monitor's current list counts
+            self.device_details.update((device.udid, device) for device in found)
+            found = self.known_devices()
+        else:
+            self.device_details = {device.udid: device for device in found}
+        if self.device_installer:
+            return
+        self.show_devices(found)
+        self.append_output(f"Found {len(found)} connected device{'s' if len(found) != 1 else ''}")
+    
+    def show_devices(self, found):
+        self.devices = found
+        self.device_tree.delete(*self.device_tree.get_children())
+        for device in found:
+            self.device_tree.insert("", tk.END, iid=device.udid,
+                                    values=(device.name, device.model, device.ios_version, device.udid, "", ""))
+    
+    def install_to_selected(self):
+        if self.device_installer:
+            return
+        selected = set(self.device_tree.selection())
+        targets = [device for device in self.devices if device.udid in selected]
+        try:
+            parallel = max(1, int(self.device_parallel_var.get()))
+        except ValueError:
+            messagebox.showerror("Error", "Parallel installs must be a number.")
+            return
+        
+        ipa_path = self.output_entry.get().strip()
+        try:
+            self.device_installer = devices.MultiInstaller(
+                self.ideviceinstaller_path,
+                ipa_path,
+                targets,
+                max_parallel=parallel,
+                on_update=lambda install: self.device_queue.put(("update", install)),
+                on_output=lambda install, line: self.device_queue.put(("output", f"[{install.device.name or install.device.udid}] {line}"))
+            )
+        except SignError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        
+        for install in self.device_installer.installs:
+            self.device_tree.item(install.device.udid, values=self.device_row(install))
+        self.append_output(f"Installing {os.path.basename(ipa_path)} on {len(targets)} devices, {parallel} at a time")
+        self.device_install_button.config(state="disabled")
+        self.device_cancel_button.config(state="normal")
+        
+        installer = self.device_installer
+        threading.Thread(target=lambda: self.device_queue.put(("done", installer.run())), daemon=True).start()
+        self.root.after(PROCESS_POLL_MS, self.poll_device_queue)
+    
+    def device_row(self, install):
+        device = install.device
+        progress = f"{install.progress}%" if install.progress else ""
+        return (device.name, device.model, device.ios_version, device.udid, install.status, progress)
+    
+    def cancel_device_install(self):
+        if self.device_installer:
+            self.append_output("Cancelling installs...")
+            self.device_installer.cancel()
+    
+    def poll_device_queue(self):
+        for kind, payload in drain_queue(self.device_queue, OUTPUT_BATCH_SECONDS):
+            if kind == "update":
+                if self.device_tree.exists(payload.device.udid):
+                    self.device_tree.item(payload.device.udid, values=self.device_row(payload))
+            elif kind == "output":
+                self.append_output(payload)
+            elif kind == "done":
+                self.finish_device_install(payload)
+                return
+        
+        delay = 1 if not self.device_queue.empty() else PROCESS_POLL_MS
+        self.root.after(delay, self.poll_device_queue)
+    
+    def finish_device_install(self, summary):
+        installs = self.device_installer.installs
+        self.device_installer = None
+        self.device_install_button.config(state="normal")
+        self.device_cancel_button.config(state="disabled")
+        
+        for install in installs:
+            if install.status == batch.FAILED:
+                self.append_output(f"Failed: {install.device} ({install.error})")
+        self.append_output(str(summary))
+        
+        if summary.failed:
+            messagebox.showerror("Install", str(summary))
+        else:
+            messagebox.showinfo("Install", str(summary))
+    
     def clear_output(self):
-        self.output_text.config(state="normal")
-        self.output_text.delete(1.0, tk.END)
-        self.output_text.config(state="disabled")
+        self.log_sink.clear()
     
     def append_output(self, text):
-        self.output_text.config(state="normal")
-        self.output_text.insert(tk.END, text + "\n")
-        self.output_text.see(tk.END)
-        self.output_text.config(state="disabled")
-        self.root.update()
+        self.log_sink.write(text)
     
-    def install_to_device(self):
-        """Install the signed IPA to device using ideviceinstaller"""
-        if not self.ideviceinstaller_path:
-            messagebox.showerror("Error", "ideviceinstaller not found. Please install it first.")
+    def update_log_lines(self, *args):
+        try:
+            max_lines = int(self.log_lines_var.get())
+        except ValueError:
             return
+        if max_lines > 0:
+            self.log_sink.set_max_lines(max_lines)
+    
+    def toggle_log_file(self):
+        if self.log_file_var.get():
+            path = log_dir("neosigner.log")
+            try:
+                self.log_sink.open_file(path)
+            except OSError as e:
+                self.log_file_var.set(False)
+                messagebox.showerror("Error", f"Could not open log file: {str(e)}")
+                return
+            self.append_output(f"Saving logs to {path}")
+        else:
+            self.log_sink.close_file()
+    
+    def start_process(self, cmd, on_done, on_line=None):
+        """Run cmd with its output read on a background thread and streamed
+        into the Logs tab; on_line sees each line as it is shown and on_done
+        is called with the ProcessStream once it exits"""
+        self.process_stream = ProcessStream(cmd).start()
+        self.cancel_button.config(state="normal")
+        self.root.after(PROCESS_POLL_MS, self.pump_process, on_done, on_line)
+    
+    def pump_process(self, on_done, on_line=None):
+        stream = self.process_stream
         
-        output_file = self.output_entry.get().strip()
-        if not output_file:
-            messagebox.showerror("Error", "No signed app specified. Please sign an app first.")
+        # Only spend a slice of each frame on output so the window stays responsive
+        for line in stream.drain(OUTPUT_BATCH_SECONDS):
+            self.append_output(line)
+            if on_line:
+                on_line(line)
+        
+        if stream.finished:
+            self.process_stream = None
+            self.cancel_button.config(state="disabled")
+            on_done(stream)
             return
         
-        if not os.path.exists(output_file):
-            messagebox.showerror("Error", f"Signed app not found: {output_file}")
+        # Come straight back if lines are still waiting, otherwise idle until the next tick
+        delay = 1 if not stream.lines.empty() else PROCESS_POLL_MS
+        self.root.after(delay, self.pump_process, on_done, on_line)
+    
+    def cancel_process(self):
+        if self.process_stream:
+            self.append_output("Cancelling...")
+            self.process_stream.cancel()
+    
+    def install_to_device(self):
+        """Install the signed IPA to device using ideviceinstaller"""
+        if self.process_stream:
             return
         
-        # Check if device is connected
+        output_file = self.output_entry.get().strip()
         try:
-            result = subprocess.run([self.ideviceinstaller_path, "-l"], 
-                                   stdout=subprocess.PIPE, 
-                                   stderr=subprocess.PIPE,
-                                   text=True)
-            if "ERROR:" in result.stdout or "ERROR:" in result.stderr:
-                messagebox.showerror("Error", "No iOS device found. Please connect your device.")
-                return
-        except Exception as e:
-            messagebox.showerror("Error", f"Error checking device: {str(e)}")
+            if not self.ideviceinstaller_path:
+                raise SignError("ideviceinstaller not found. Please install it first.")
+            if not output_file:
+                raise SignError("No signed app specified. Please sign an app first.")
+            if not os.path.exists(output_file):
+                raise SignError(f"Signed app not found: {output_file}")
+            
+            # Check if device is connected, from the monitor's cached state when it has one
+            monitor = self.device_monitor
+            if monitor and monitor.known:
+                if not monitor.connected:
+                    raise SignError("No iOS device found. Please connect your device.")
+            else:
+                engine.check_device(self.ideviceinstaller_path, tools.cached_tool_path("idevice_id"))
+        except SignError as e:
+            messagebox.showerror("Error", str(e))
             return
         
         # Install the app
         self.append_output(f"Installing app to device: {output_file}")
         
         try:
-            cmd = [self.ideviceinstaller_path, "-i", output_file]
-            process = subprocess.Popen(
-                cmd, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.STDOUT, 
-                text=True,
-                bufsize=1
-            )
-            
-            # Switch to output tab
-            self.notebook.select(self.output_frame)
-            
-            # Read output in real-time
-            while True:
-                output = process.stdout.readline()
-                if output == '' and process.poll() is not None:
-                    break
-                if output:
-                    self.append_output(output.strip())
-                self.root.update()
-            
-            return_code = process.poll()
-            
-            if return_code == 0:
-                self.append_output("App installed successfully!")
-                messagebox.showinfo("Success", "App installed successfully to your device!")
-            else:
-                self.append_output(f"Installation failed with code {return_code}")
-                messagebox.showerror("Error", f"Installation failed with code {return_code}")
-                
+            self.start_process([self.ideviceinstaller_path, "-i", output_file], self.install_finished)
         except Exception as e:
             self.append_output(f"Installation error: {str(e)}")
             messagebox.showerror("Error", f"Installation error: {str(e)}")
+            return
+        
+        # Switch to output tab
+        self.notebook.select(self.output_frame)
+    
+    def install_finished(self, stream):
+        return_code = stream.returncode
+        
+        if stream.cancelled:
+            self.append_output("Installation cancelled")
+        elif return_code == 0:
+            self.append_output("App installed successfully!")
+            messagebox.showinfo("Success", "App installed successfully to your device!")
+        else:
+            self.append_output(f"Installation failed with code {return_code}")
+            messagebox.showerror("Error", f"Installation failed with code {return_code}")
     
     def sign(self):
-        input_path = self.input_entry.get().strip()
-        if not input_path:
-            messagebox.showerror("Error", "Unsigned app (.ipa) is required.")
+        if self.process_stream:
             return
         
-        if not os.path.exists(input_path):
-            messagebox.showerror("Error", f"Input path does not exist: {input_path}")
+        job = self.job_from_form()
+        try:
+            engine.validate(job)
+        except SignError as e:
+            messagebox.showerror("Error", str(e))
             return
         
         # Check if zsign binary exists
@@ -459,178 +1094,154 @@ class ZsignGUI:
             else:
                 return
         
-        # Build the command
-        cmd = [self.zsign_path]
-        
-        # Basic options
-        if self.adhoc_var.get():
-            cmd.append("-a")
-        else:
-            # When not adhoc, we need key and prov
-            pkey = self.pkey_entry.get().strip()
-            prov = self.prov_entry.get().strip()
-            
-            if not pkey:
-                messagebox.showerror("Error", "Certificate file (.p12) is required unless using ad-hoc.")
-                return
-            if not prov:
-                messagebox.showerror("Error", "Provisioning profile is required unless using ad-hoc.")
-                return
-            
-            # Check if files exist
-            if not os.path.exists(pkey):
-                messagebox.showerror("Error", f"Certificate file not found: {pkey}")
-                return
-            if not os.path.exists(prov):
-                messagebox.showerror("Error", f"Provisioning profile not found: {prov}")
-                return
-            
-            cmd.extend(["-k", pkey])
-            cmd.extend(["-m", prov])
-            
-            password = self.password_entry.get()
-            if password:
-                cmd.extend(["-p", password])
-        
-        # Output file
-        output_file = self.output_entry.get().strip()
-        if output_file:
-            # Ensure output directory exists
-            output_dir = os.path.dirname(output_file)
-            if output_dir and not os.path.exists(output_dir):
-                try:
-                    os.makedirs(output_dir, exist_ok=True)
-                except Exception as e:
-                    messagebox.showerror("Error", f"Could not create output directory: {str(e)}")
-                    return
-            cmd.extend(["-o", output_file])
-        
-        # Advanced options
-        cert_file = self.cert_entry.get().strip()
-        if cert_file:
-            if not os.path.exists(cert_file):
-                messagebox.showerror("Error", f"Certificate file not found: {cert_file}")
-                return
-            cmd.extend(["-c", cert_file])
-        
-        bundle_id = self.bundle_id_entry.get().strip()
-        if bundle_id:
-            cmd.extend(["-b", bundle_id])
-        
-        bundle_name = self.bundle_name_entry.get().strip()
-        if bundle_name:
-            cmd.extend(["-n", bundle_name])
-        
-        bundle_version = self.bundle_version_entry.get().strip()
-        if bundle_version:
-            cmd.extend(["-r", bundle_version])
-        
-        entitlements = self.entitlements_entry.get().strip()
-        if entitlements:
-            if not os.path.exists(entitlements):
-                messagebox.showerror("Error", f"Entitlements file not found: {entitlements}")
-                return
-            cmd.extend(["-e", entitlements])
-        
-        dylib = self.dylib_entry.get().strip()
-        if dylib:
-            if not os.path.exists(dylib):
-                messagebox.showerror("Error", f"Dylib file not found: {dylib}")
-                return
-            cmd.extend(["-l", dylib])
-        
-        if self.weak_var.get():
-            cmd.append("-w")
-        
-        if self.force_var.get():
-            cmd.append("-f")
-        
-        if self.sha256_var.get():
-            cmd.append("-2")
-        
-        if self.install_var.get():
-            cmd.append("-i")
-        
-        try:
-            zip_level = int(self.zip_level_var.get())
-            if 0 <= zip_level <= 9:
-                cmd.extend(["-z", str(zip_level)])
-        except ValueError:
-            pass
+        # Disable the sign button during signing
+        self.set_form_state("disabled")
+        self.notebook.select(self.output_frame)
         
-        # Add the input path
-        cmd.append(input_path)
+        # Hashing or extracting a large IPA takes a moment, so get the job
+        # ready off the Tk thread
+        sign_run = engine.SignRun(
+            self.zsign_path,
+            job,
+            cache=self.signed_cache if self.cache_var.get() else None,
+            workspace=self.signing_workspace(),
+            metrics=self.metrics,
+            scratch=self.signing_scratch()
+        )
+        self.sign_log_shown = 0
+        if sign_run.cache or sign_run.workspace or sign_run.scratch or job.slim:
+            self.append_output("Preparing signing job...")
+        self.run_in_background(sign_run.prepare,
+                               lambda result, error: self.sign_prepared(sign_run, result, error))
+    
+    def set_form_state(self, state):
+        self.notebook.tab(self.notebook.index(self.basic_frame), state=state)
+        self.notebook.tab(self.notebook.index(self.advanced_frame), state=state)
+    
+    def signing_workspace(self):
+        """The extracted app workspace, if enabled on the Advanced tab"""
+        if not self.workspace_var.get():
+            return None
+        if not self.workspace:
+            self.workspace = Workspace()
+        return self.workspace
+    
+    def signing_scratch(self):
+        """The scratch policy for the fast folder on the Advanced tab, if any"""
+        folder = self.scratch_entry.get().strip()
+        if not folder:
+            return None
+        if not self.scratch or self.scratch.fast_dir != os.path.abspath(folder):
+            try:
+                self.scratch = default_policy(folder)
+            except OSError as e:
+                self.append_output(f"Can't use scratch folder {folder}, unpacking in the temp folder: {str(e)}")
+                return None
+        return self.scratch
+    
+    def show_sign_log(self, sign_run):
+        """Show the lines the signing job logged since the last call"""
+        for line in sign_run.log[self.sign_log_shown:]:
+            self.append_output(line)
+        self.sign_log_shown = len(sign_run.log)
+    
+    def sign_prepared(self, sign_run, result, error):
+        self.show_sign_log(sign_run)
+        if error:
+            sign_run.cleanup()
+            self.set_form_state("normal")
+            self.append_output(f"Error: {str(error)}")
+            messagebox.showerror("Error", str(error))
+            return
+        if result:
+            self.append_output(sign_run.record.summary())
+            self.sign_finished(sign_run.job, 0)
+            return
         
         # Show command
-        cmd_str = " ".join(cmd)
+        cmd_str = " ".join(sign_run.command)
         self.append_output(f"Running command: {cmd_str}")
         
         # Run the command
         try:
-            process = subprocess.Popen(
-                cmd, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.STDOUT, 
-                text=True,
-                bufsize=1,  # Line buffered
-                universal_newlines=True
-            )
-            
-            # Disable the sign button during signing
-            self.notebook.tab(self.notebook.index(self.basic_frame), state="disabled")
-            self.notebook.tab(self.notebook.index(self.advanced_frame), state="disabled")
-            self.notebook.select(self.output_frame)
-            self.root.update()
-            
-            # Read output in real-time
-            while True:
-                output = process.stdout.readline()
-                if output == '' and process.poll() is not None:
-                    break
-                if output:
-                    self.append_output(output.strip())
-                self.root.update()
-            
-            # Check for any remaining output
-            remaining_output = process.stdout.read()
-            if remaining_output:
-                self.append_output(remaining_output.strip())
-            
-            return_code = process.poll()
-            
-            # Re-enable tabs
-            self.notebook.tab(self.notebook.index(self.basic_frame), state="normal")
-            self.notebook.tab(self.notebook.index(self.advanced_frame), state="normal")
-            
-            if return_code == 0:
-                self.append_output("\nSignature completed successfully!")
-                
-                # If output file exists, show its path
-                if output_file and os.path.exists(output_file):
-                    file_size = os.path.getsize(output_file) / (1024 * 1024)  # Size in MB
-                    self.append_output(f"Output file: {output_file} ({file_size:.2f} MB)")
-                
-                messagebox.showinfo("Success", "Signature completed successfully!")
-                
-                # Auto-install if ideviceinstaller is available and install after signing is checked
-                if self.ideviceinstaller_path and self.install_var.get() and output_file and os.path.exists(output_file):
-                    result = messagebox.askquestion("Install", 
-                              "Would you like to install the signed app to your device now?")
-                    if result == 'yes':
-                        self.install_to_device()
-            else:
-                self.append_output(f"\nSignature failed with return code {return_code}")
-                messagebox.showerror("Error", f"Signature failed with return code {return_code}")
-                
+            with sign_run.record.stage("spawn"):
+                self.start_process(sign_run.command, lambda stream: self.sign_exited(sign_run, stream),
+                                   on_line=sign_run.observe)
+            sign_run.started()
         except Exception as e:
+            sign_run.cleanup()
+            self.set_form_state("normal")
             self.append_output(f"Error: {str(e)}")
             messagebox.showerror("Error", str(e))
-            
-            # Re-enable tabs
-            self.notebook.tab(self.notebook.index(self.basic_frame), state="normal")
-            self.notebook.tab(self.notebook.index(self.advanced_frame), state="normal")
+    
+    def sign_exited(self, sign_run, stream):
+        # Caching the result and removing the workspace copy touch the disk,
+        # so finish up off the Tk thread too
+        self.run_in_background(lambda: sign_run.finish(stream.returncode),
+                               lambda result, error: self.sign_wrapped_up(sign_run, stream, error))
+    
+    def sign_wrapped_up(self, sign_run, stream, error):
+        self.show_sign_log(sign_run)
+        if error:
+            self.append_output(f"Error finishing signing job: {str(error)}")
+        else:
+            self.append_output(sign_run.record.summary())
+        self.sign_finished(sign_run.job, stream.returncode, stream.cancelled)
+    
+    def sign_finished(self, job, return_code, cancelled=False):
+        # Re-enable tabs
+        self.set_form_state("normal")
+        
+        if cancelled:
+            self.append_output("\nSignature cancelled")
+        elif return_code == 0:
+            if self.verify_var.get() and can_verify(job):
+                # Reading the whole IPA takes a while, so check it in the
+                # verification pool and report once that's done
+                self.append_output("Verifying signed app...")
+                self.run_in_background(lambda: verify_job(job).result(),
+                                       lambda verification, error: self.sign_verified(job, verification, error))
+            else:
+                self.sign_succeeded(job)
+        else:
+            self.append_output(f"\nSignature failed with return code {return_code}")
+            messagebox.showerror("Error", f"Signature failed with return code {return_code}")
+    
+    def sign_verified(self, job, verification, error):
+        if error:
+            self.append_output(f"Could not verify signed app: {str(error)}")
+        elif not verification.ok:
+            self.append_output(f"\n{verification}")
+            for problem in verification.problems:
+                self.append_output(f"  {problem}")
+            messagebox.showerror("Verification Failed",
+                                 "The signed app failed verification:\n\n" + "\n".join(verification.problems[:10]))
+            return
+        else:
+            self.append_output(str(verification))
+        self.sign_succeeded(job)
+    
+    def sign_succeeded(self, job):
+        output_file = job.output_path
+        self.append_output("\nSignature completed successfully!")
+        
+        # If output file exists, show its path
+        if output_file and os.path.exists(output_file):
+            file_size = os.path.getsize(output_file) / (1024 * 1024)  # Size in MB
+            self.append_output(f"Output file: {output_file} ({file_size:.2f} MB)")
+        
+        messagebox.showinfo("Success", "Signature completed successfully!")
+        
+        # Auto-install if ideviceinstaller is available and install after signing is checked
+        if self.ideviceinstaller_path and job.install and output_file and os.path.exists(output_file):
+            result = messagebox.askquestion("Install", 
+                      "Would you like to install the signed app to your device now?")
+            if result == 'yes':
+                self.install_to_device()
 
 if __name__ == "__main__":
+    # Lets a frozen build start packaging worker processes
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = ZsignGUI(root)
     root.mainloop() 